@@ -0,0 +1,158 @@
+"""
+packing 학습의 contrastive loss를 예전 dense 구현과 chunk 구현으로 계산해서 memory와 속도를 비교하는 benchmark.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.contrastive_loss_benchmark --chunk_size_ls 512 2048
+    python -m benchmark.contrastive_loss_benchmark --device=cuda --batch_size=16
+
+saved는 backward를 위해 autograd가 잡고 있는 tensor 크기의 합, peak는 CUDA에서만 측정 함.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from data.collator import _compute_segment_mask_indices, _sample_segment_negative_indices
+from models.modeling_packed_wav2vec2 import compute_packed_contrastive_loss
+from transformers import HfArgumentParser
+
+
+@dataclass
+class ContrastiveLossBenchmarkArguments:
+    batch_size: int = field(
+        default=8,
+        metadata={"help": "Number of packs in one batch."},
+    )
+    packing_max_seq_len: int = field(
+        default=512,
+        metadata={"help": ""},
+    )
+    packing_max_elem: int = field(
+        default=10,
+        metadata={"help": ""},
+    )
+    proj_codevector_dim: int = field(
+        default=256,
+        metadata={"help": ""},
+    )
+    num_negatives: int = field(
+        default=100,
+        metadata={"help": ""},
+    )
+    chunk_size_ls: List[int] = field(
+        default_factory=lambda: [256, 1024],
+        metadata={"help": "Chunk sizes to benchmark in addition to the unchunked masked-only path."},
+    )
+    device: str = field(
+        default="cpu",
+        metadata={"help": ""},
+    )
+    num_iterations: int = field(
+        default=3,
+        metadata={"help": ""},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def dense_contrastive_loss(transformer_features, quantized_features, mask_time_indices, sampled_negative_indices):
+    # NOTE: chunk 구현 전의 PackedWav2Vec2ForPreTraining.forward와 같은 계산
+    batch_size, sequence_length, hidden_size = quantized_features.shape
+    negative_quantized_features = quantized_features.view(-1, hidden_size)[sampled_negative_indices.long().view(-1)]
+    negative_quantized_features = negative_quantized_features.view(batch_size, sequence_length, -1, hidden_size)
+    negative_quantized_features = negative_quantized_features.permute(2, 0, 1, 3)
+
+    target_features = torch.cat([quantized_features[None, :], negative_quantized_features], dim=0)
+    logits = torch.cosine_similarity(transformer_features.float(), target_features.float(), dim=-1)
+    logits = logits.type_as(target_features) / 0.1
+
+    neg_is_pos = (quantized_features == negative_quantized_features).all(-1)
+    if neg_is_pos.any():
+        logits[1:][neg_is_pos] = float("-inf")
+
+    logits = logits.transpose(0, 2).reshape(-1, logits.size(0))
+    target = ((1 - mask_time_indices.long()) * -100).transpose(0, 1).flatten()
+    return nn.functional.cross_entropy(logits.float(), target, reduction="sum")
+
+
+def get_packed_inputs(args: ContrastiveLossBenchmarkArguments, rng: np.random.Generator):
+    segment_ids = np.full((args.batch_size, args.packing_max_seq_len), -1, dtype=np.int64)
+    segment_length_ls = list()
+    for batch_idx in range(args.batch_size):
+        cut_ls = np.sort(rng.choice(np.arange(1, args.packing_max_seq_len), args.packing_max_elem - 1, replace=False))
+        feat_split_idx = np.diff(np.concatenate([[0], cut_ls, [args.packing_max_seq_len]]))
+        segment_ids[batch_idx] = np.repeat(np.arange(len(feat_split_idx)), feat_split_idx)
+        segment_length_ls.append(feat_split_idx)
+
+    mask_time_indices = _compute_segment_mask_indices(np.concatenate(segment_length_ls), 0.65, 10)
+    mask_time_indices = mask_time_indices.reshape(args.batch_size, args.packing_max_seq_len)
+    sampled_negative_indices = _sample_segment_negative_indices(mask_time_indices, segment_ids, args.num_negatives)
+
+    feature_shape = (args.batch_size, args.packing_max_seq_len, args.proj_codevector_dim)
+    transformer_features = torch.randn(feature_shape, device=args.device, requires_grad=True)
+    quantized_features = torch.randn(feature_shape, device=args.device, requires_grad=True)
+    mask_time_indices = torch.tensor(mask_time_indices, device=args.device)
+    sampled_negative_indices = torch.tensor(sampled_negative_indices, device=args.device)
+    return transformer_features, quantized_features, mask_time_indices, sampled_negative_indices
+
+
+def measure(loss_function, inputs, args: ContrastiveLossBenchmarkArguments):
+    saved_storage = dict()
+
+    def pack_hook(tensor):
+        # NOTE: 같은 storage를 여러 번 저장해도 memory는 한 번만 쓰므로 storage 기준으로 셈.
+        storage = tensor.untyped_storage()
+        saved_storage[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    is_cuda = args.device.startswith("cuda")
+    if is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base_memory = torch.cuda.memory_allocated() if is_cuda else 0
+
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        loss = loss_function(*inputs)
+    loss.backward()
+    peak_memory = torch.cuda.max_memory_allocated() - base_memory if is_cuda else float("nan")
+
+    start_time = time.perf_counter()
+    for _ in range(args.num_iterations):
+        loss_function(*inputs).backward()
+    if is_cuda:
+        torch.cuda.synchronize()
+    wall_time = (time.perf_counter() - start_time) / args.num_iterations
+
+    return loss.item(), sum(saved_storage.values()) / 2**20, peak_memory / 2**20, wall_time
+
+
+def main(args: ContrastiveLossBenchmarkArguments) -> None:
+    torch.manual_seed(args.seed)
+    inputs = get_packed_inputs(args, np.random.default_rng(args.seed))
+
+    loss_function_ls = [("dense", dense_contrastive_loss)]
+    for chunk_size in [None] + list(args.chunk_size_ls):
+
+        def chunked_contrastive_loss(*inputs, chunk_size=chunk_size):
+            return compute_packed_contrastive_loss(
+                *inputs, temperature=0.1, chunk_size=chunk_size, use_checkpoint=chunk_size is not None
+            )
+
+        loss_function_ls.append((f"chunk={chunk_size or 'all'}", chunked_contrastive_loss))
+
+    print(f"{'method':<14}{'loss':>14}{'saved(MB)':>12}{'peak(MB)':>12}{'ms/step':>10}")
+    for name, loss_function in loss_function_ls:
+        loss, saved_memory, peak_memory, wall_time = measure(loss_function, inputs, args)
+        print(f"{name:<14}{loss:>14.3f}{saved_memory:>12.1f}{peak_memory:>12.1f}{wall_time * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([ContrastiveLossBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
@@ -0,0 +1,250 @@
+"""
+Wav2Vec2Pretrainer에서 gradient accumulation으로 micro batch k개를 돌린 grad가, 같은 sample을 batch 하나로 돌린 grad와
+같은지 CPU에서 확인하는 benchmark. micro batch 별로 normalize 하던 이전 방식(micro batch 평균)과의 차이도 같이 출력 함.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.grad_accumulation_benchmark
+    python -m benchmark.grad_accumulation_benchmark --gradient_accumulation_steps=4 --sample_mask_on_device
+
+두 경로가 같은 mask와 negative를 쓰도록 micro batch에서 뽑은 mask를 합쳐서 큰 batch를 만듦.
+dropout, layerdrop, gumbel noise처럼 호출 순서에 따라 달라지는 random은 끄고,
+diversity loss는 batch 전체의 codevector perplexity로 계산되어 micro batch 합으로 나눠지지 않으므로 weight를 0으로 둠.
+
+DeepSpeed 경로는 deepspeed 없이 흉내만 냄. `distributed_type`을 DEEPSPEED로 두고, backward에서
+DeepSpeedEngine.backward처럼 loss를 gradient_accumulation_steps로 나눔. engine의 다른 동작(ZeRO, fp16 loss scale)은 확인하지 않음.
+"""
+
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List
+from unittest import mock
+
+import numpy as np
+import torch
+from accelerate import Accelerator
+from accelerate.utils import DistributedType
+
+from data import DataCollatorForWav2Vec2Pretraining
+from transformers import HfArgumentParser, Wav2Vec2Config, Wav2Vec2FeatureExtractor, Wav2Vec2ForPreTraining
+from utils import Wav2Vec2PretrainingArguments
+from wav2vec2_pretrainer import Wav2Vec2Pretrainer
+
+
+TINY_CONFIG_KWARGS = dict(
+    hidden_size=32,
+    num_hidden_layers=2,
+    num_attention_heads=2,
+    intermediate_size=37,
+    conv_dim=(16, 16, 16),
+    conv_stride=(5, 2, 2),
+    conv_kernel=(10, 3, 3),
+    num_conv_pos_embeddings=16,
+    num_conv_pos_embedding_groups=2,
+    codevector_dim=16,
+    proj_codevector_dim=16,
+    num_codevectors_per_group=10,
+    num_codevector_groups=2,
+    num_negatives=5,
+    do_stable_layer_norm=True,
+    feat_extract_norm="layer",
+    mask_time_prob=0.3,
+    mask_time_length=2,
+    mask_time_min_masks=2,
+    hidden_dropout=0.0,
+    activation_dropout=0.0,
+    attention_dropout=0.0,
+    feat_proj_dropout=0.0,
+    feat_quantizer_dropout=0.0,
+    layerdrop=0.0,
+    diversity_loss_weight=0.0,
+)
+
+
+@dataclass
+class GradAccumulationBenchmarkArguments:
+    gradient_accumulation_steps: int = field(
+        default=3,
+        metadata={"help": "Number of micro batches accumulated into one optimizer step."},
+    )
+    batch_size: int = field(
+        default=2,
+        metadata={"help": "Number of utterances in one micro batch."},
+    )
+    sample_mask_on_device: bool = field(
+        default=False,
+        metadata={"help": "Sample mask_time_indices and negatives in the trainer instead of the collator."},
+    )
+    min_length: int = field(
+        default=800,
+        metadata={"help": "Minimum number of audio samples in a synthetic utterance."},
+    )
+    max_length: int = field(
+        default=2400,
+        metadata={"help": "Maximum number of audio samples in a synthetic utterance."},
+    )
+    tolerance: float = field(
+        default=1e-4,
+        metadata={"help": "Allowed max abs grad difference, relative to the max abs grad of the single batch."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def deterministic_gumbel_softmax(logits: torch.Tensor, tau: float = 1.0, hard: bool = False, dim: int = -1, **kwargs):
+    # NOTE: gumbel noise 없이 softmax(logits / tau)의 straight-through. 호출 순서와 상관없이 같은 codevector가 뽑힘.
+    y_soft = (logits / tau).softmax(dim)
+    if not hard:
+        return y_soft
+    y_hard = torch.zeros_like(logits).scatter_(dim, y_soft.argmax(dim, keepdim=True), 1.0)
+    return y_hard - y_soft.detach() + y_soft
+
+
+def merge_micro_batches(
+    micro_batch_ls: List[Dict[str, torch.Tensor]],
+    input_values_ls: List[torch.Tensor],
+    feature_extractor: Wav2Vec2FeatureExtractor,
+    model: Wav2Vec2ForPreTraining,
+) -> Dict[str, torch.Tensor]:
+    """micro batch에서 뽑힌 mask와 negative를 그대로 쓰는, 같은 sample의 batch 하나를 만듦."""
+    batch = feature_extractor.pad(
+        [{"input_values": x} for x in input_values_ls], return_attention_mask=True, return_tensors="pt"
+    )
+    sequence_length = int(model._get_feat_extract_output_lengths(batch["input_values"].shape[-1]))
+    batch["sub_attention_mask"] = model._get_feature_vector_attention_mask(sequence_length, batch["attention_mask"])
+
+    mask_time_indices_ls, sampled_negative_indices_ls, row_offset = list(), list(), 0
+    for micro_batch in micro_batch_ls:
+        mask_time_indices = micro_batch["mask_time_indices"].cpu()
+        sampled_negative_indices = micro_batch["sampled_negative_indices"].cpu()
+        micro_batch_size, micro_sequence_length = mask_time_indices.shape
+        pad_length = sequence_length - micro_sequence_length
+
+        # NOTE: negative는 `batch_idx * sequence_length + frame_idx`라서 큰 batch의 row와 sequence 길이로 다시 계산 함.
+        row_idx = torch.arange(micro_batch_size)[:, None, None]
+        frame_idx = sampled_negative_indices - row_idx * micro_sequence_length
+        sampled_negative_indices = (row_offset + row_idx) * sequence_length + frame_idx
+        sampled_negative_indices = torch.cat(
+            [sampled_negative_indices, sampled_negative_indices[:, :1].expand(-1, pad_length, -1)], dim=1
+        )
+
+        mask_time_indices_ls.append(torch.nn.functional.pad(mask_time_indices, (0, pad_length)))
+        sampled_negative_indices_ls.append(sampled_negative_indices)
+        row_offset += micro_batch_size
+
+    batch["mask_time_indices"] = torch.cat(mask_time_indices_ls)
+    batch["sampled_negative_indices"] = torch.cat(sampled_negative_indices_ls)
+    return dict(batch)
+
+
+def get_grads(model: Wav2Vec2ForPreTraining) -> torch.Tensor:
+    grads = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+    model.zero_grad(set_to_none=True)
+    return grads
+
+
+def main(args: GradAccumulationBenchmarkArguments) -> None:
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    config = Wav2Vec2Config(**TINY_CONFIG_KWARGS)
+    model = Wav2Vec2ForPreTraining(config).train()
+    feature_extractor = Wav2Vec2FeatureExtractor(return_attention_mask=True)
+    collator = DataCollatorForWav2Vec2Pretraining(
+        model=model,
+        feature_extractor=feature_extractor,
+        mask_time_prob=config.mask_time_prob,
+        mask_time_length=config.mask_time_length,
+        mask_time_min_masks=config.mask_time_min_masks,
+        num_negatives=config.num_negatives,
+        sample_mask_on_device=args.sample_mask_on_device,
+    )
+
+    input_values_ls = [
+        torch.from_numpy(rng.standard_normal(int(rng.integers(args.min_length, args.max_length))).astype(np.float32))
+        for _ in range(args.batch_size * args.gradient_accumulation_steps)
+    ]
+    micro_batch_ls = [
+        collator([{"input_values": x} for x in input_values_ls[idx : idx + args.batch_size]])
+        for idx in range(0, len(input_values_ls), args.batch_size)
+    ]
+
+    with (
+        tempfile.TemporaryDirectory() as output_dir,
+        mock.patch("torch.nn.functional.gumbel_softmax", deterministic_gumbel_softmax),
+    ):
+        train_args = Wav2Vec2PretrainingArguments(
+            output_dir=output_dir,
+            use_cpu=True,
+            report_to="none",
+            gradient_accumulation_steps=args.gradient_accumulation_steps,
+            per_device_train_batch_size=args.batch_size,
+            seed=args.seed,
+        )
+        trainer = Wav2Vec2Pretrainer(model=model, args=train_args)
+
+        # gradient accumulation: 지금 trainer가 하는 것처럼 window 전체의 masked frame 수로 normalize.
+        batch_samples, num_items_in_batch = trainer.get_batch_samples(
+            iter(micro_batch_ls), args.gradient_accumulation_steps
+        )
+        # NOTE: training_step이 device에서 뽑을 negative를 같은 step_key로 미리 뽑아서 큰 batch에 그대로 씀.
+        sampled_batch_ls = list()
+        for inputs in batch_samples:
+            inputs = dict(inputs)
+            step_key = inputs.pop("mask_step_key", None)
+            if step_key is not None:
+                inputs = trainer._sample_mask_on_device(model, trainer._prepare_inputs(inputs), step_key)
+            sampled_batch_ls.append(inputs)
+
+        for inputs in sampled_batch_ls:
+            trainer.training_step(model, dict(inputs), num_items_in_batch)
+        accumulated_grads = get_grads(model)
+
+        # DeepSpeed: backward가 loss를 gradient_accumulation_steps로 나누는 것까지 포함해서 같은 grad가 나와야 함.
+        def deepspeed_backward(loss: torch.Tensor, **kwargs) -> None:
+            (loss / args.gradient_accumulation_steps).backward(**kwargs)
+
+        with (
+            mock.patch.object(Accelerator, "distributed_type", property(lambda self: DistributedType.DEEPSPEED)),
+            mock.patch.object(trainer.accelerator, "backward", deepspeed_backward),
+        ):
+            for inputs in sampled_batch_ls:
+                trainer.training_step(model, dict(inputs), num_items_in_batch)
+        deepspeed_grads = get_grads(model)
+
+        # 이전 방식: micro batch 마다 자기 masked frame 수로 normalize 하고 window 안에서 평균.
+        for inputs in sampled_batch_ls:
+            trainer.training_step(model, dict(inputs))
+        micro_batch_mean_grads = get_grads(model)
+
+        # 같은 sample을 batch 하나로.
+        single_batch = merge_micro_batches(sampled_batch_ls, input_values_ls, feature_extractor, model)
+        single_batch_samples, single_num_items_in_batch = trainer.get_batch_samples(iter([single_batch]), 1)
+        trainer.training_step(model, single_batch_samples[0], single_num_items_in_batch)
+        single_batch_grads = get_grads(model)
+
+    grad_scale = single_batch_grads.abs().max().item()
+    print(f"masked frames: accumulated={int(num_items_in_batch)}, single batch={int(single_num_items_in_batch)}")
+    print(f"{'method':<24}{'max_abs_diff':>14}{'relative':>12}")
+    grads_map = {
+        "accumulated": accumulated_grads,
+        "accumulated_deepspeed": deepspeed_grads,
+        "micro_batch_mean": micro_batch_mean_grads,
+    }
+    for name, grads in grads_map.items():
+        max_abs_diff = (grads - single_batch_grads).abs().max().item()
+        print(f"{name:<24}{max_abs_diff:>14.3e}{max_abs_diff / grad_scale:>12.3e}")
+
+    assert int(num_items_in_batch) == int(single_num_items_in_batch), "두 경로의 masked frame 수가 다름."
+    for name in ("accumulated", "accumulated_deepspeed"):
+        max_abs_diff = (grads_map[name] - single_batch_grads).abs().max().item()
+        assert max_abs_diff <= args.tolerance * grad_scale, (
+            f"{name} grad가 batch 하나의 grad와 다름. relative diff: {max_abs_diff / grad_scale:.3e}"
+        )
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([GradAccumulationBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
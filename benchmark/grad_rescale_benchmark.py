@@ -0,0 +1,190 @@
+"""
+Wav2Vec2Pretrainer의 gradient rescale(1/num_losses)을 parameter loop, `torch._foreach_mul_`,
+backward 전에 loss에 곱하기로 비교하는 benchmark.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.grad_rescale_benchmark --model_size_ls base large
+    python -m benchmark.grad_rescale_benchmark --device=cuda --measure_step
+
+rescale은 grad를 채워둔 상태에서 rescale 부분만 잰 시간, step은 forward + backward + rescale을 잰 시간.
+"""
+
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+import torch
+
+from transformers import HfArgumentParser, Wav2Vec2Config, Wav2Vec2ForPreTraining
+from transformers.models.wav2vec2.modeling_wav2vec2 import _compute_mask_indices, _sample_negative_indices
+
+
+MODEL_SIZE_TO_CONFIG_KWARGS = {
+    "base": dict(),
+    "large": dict(
+        hidden_size=1024,
+        num_hidden_layers=24,
+        num_attention_heads=16,
+        intermediate_size=4096,
+        do_stable_layer_norm=True,
+        feat_extract_norm="layer",
+        codevector_dim=768,
+        proj_codevector_dim=768,
+    ),
+}
+
+
+@dataclass
+class GradRescaleBenchmarkArguments:
+    model_size_ls: List[str] = field(
+        default_factory=lambda: ["base", "large"],
+        metadata={"help": "Model sizes to benchmark: base, large."},
+    )
+    device: str = field(
+        default="cpu",
+        metadata={"help": ""},
+    )
+    measure_step: bool = field(
+        default=False,
+        metadata={"help": "Also time a full forward + backward step for each rescale method."},
+    )
+    batch_size: int = field(
+        default=2,
+        metadata={"help": "Number of utterances in one batch for the step benchmark."},
+    )
+    audio_seconds: float = field(
+        default=4.0,
+        metadata={"help": "Length of each utterance for the step benchmark."},
+    )
+    num_iterations: int = field(
+        default=20,
+        metadata={"help": ""},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def loop_rescale(params: List[torch.nn.Parameter], loss: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    # NOTE: 이전 multiply_grads와 같은 계산
+    for p in params:
+        if p.grad is not None:
+            if torch.is_tensor(scale):
+                scale = scale.to(p.grad.device)
+            p.grad.data.mul_(scale)
+    return loss
+
+
+def foreach_rescale(params: List[torch.nn.Parameter], loss: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    grads_per_device_and_dtype = defaultdict(list)
+    for p in params:
+        if p.grad is not None:
+            grads_per_device_and_dtype[(p.grad.device, p.grad.dtype)].append(p.grad)
+    for (device, _), grads in grads_per_device_and_dtype.items():
+        torch._foreach_mul_(grads, scale.to(device))
+    return loss
+
+
+def fold_rescale(params: List[torch.nn.Parameter], loss: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    # NOTE: 지금 Wav2Vec2Pretrainer.training_step이 쓰는 방식. backward 전에 loss에 곱하므로 grad pass가 없음.
+    return loss * scale
+
+
+RESCALE_FUNCTIONS: Dict[str, Callable] = {"loop": loop_rescale, "foreach": foreach_rescale, "fold": fold_rescale}
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def get_batch(model: Wav2Vec2ForPreTraining, args: GradRescaleBenchmarkArguments, device: torch.device) -> dict:
+    config = model.config
+    input_values = torch.randn(args.batch_size, int(args.audio_seconds * 16000))
+    sequence_length = int(model._get_feat_extract_output_lengths(input_values.shape[-1]))
+    mask_time_indices = _compute_mask_indices(
+        (args.batch_size, sequence_length), config.mask_time_prob, config.mask_time_length, min_masks=2
+    )
+    sampled_negative_indices = _sample_negative_indices(
+        (args.batch_size, sequence_length), config.num_negatives, mask_time_indices=mask_time_indices
+    )
+    return {
+        "input_values": input_values.to(device),
+        "mask_time_indices": torch.tensor(mask_time_indices, device=device),
+        "sampled_negative_indices": torch.tensor(sampled_negative_indices, device=device),
+    }
+
+
+def benchmark_rescale(model: Wav2Vec2ForPreTraining, args: GradRescaleBenchmarkArguments, device: torch.device):
+    params = list(model.parameters())
+    for p in params:
+        p.grad = torch.randn_like(p)
+
+    result = dict()
+    loss, scale = torch.ones((), device=device), torch.tensor(1 / 3000, device=device)
+    for name, rescale_function in RESCALE_FUNCTIONS.items():
+        rescale_function(params, loss, scale)
+        synchronize(device)
+        start_time = time.perf_counter()
+        for _ in range(args.num_iterations):
+            rescale_function(params, loss, scale)
+        synchronize(device)
+        result[name] = (time.perf_counter() - start_time) / args.num_iterations
+    model.zero_grad(set_to_none=True)
+    return result
+
+
+def benchmark_step(model: Wav2Vec2ForPreTraining, args: GradRescaleBenchmarkArguments, device: torch.device):
+    params = list(model.parameters())
+    batch = get_batch(model, args, device)
+    num_losses = batch["mask_time_indices"].sum()
+
+    result = dict()
+    for name, rescale_function in RESCALE_FUNCTIONS.items():
+        step_time = 0.0
+        for step in range(args.num_iterations + 1):
+            model.zero_grad(set_to_none=True)
+            synchronize(device)
+            start_time = time.perf_counter()
+
+            loss = model(**batch).loss
+            if name == "fold":
+                rescale_function(params, loss, 1 / num_losses).backward()
+            else:
+                loss.backward()
+                rescale_function(params, loss, 1 / num_losses)
+
+            synchronize(device)
+            # NOTE: 첫 step은 warmup
+            step_time += (time.perf_counter() - start_time) if step else 0.0
+        result[name] = step_time / args.num_iterations
+    return result
+
+
+def main(args: GradRescaleBenchmarkArguments) -> None:
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+
+    print(f"{'model':<8}{'params(M)':>12}{'method':>10}{'rescale(ms)':>14}{'step(ms)':>12}")
+    for model_size in args.model_size_ls:
+        config = Wav2Vec2Config(**MODEL_SIZE_TO_CONFIG_KWARGS[model_size])
+        model = Wav2Vec2ForPreTraining(config).to(device).train()
+        param_num = sum(p.numel() for p in model.parameters()) / 1e6
+
+        rescale_result = benchmark_rescale(model, args, device)
+        step_result = benchmark_step(model, args, device) if args.measure_step else dict()
+        for name in RESCALE_FUNCTIONS:
+            step_time = f"{step_result[name] * 1000:>12.1f}" if name in step_result else f"{'-':>12}"
+            print(f"{model_size:<8}{param_num:>12.1f}{name:>10}{rescale_result[name] * 1000:>14.3f}{step_time}")
+
+        del model
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([GradRescaleBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
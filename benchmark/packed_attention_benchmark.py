@@ -0,0 +1,133 @@
+"""
+packing된 encoder의 attention backend 별 결과가 eager attention과 같은지 확인하고 속도를 비교하는 benchmark. CPU에서도 돌아감.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.packed_attention_benchmark
+    python -m benchmark.packed_attention_benchmark --device=cuda --dtype=bfloat16
+
+flash-attn이 설치되어 있고 CUDA half precision이면 flash_attention_2는 varlen kernel을, 아니면 segment 별 SDPA를 사용 함.
+"""
+
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+
+from models.modeling_packed_wav2vec2 import PackedWav2Vec2Attention, get_block_diagonal_attention_mask
+from transformers import HfArgumentParser, Wav2Vec2Config
+
+
+@dataclass
+class PackedAttentionBenchmarkArguments:
+    batch_size: int = field(
+        default=8,
+        metadata={"help": "Number of packs in one batch."},
+    )
+    packing_max_seq_len: int = field(
+        default=512,
+        metadata={"help": ""},
+    )
+    packing_max_elem: int = field(
+        default=10,
+        metadata={"help": ""},
+    )
+    hidden_size: int = field(
+        default=768,
+        metadata={"help": ""},
+    )
+    num_attention_heads: int = field(
+        default=12,
+        metadata={"help": ""},
+    )
+    device: str = field(
+        default="cpu",
+        metadata={"help": ""},
+    )
+    dtype: str = field(
+        default="float32",
+        metadata={"help": "One of float32, float16, bfloat16."},
+    )
+    num_iterations: int = field(
+        default=20,
+        metadata={"help": "Number of forward calls to time for each backend."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def get_packed_inputs(args: PackedAttentionBenchmarkArguments, rng: np.random.Generator):
+    segment_ids = np.full((args.batch_size, args.packing_max_seq_len), -1, dtype=np.int64)
+    segment_length_ls = list()
+    for batch_idx in range(args.batch_size):
+        # NOTE: 실제 pack처럼 끝에 약간의 padding이 남도록 segment 길이를 뽑음.
+        cut_ls = np.sort(rng.choice(np.arange(1, args.packing_max_seq_len), args.packing_max_elem - 1, replace=False))
+        feat_split_idx = np.diff(np.concatenate([[0], cut_ls, [args.packing_max_seq_len]]))
+        feat_split_idx[-1] = max(1, feat_split_idx[-1] // 2)
+        segment_ids[batch_idx, : feat_split_idx.sum()] = np.repeat(np.arange(len(feat_split_idx)), feat_split_idx)
+        segment_length_ls.append(feat_split_idx)
+
+    segment_ids = torch.tensor(segment_ids, device=args.device)
+    cu_seqlens = np.concatenate([[0], np.cumsum(np.concatenate(segment_length_ls))])
+    cu_seqlens = torch.tensor(cu_seqlens, dtype=torch.int32, device=args.device)
+    hidden_states = torch.randn(
+        (args.batch_size, args.packing_max_seq_len, args.hidden_size),
+        device=args.device,
+        dtype=getattr(torch, args.dtype),
+    )
+    return hidden_states, segment_ids, cu_seqlens
+
+
+def main(args: PackedAttentionBenchmarkArguments) -> None:
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    hidden_states, segment_ids, cu_seqlens = get_packed_inputs(args, rng)
+    feat_attention_mask = get_block_diagonal_attention_mask(segment_ids)
+    valid_mask = segment_ids >= 0
+
+    config = Wav2Vec2Config(hidden_size=args.hidden_size, num_attention_heads=args.num_attention_heads)
+    attention = PackedWav2Vec2Attention(
+        embed_dim=config.hidden_size,
+        num_heads=config.num_attention_heads,
+        dropout=0.0,
+        config=config,
+    )
+    attention = attention.to(device=args.device, dtype=hidden_states.dtype).eval()
+
+    reference_output = None
+    print(f"{'backend':<20}{'ms/call':>12}{'max_abs_diff':>16}")
+    for attn_implementation in ["eager", "sdpa", "flash_attention_2"]:
+        config._attn_implementation = attn_implementation
+
+        def attention_call():
+            return attention(
+                hidden_states,
+                attention_mask=feat_attention_mask,
+                segment_ids=segment_ids,
+                cu_seqlens=cu_seqlens,
+            )[0]
+
+        with torch.no_grad():
+            output = attention_call()
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            for _ in range(args.num_iterations):
+                attention_call()
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            wall_time = time.perf_counter() - start_time
+
+        # padding frame의 출력은 backend 마다 다르고 loss에도 쓰이지 않으므로 유효한 frame만 비교 함.
+        output = output[valid_mask].float()
+        reference_output = output if reference_output is None else reference_output
+        max_abs_diff = (output - reference_output).abs().max().item()
+        print(f"{attn_implementation:<20}{wall_time / args.num_iterations * 1000:>12.3f}{max_abs_diff:>16.2e}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([PackedAttentionBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
@@ -0,0 +1,114 @@
+"""
+packing 알고리즘 별로 padding이 얼마나 남는지 비교하는 benchmark.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.packing_benchmark --num_samples=1000000
+    python -m benchmark.packing_benchmark --dataset_path=/root/.cache/train_dataset --model_name_or_path=/root/init_model
+
+dataset_path는 save_to_disk로 저장된, length column(음성 sample 수)을 가진 dataset이어야 함.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+from datasets import load_from_disk
+
+from transformers import HfArgumentParser, Wav2Vec2Config
+from utils import PackingStrategyType, get_feat_extract_output_lengths, get_packing_strategy_function
+
+
+@dataclass
+class PackingBenchmarkArguments:
+    num_samples: int = field(
+        default=1_000_000,
+        metadata={"help": "Number of feature lengths to draw for each synthetic distribution."},
+    )
+    packing_max_seq_len: int = field(
+        default=512,
+        metadata={"help": ""},
+    )
+    packing_max_elem: int = field(
+        default=10,
+        metadata={"help": ""},
+    )
+    dataset_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path to a dataset saved with save_to_disk to benchmark a real length distribution."},
+    )
+    length_column_name: str = field(
+        default="length",
+        metadata={"help": ""},
+    )
+    model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Config used to turn sample lengths into feature lengths. Defaults to Wav2Vec2Config()."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def get_synthetic_length_distributions(num_samples: int, max_seq_len: int, seed: int) -> Dict[str, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    # NOTE: 발화 길이는 보통 log-normal에 가까움. 짧은 발화가 많은 경우와 섞인 경우도 같이 봄.
+    lognormal = rng.lognormal(mean=np.log(max_seq_len / 3), sigma=0.6, size=num_samples)
+    short = rng.lognormal(mean=np.log(max_seq_len / 10), sigma=0.5, size=num_samples)
+    bimodal = np.where(rng.random(num_samples) < 0.5, short, lognormal)
+    distributions = {
+        "uniform": rng.integers(1, max_seq_len + 1, size=num_samples),
+        "lognormal": lognormal,
+        "short_lognormal": short,
+        "bimodal": bimodal,
+    }
+    return {name: np.clip(lengths, 1, max_seq_len).astype(np.int64) for name, lengths in distributions.items()}
+
+
+def benchmark_packing(length_ls: np.ndarray, max_seq_len: int, max_seq_per_pack: int) -> List[Dict[str, float]]:
+    result_ls = list()
+    for strategy in PackingStrategyType:
+        packing_function = get_packing_strategy_function(strategy)
+
+        start_time = time.perf_counter()
+        strategies_per_length = packing_function(length_ls, max_seq_len, max_seq_per_pack)
+        wall_time = time.perf_counter() - start_time
+
+        pack_num = sum(count for strategies_ls in strategies_per_length.values() for count, _ in strategies_ls)
+        result_ls.append(
+            {
+                "strategy": strategy.value,
+                "pack_num": pack_num,
+                "fill_ratio": length_ls.sum() / (pack_num * max_seq_len),
+                "segments_per_pack": len(length_ls) / pack_num,
+                "wall_time": wall_time,
+            }
+        )
+    return result_ls
+
+
+def main(args: PackingBenchmarkArguments) -> None:
+    distributions = get_synthetic_length_distributions(args.num_samples, args.packing_max_seq_len, args.seed)
+
+    if args.dataset_path:
+        config = (
+            Wav2Vec2Config.from_pretrained(args.model_name_or_path) if args.model_name_or_path else Wav2Vec2Config()
+        )
+        length_ls = load_from_disk(args.dataset_path)[args.length_column_name]
+        feat_length_ls = np.array([get_feat_extract_output_lengths(length, config) for length in length_ls])
+        distributions["real"] = feat_length_ls[(0 < feat_length_ls) & (feat_length_ls <= args.packing_max_seq_len)]
+
+    print(f"{'distribution':<16}{'strategy':<24}{'packs':>12}{'fill':>10}{'seg/pack':>10}{'time(s)':>10}")
+    for name, length_ls in distributions.items():
+        for result in benchmark_packing(length_ls, args.packing_max_seq_len, args.packing_max_elem):
+            print(
+                f"{name:<16}{result['strategy']:<24}{result['pack_num']:>12}{result['fill_ratio']:>10.4f}"
+                f"{result['segments_per_pack']:>10.2f}{result['wall_time']:>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([PackingBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
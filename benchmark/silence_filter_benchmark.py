@@ -0,0 +1,103 @@
+"""
+preprocessor의 silence filter를 utterance 별 `librosa_silence_filter` loop와 `batched_silence_filter`로 비교하는 benchmark.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.silence_filter_benchmark --batch_size=1000 --max_audio_seconds=15
+
+시간을 재기 전에 모든 utterance에서 `get_non_silent_intervals`와 `librosa.effects.split`의 구간이 같은지 먼저 확인 함.
+intervals는 `return_intervals=True`로 waveform을 자르지 않고 구간만 구하는 시간.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import List
+
+import librosa
+import numpy as np
+
+from transformers import HfArgumentParser
+from utils import batched_silence_filter, get_non_silent_intervals, librosa_silence_filter
+
+
+@dataclass
+class SilenceFilterBenchmarkArguments:
+    batch_size: int = field(
+        default=1000,
+        metadata={"help": "Number of utterances in one preprocessing map batch."},
+    )
+    min_audio_seconds: float = field(
+        default=1.0,
+        metadata={"help": ""},
+    )
+    max_audio_seconds: float = field(
+        default=15.0,
+        metadata={"help": ""},
+    )
+    filter_decibel: int = field(
+        default=30,
+        metadata={"help": ""},
+    )
+    sampling_rate: int = field(
+        default=16000,
+        metadata={"help": ""},
+    )
+    num_iterations: int = field(
+        default=3,
+        metadata={"help": "Number of batches to time for each implementation."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def get_audio(args: SilenceFilterBenchmarkArguments, rng: np.random.Generator) -> np.ndarray:
+    # NOTE: 작은 noise floor 위에 크기가 다른 발화 구간과 무음 구간을 번갈아 넣어서 실제 음성과 비슷하게 만듦.
+    audio_length = int(rng.uniform(args.min_audio_seconds, args.max_audio_seconds) * args.sampling_rate)
+    audio = rng.normal(0, 1e-3, audio_length).astype(np.float32)
+
+    start = int(rng.integers(0, args.sampling_rate))
+    while start < audio_length:
+        end = min(start + int(rng.integers(args.sampling_rate // 10, args.sampling_rate * 2)), audio_length)
+        voice = rng.normal(0, rng.uniform(0.05, 0.5), end - start) * np.hanning(end - start)
+        audio[start:end] += voice.astype(np.float32)
+        start = end + int(rng.integers(args.sampling_rate // 20, args.sampling_rate))
+    return audio
+
+
+def check_parity(audio_ls: List[np.ndarray], args: SilenceFilterBenchmarkArguments) -> int:
+    interval_ls = get_non_silent_intervals(audio_ls, top_db=args.filter_decibel)
+    mismatch_num = 0
+    for audio, intervals in zip(audio_ls, interval_ls):
+        mismatch_num += not np.array_equal(librosa.effects.split(audio, top_db=args.filter_decibel), intervals)
+    return mismatch_num
+
+
+def main(args: SilenceFilterBenchmarkArguments) -> None:
+    rng = np.random.default_rng(args.seed)
+    audio_ls_ls = [[get_audio(args, rng) for _ in range(args.batch_size)] for _ in range(args.num_iterations)]
+    audio_seconds = sum(len(audio) for audio_ls in audio_ls_ls for audio in audio_ls) / args.sampling_rate
+
+    mismatch_num = sum(check_parity(audio_ls, args) for audio_ls in audio_ls_ls)
+    print(f"librosa parity: {mismatch_num} / {args.batch_size * args.num_iterations} utterances differ")
+
+    method_ls = [
+        ("librosa", lambda audio_ls: [librosa_silence_filter(audio, args.filter_decibel) for audio in audio_ls]),
+        ("batched", lambda audio_ls: batched_silence_filter(audio_ls, args.filter_decibel)),
+        ("intervals", lambda audio_ls: batched_silence_filter(audio_ls, args.filter_decibel, return_intervals=True)),
+    ]
+
+    print(f"{'method':<12}{'ms/batch':>12}{'audio sec/sec':>16}")
+    for name, filter_function in method_ls:
+        start_time = time.perf_counter()
+        for audio_ls in audio_ls_ls:
+            filter_function(audio_ls)
+        wall_time = time.perf_counter() - start_time
+
+        print(f"{name:<12}{wall_time / args.num_iterations * 1000:>12.1f}{audio_seconds / wall_time:>16.0f}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([SilenceFilterBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
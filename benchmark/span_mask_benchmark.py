@@ -0,0 +1,108 @@
+"""
+PackingCollator의 span mask 생성을 segment 별 `_compute_mask_indices` loop와 batched 구현으로 비교하는 micro-benchmark.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.span_mask_benchmark --batch_size=32 --packing_max_elem=10
+"""
+
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from data.collator import _compute_segment_mask_indices
+from transformers import HfArgumentParser
+from transformers.models.wav2vec2.modeling_wav2vec2 import _compute_mask_indices
+
+
+@dataclass
+class SpanMaskBenchmarkArguments:
+    batch_size: int = field(
+        default=32,
+        metadata={"help": "Number of packs in one collated batch."},
+    )
+    packing_max_seq_len: int = field(
+        default=512,
+        metadata={"help": ""},
+    )
+    packing_max_elem: int = field(
+        default=10,
+        metadata={"help": ""},
+    )
+    mask_time_prob: float = field(
+        default=0.65,
+        metadata={"help": ""},
+    )
+    mask_time_length: int = field(
+        default=10,
+        metadata={"help": ""},
+    )
+    mask_time_min_masks: int = field(
+        default=0,
+        metadata={"help": ""},
+    )
+    num_iterations: int = field(
+        default=200,
+        metadata={"help": "Number of batches to time for each implementation."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def get_segment_lengths(args: SpanMaskBenchmarkArguments, rng: np.random.Generator) -> np.ndarray:
+    # NOTE: pack 하나를 packing_max_elem 개의 segment로 균등하게 나눈 뒤 길이를 흔들어서 실제 pack과 비슷하게 만듦.
+    mean_length = args.packing_max_seq_len // args.packing_max_elem
+    segment_lengths = rng.integers(
+        max(args.mask_time_length, mean_length // 2),
+        mean_length + 1,
+        size=args.batch_size * args.packing_max_elem,
+    )
+    return segment_lengths
+
+
+def loop_span_mask(segment_lengths: np.ndarray, args: SpanMaskBenchmarkArguments) -> np.ndarray:
+    mask_time_indices_ls = list()
+    for feat_len in segment_lengths:
+        mask_time_indices = _compute_mask_indices(
+            (1, int(feat_len)),
+            args.mask_time_prob,
+            args.mask_time_length,
+            min_masks=args.mask_time_min_masks,
+        )
+        mask_time_indices_ls.append(mask_time_indices[0])
+    return np.concatenate(mask_time_indices_ls)
+
+
+def batched_span_mask(segment_lengths: np.ndarray, args: SpanMaskBenchmarkArguments) -> np.ndarray:
+    return _compute_segment_mask_indices(
+        segment_lengths,
+        args.mask_time_prob,
+        args.mask_time_length,
+        min_masks=args.mask_time_min_masks,
+    )
+
+
+def main(args: SpanMaskBenchmarkArguments) -> None:
+    rng = np.random.default_rng(args.seed)
+    np.random.seed(args.seed)
+    segment_lengths_ls = [get_segment_lengths(args, rng) for _ in range(args.num_iterations)]
+
+    print(f"{'method':<12}{'ms/batch':>12}{'masked':>10}")
+    for name, mask_function in [("loop", loop_span_mask), ("batched", batched_span_mask)]:
+        masked_num, frame_num = 0, 0
+        start_time = time.perf_counter()
+        for segment_lengths in segment_lengths_ls:
+            mask_time_indices = mask_function(segment_lengths, args)
+            masked_num += mask_time_indices.sum()
+            frame_num += len(mask_time_indices)
+        wall_time = time.perf_counter() - start_time
+
+        print(f"{name:<12}{wall_time / args.num_iterations * 1000:>12.3f}{masked_num / frame_num:>10.4f}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([SpanMaskBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
@@ -0,0 +1,160 @@
+"""
+PretrainingProfilerCallback을 붙여서 작은 Wav2Vec2ForPreTraining을 CPU에서 몇 step 돌리고,
+`step_timing.jsonl`이 step 마다 기록되는지와 구간 시간의 합이 `step_ms`와 같은지 확인하는 benchmark.
+repo root에서 다음과 같이 실행 함.
+
+    python -m benchmark.step_timing_benchmark
+    python -m benchmark.step_timing_benchmark --max_steps=10 --gradient_accumulation_steps=2
+
+구간 시간은 jsonl에 소수점 3자리(ms)로 반올림 되어 기록되므로 합은 반올림 오차(`tolerance_ms`)까지 허용 함.
+"""
+
+import json
+import os
+import tempfile
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+from datasets import Dataset
+
+from data import DataCollatorForWav2Vec2Pretraining
+from transformers import HfArgumentParser, Wav2Vec2Config, Wav2Vec2FeatureExtractor, Wav2Vec2ForPreTraining
+from utils import PretrainingProfilerCallback, Wav2Vec2PretrainingArguments
+from utils.profiling import PROFILE_PHASES
+from wav2vec2_pretrainer import Wav2Vec2Pretrainer
+
+
+TINY_CONFIG_KWARGS = dict(
+    hidden_size=32,
+    num_hidden_layers=2,
+    num_attention_heads=2,
+    intermediate_size=37,
+    conv_dim=(16, 16, 16),
+    conv_stride=(5, 2, 2),
+    conv_kernel=(10, 3, 3),
+    num_conv_pos_embeddings=16,
+    num_conv_pos_embedding_groups=2,
+    codevector_dim=16,
+    proj_codevector_dim=16,
+    num_codevectors_per_group=10,
+    num_codevector_groups=2,
+    num_negatives=5,
+    do_stable_layer_norm=True,
+    feat_extract_norm="layer",
+    mask_time_prob=0.3,
+    mask_time_length=2,
+    mask_time_min_masks=2,
+)
+
+
+@dataclass
+class StepTimingBenchmarkArguments:
+    max_steps: int = field(
+        default=4,
+        metadata={"help": "Number of optimizer steps to run."},
+    )
+    batch_size: int = field(
+        default=2,
+        metadata={"help": "Number of utterances in one micro batch."},
+    )
+    gradient_accumulation_steps: int = field(
+        default=1,
+        metadata={"help": ""},
+    )
+    sample_mask_on_device: bool = field(
+        default=False,
+        metadata={"help": "Sample mask_time_indices and negatives in the trainer instead of the collator."},
+    )
+    min_length: int = field(
+        default=800,
+        metadata={"help": "Minimum number of audio samples in a synthetic utterance."},
+    )
+    max_length: int = field(
+        default=2400,
+        metadata={"help": "Maximum number of audio samples in a synthetic utterance."},
+    )
+    tolerance_ms: float = field(
+        default=0.01,
+        metadata={"help": "Allowed difference between the sum of the phases and step_ms."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": ""},
+    )
+
+
+def main(args: StepTimingBenchmarkArguments) -> None:
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    config = Wav2Vec2Config(**TINY_CONFIG_KWARGS)
+    model = Wav2Vec2ForPreTraining(config)
+    feature_extractor = Wav2Vec2FeatureExtractor(return_attention_mask=True)
+
+    num_utterances = args.max_steps * args.batch_size * args.gradient_accumulation_steps
+    input_values_ls = [
+        rng.standard_normal(int(rng.integers(args.min_length, args.max_length))).astype(np.float32)
+        for _ in range(num_utterances)
+    ]
+    train_dataset = Dataset.from_dict({"input_values": input_values_ls}).with_format("pt")
+
+    collator = DataCollatorForWav2Vec2Pretraining(
+        model=model,
+        feature_extractor=feature_extractor,
+        mask_time_prob=config.mask_time_prob,
+        mask_time_length=config.mask_time_length,
+        mask_time_min_masks=config.mask_time_min_masks,
+        num_negatives=config.num_negatives,
+        sample_mask_on_device=args.sample_mask_on_device,
+    )
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        train_args = Wav2Vec2PretrainingArguments(
+            output_dir=output_dir,
+            use_cpu=True,
+            report_to="none",
+            save_strategy="no",
+            logging_steps=1,
+            disable_tqdm=True,
+            max_steps=args.max_steps,
+            per_device_train_batch_size=args.batch_size,
+            gradient_accumulation_steps=args.gradient_accumulation_steps,
+            seed=args.seed,
+        )
+        trainer = Wav2Vec2Pretrainer(
+            model=model,
+            args=train_args,
+            train_dataset=train_dataset,
+            data_collator=collator,
+            callbacks=[PretrainingProfilerCallback()],
+        )
+        trainer.train()
+
+        step_timing_path = os.path.join(output_dir, "step_timing.jsonl")
+        assert os.path.exists(step_timing_path), f"{step_timing_path}가 만들어지지 않음."
+        with open(step_timing_path) as f:
+            record_ls = [json.loads(line) for line in f]
+
+    assert [x["step"] for x in record_ls] == list(range(1, args.max_steps + 1)), "step 마다 기록이 하나씩 있어야 함."
+
+    print(f"{'step':>6}{'step_ms':>12}{'phase_sum_ms':>14}{'diff_ms':>10}")
+    for record in record_ls:
+        phase_sum = sum(record[f"{phase}_ms"] for phase in PROFILE_PHASES)
+        diff = abs(phase_sum - record["step_ms"])
+        print(f"{record['step']:>6}{record['step_ms']:>12.3f}{phase_sum:>14.3f}{diff:>10.3f}")
+        assert diff <= args.tolerance_ms, (
+            f"step {record['step']}: 구간 합 {phase_sum}ms != step_ms {record['step_ms']}ms"
+        )
+        assert record["audio_samples"] > 0 and record["feature_frames"] > 0, "batch 처리량이 기록되지 않음."
+
+    print()
+    print(f"{'phase':<20}{'mean(ms)':>10}")
+    for phase in PROFILE_PHASES:
+        print(f"{phase:<20}{np.mean([x[f'{phase}_ms'] for x in record_ls]):>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser([StepTimingBenchmarkArguments])
+    args, remain_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+    main(args)
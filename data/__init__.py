@@ -1,2 +1,3 @@
 from .augmentations import HFAddBackgroundNoise
 from .collator import DataCollatorCTCWithPadding, DataCollatorForWav2Vec2Pretraining, PackingCollator
+from .packed_dataset import PackedDatasetView
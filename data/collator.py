@@ -10,11 +10,109 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
     _compute_mask_indices,
     _sample_negative_indices,
 )
+from utils import restore_input_values
+
+
+def _get_input_values(feature: dict) -> Union[np.ndarray, torch.Tensor]:
+    # NOTE: int16/float16로 저장된 feature는 mean/std가 같이 있고, 여기서 float32로 되돌려서 normalize 함.
+    if "input_values_std" not in feature:
+        return feature["input_values"]
+    return restore_input_values(feature["input_values"], feature["input_values_mean"], feature["input_values_std"])
+
+
+def _compute_segment_mask_indices(
+    segment_lengths: np.ndarray,
+    mask_prob: float,
+    mask_length: int,
+    min_masks: int = 0,
+) -> np.ndarray:
+    """
+    packing된 segment 들의 길이를 1차원으로 받아서, 각 segment에 `_compute_mask_indices((1, length), ...)`를 따로 호출한 것과
+    같은 분포의 span mask를 한 번에 만듦. 반환 값은 segment 들을 순서대로 이어 붙인 `(sum(segment_lengths),)` bool 배열.
+    span 개수를 정하는 규칙(`mask_prob`, `mask_length`, `min_masks`, segment 별 probabilistic rounding)과 span 시작점을 중복 없이
+    균등하게 뽑는 것도 동일 함. 단, `mask_length`보다 짧은 segment는 에러 대신 mask 하지 않음.
+    """
+    if mask_length < 1:
+        raise ValueError("`mask_length` has to be bigger than 0.")
+
+    segment_lengths = np.asarray(segment_lengths, dtype=np.int64)
+    mask_time_indices = np.zeros(segment_lengths.sum(), dtype=bool)
+
+    # epsilon is used for probabilistic rounding, 원래 구현처럼 segment 마다 따로 뽑음.
+    epsilon = np.random.random(len(segment_lengths))
+    num_masked_span = (mask_prob * segment_lengths / mask_length + epsilon).astype(np.int64)
+    num_masked_span = np.maximum(num_masked_span, min_masks)
+    num_masked_span = np.where(
+        num_masked_span * mask_length > segment_lengths, segment_lengths // mask_length, num_masked_span
+    )
+    num_span_start = np.maximum(segment_lengths - (mask_length - 1), 0)
+    num_masked_span = np.minimum(num_masked_span, num_span_start)
+    if not num_masked_span.any():
+        return mask_time_indices
+
+    # NOTE: 모든 segment의 span 시작 후보를 이어 붙이고 (segment, 난수) 순으로 정렬하면 segment 안에서는 무작위 순서가 됨.
+    #       segment 마다 앞에서 num_masked_span 개를 고르면 replace=False인 np.random.choice와 같음.
+    candidate_segment = np.repeat(np.arange(len(segment_lengths)), num_span_start)
+    candidate_offset = np.repeat(np.cumsum(num_span_start) - num_span_start, num_span_start)
+    candidate_order = np.argsort(candidate_segment + np.random.random(len(candidate_segment)))
+    candidate_rank = np.arange(len(candidate_segment)) - candidate_offset
+    is_selected = candidate_rank < num_masked_span[candidate_segment]
+
+    segment_offset = np.cumsum(segment_lengths) - segment_lengths
+    span_start = (candidate_order - candidate_offset)[is_selected] + segment_offset[candidate_segment[is_selected]]
+    mask_time_indices[(span_start[:, None] + np.arange(mask_length)).reshape(-1)] = True
+    return mask_time_indices
+
+
+def _sample_segment_negative_indices(
+    mask_time_indices: np.ndarray,
+    segment_ids: np.ndarray,
+    num_negatives: int,
+) -> np.ndarray:
+    """
+    packing된 batch에서 negative를 같은 발화(segment)의 mask된 frame 중에서만 뽑음.
+    `_sample_negative_indices`와 같이 자기 자신은 제외한 채 균등하게 뽑고, 반환 값도 `batch_idx * sequence_length`가 더해진
+    flat index `(batch_size, sequence_length, num_negatives)`임. 모든 segment를 한 번의 numpy 연산으로 처리 함.
+    """
+    batch_size, sequence_length = mask_time_indices.shape
+    sampled_negative_indices = np.broadcast_to(
+        (np.arange(batch_size) * sequence_length)[:, None, None], (batch_size, sequence_length, num_negatives)
+    ).astype(np.int32)
+
+    masked_positions = np.flatnonzero(mask_time_indices)
+    if not len(masked_positions):
+        return sampled_negative_indices
+
+    # mask된 frame을 flat 순서로 나열하면 같은 segment끼리 붙어 있으므로, segment의 시작 위치와 frame 수만 알면 됨.
+    segment_keys = (masked_positions // sequence_length) * sequence_length + segment_ids.reshape(-1)[masked_positions]
+    is_segment_start = np.ones(len(masked_positions), dtype=bool)
+    is_segment_start[1:] = segment_keys[1:] != segment_keys[:-1]
+    segment_start = np.flatnonzero(is_segment_start)
+    segment_count = np.diff(np.append(segment_start, len(masked_positions)))
+
+    segment_idx = np.cumsum(is_segment_start) - 1
+    frame_start, frame_count = segment_start[segment_idx], segment_count[segment_idx]
+    frame_rank = np.arange(len(masked_positions)) - frame_start
+
+    # avoid sampling the same positive vector, but keep the distribution uniform
+    # NOTE: high가 frame마다 달라서 randint 대신 [0, 1) 난수에 high를 곱해서 내림 함. 이게 훨씬 빠름.
+    high = np.maximum(frame_count - 1, 1)[:, None]
+    sampled_indices = (np.random.random((len(masked_positions), num_negatives)) * high).astype(np.int64)
+    sampled_indices[sampled_indices >= frame_rank[:, None]] += 1
+    # NOTE: segment에 mask된 frame이 하나뿐이면 뽑을 negative가 없어서 자기 자신을 넣음. model에서 neg_is_pos로 걸러짐.
+    sampled_indices = np.where(frame_count[:, None] > 1, sampled_indices, frame_rank[:, None])
+
+    sampled_negative_indices.reshape(-1, num_negatives)[masked_positions] = masked_positions[
+        frame_start[:, None] + sampled_indices
+    ]
+    return sampled_negative_indices
 
 
 @dataclass
 class PackingCollator(DataCollatorMixin):
     pack_max_seq: int = 512
+    # NOTE: pack_max_seq와 같이 feature frame 단위. DataCollatorForWav2Vec2Pretraining의 pad_to_multiple_of는 audio sample 단위임.
+    pad_to_multiple_of: Optional[int] = None
     mask_time_prob: float = 0.65
     mask_time_length: int = 10
     mask_time_min_masks: int = 0
@@ -23,55 +121,63 @@ class PackingCollator(DataCollatorMixin):
 
     def torch_call(self, features):
         input_values_ls = list()
-        feat_attention_mask_ls = list()
         split_indices_ls = list()
         feat_split_indices_ls = list()
-        mask_time_indices_ls = list()
-        sampled_negative_indices_ls = list()
-
-        for feature in features:
-            input_values_ls.append(feature["input_values"])
-
-            start_idx = 0
-            expand_attention_mask = np.zeros((1, 1, self.pack_max_seq, self.pack_max_seq))
-            mask_time_indices = np.zeros((1, self.pack_max_seq))
-            sampled_negative_indices = np.zeros((1, self.pack_max_seq, self.num_negatives))
-            for feat_len in feature["feat_split_idx"]:
-                end_idx = start_idx + feat_len
-                test = _compute_mask_indices(
-                    (1, int(feat_len)),
-                    self.mask_time_prob,
-                    self.mask_time_length,
-                    min_masks=self.mask_time_min_masks,
-                )
-                mask_time_indices[0, start_idx:end_idx] = test
-                # sampled_negative_indices[0, start_idx:end_idx, :] = _sample_negative_indices(
-                #     (1, int(feat_len)),
-                #     self.num_negatives,
-                #     mask_time_indices=test.astype(bool),
-                # )
-                expand_attention_mask[0, 0, start_idx:end_idx, start_idx:end_idx] = 1
-                start_idx += int(feat_len)
-
-            feat_attention_mask_ls.append(expand_attention_mask)
+
+        # NOTE: 항상 pack_max_seq로 padding하지 않고 batch에서 가장 긴 pack에 맞춤. 짧은 pack만 모인 batch는 encoder 연산이 줄어듦.
+        pack_length_ls = [int(sum(feature["feat_split_idx"])) for feature in features]
+        sequence_length = max(pack_length_ls)
+        if self.pad_to_multiple_of:
+            sequence_length = -(-sequence_length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        sequence_length = min(sequence_length, self.pack_max_seq)
+
+        # NOTE: dense한 (B, 1, S, S) mask 대신 frame 별 segment 번호만 넘기고, mask는 model에서 device 위에서 만듦.
+        #       padding frame은 -1
+        segment_ids = np.full((len(features), sequence_length), -1, dtype=np.int64)
+        segment_length_ls = list()
+        for batch_idx, feature in enumerate(features):
+            input_values = feature["input_values"]
+            if "input_values_std" in feature:
+                input_values = [
+                    restore_input_values(*stored_values)
+                    for stored_values in zip(input_values, feature["input_values_mean"], feature["input_values_std"])
+                ]
+            input_values_ls.append(input_values)
+
+            feat_split_idx = np.asarray(feature["feat_split_idx"], dtype=np.int64)
+            segment_ids[batch_idx, : feat_split_idx.sum()] = np.repeat(np.arange(len(feat_split_idx)), feat_split_idx)
+            segment_length_ls.append(feat_split_idx)
+
             feat_split_indices_ls.append(feature["feat_split_idx"])
             split_indices_ls.append(feature["split_idx"])
-            mask_time_indices_ls.append(mask_time_indices)
-            # sampled_negative_indices_ls.append(sampled_negative_indices)
-        mask_time_indices = np.concatenate(mask_time_indices_ls)
-        sampled_negative_indices_ls = _sample_negative_indices(
-            mask_time_indices.shape,
+
+        segment_lengths = np.concatenate(segment_length_ls)
+        # NOTE: segment 마다 _compute_mask_indices를 부르지 않고 batch 안의 모든 segment를 한 번에 mask 함.
+        #       padding이 아닌 frame은 각 row의 앞쪽에 segment 순서대로 있으므로 row-major 순서로 그대로 채워 넣으면 됨.
+        mask_time_indices = np.zeros((len(features), sequence_length), dtype=bool)
+        mask_time_indices[segment_ids >= 0] = _compute_segment_mask_indices(
+            segment_lengths,
+            self.mask_time_prob,
+            self.mask_time_length,
+            min_masks=self.mask_time_min_masks,
+        )
+        # NOTE: 발화 경계를 넘거나 padding에서 negative를 뽑지 않도록 segment 안에서만 뽑음.
+        sampled_negative_indices = _sample_segment_negative_indices(
+            mask_time_indices,
+            segment_ids,
             self.num_negatives,
-            mask_time_indices=mask_time_indices.astype(bool),
         )
 
         batch = dict()
         batch["input_values"] = input_values_ls
-        batch["feat_attention_mask"] = torch.tensor(np.concatenate(feat_attention_mask_ls))
+        batch["segment_ids"] = torch.tensor(segment_ids)
+        # padding을 뺀 frame을 batch 순서대로 이어 붙였을 때 각 segment의 경계, varlen attention kernel에서 사용 함.
+        cu_seqlens = np.concatenate([[0], np.cumsum(segment_lengths)])
+        batch["cu_seqlens"] = torch.tensor(cu_seqlens, dtype=torch.int32)
         batch["split_idx"] = split_indices_ls
         batch["feat_split_idx"] = feat_split_indices_ls
         batch["mask_time_indices"] = torch.tensor(mask_time_indices)
-        batch["sampled_negative_indices"] = torch.tensor(sampled_negative_indices_ls)
+        batch["sampled_negative_indices"] = torch.tensor(sampled_negative_indices)
 
         return batch
 
@@ -111,6 +217,9 @@ class DataCollatorForWav2Vec2Pretraining(DataCollatorMixin):
         mask_time_length (:obj:`int`, `optional`, defaults to :obj:`10`):
             Length of each vector mask span to mask along the time axis in the contrastive task. The default value
             originates from the original wav2vec 2.0 article and corresponds to the ``M`` variable mentioned there.
+        sample_mask_on_device (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            If set, ``mask_time_indices`` and ``sampled_negative_indices`` are not computed here. ``Wav2Vec2Pretrainer``
+            samples them with torch on the model device instead.
     """
 
     model: Wav2Vec2ForPreTraining
@@ -121,11 +230,12 @@ class DataCollatorForWav2Vec2Pretraining(DataCollatorMixin):
     mask_time_length: Optional[int] = 10
     mask_time_min_masks: int = 0
     num_negatives: int = 100
+    sample_mask_on_device: bool = False
     return_tensors: str = "pt"
 
     def torch_call(self, features):
         # features가 2차원 리스트로 들어올 떄 feature_extractor에서 padding을 진행하지 못함. 따라서 이걸 1차원 리스트로 변경 함.
-        features = [{"input_values": x["input_values"]} for x in features]
+        features = [{"input_values": _get_input_values(x)} for x in features]
 
         # reformat list to dict and set to pytorch format
         batch = self.feature_extractor.pad(
@@ -149,6 +259,10 @@ class DataCollatorForWav2Vec2Pretraining(DataCollatorMixin):
                 batch.attention_mask,
             )
 
+        if self.sample_mask_on_device:
+            # NOTE: mask와 negative는 trainer가 model device에서 step 별 seed로 뽑음.
+            return batch.to(self.model.dtype)
+
         features_shape = (batch_size, mask_indices_seq_length)
 
         # sample randomly masked indices
@@ -183,7 +297,7 @@ class DataCollatorCTCWithPadding(DataCollatorMixin):
     return_tensors: str = "pt"
 
     def torch_call(self, features):
-        input_features = [{"input_values": feature["input_values"]} for feature in features]
+        input_features = [{"input_values": _get_input_values(feature)} for feature in features]
         label_features = [{"input_ids": feature["labels"]} for feature in features]
 
         batch = self.processor.pad(
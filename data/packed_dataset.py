@@ -0,0 +1,59 @@
+from typing import Any, Dict
+
+import numpy as np
+import pyarrow as pa
+import torch
+from datasets import Dataset
+from torch.utils.data import Dataset as TorchDataset
+
+
+class PackedDatasetView(TorchDataset):
+    """
+    packing index(`packing_ls`, `feat_length_ls`)만 들고 있다가 __getitem__에서 원본 dataset의 row를 가져오는 lazy view.
+    packing된 음성을 arrow로 다시 쓰지 않기 때문에 디스크를 두 배로 쓰지 않음.
+    각 pack은 원본 memory-mapped arrow table에서 한 번의 batched take로 가져오며, 반환 형식은 PackingCollator가 받는 것과 동일 함.
+
+    Args:
+        dataset (`Dataset`):
+            `input_values`와 length column을 가진 원본 dataset. pt format이 적용되어 있어야 함.
+        packing_idx_dataset (`Dataset`):
+            `get_packing_dataset_idx`로 만든 packing index dataset.
+        length_column_name (`str`, *optional*, defaults to `"length"`):
+            원본 dataset에서 음성 길이가 들어 있는 column 이름.
+    """
+
+    def __init__(self, dataset: Dataset, packing_idx_dataset: Dataset, length_column_name: str = "length") -> None:
+        self.dataset = dataset
+        self.length_column_name = length_column_name
+
+        # NOTE: pack마다 arrow에 접근하지 않도록 list column을 offsets/values numpy 배열로 풀어 둠.
+        #       select 등으로 indices mapping이 걸려 있을 수 있어서 arrow format으로 한 번 꺼내서 씀.
+        packing_table = packing_idx_dataset.with_format("arrow")[:]
+        packing_ls = pa.concat_arrays(packing_table.column("packing_ls").chunks)
+        feat_length_ls = pa.concat_arrays(packing_table.column("feat_length_ls").chunks)
+
+        self.offsets = packing_ls.offsets.to_numpy() - packing_ls.offsets[0].as_py()
+        self.packing_values = packing_ls.flatten().to_numpy()
+        self.feat_length_values = feat_length_ls.flatten().to_numpy()
+        # pack 별 feature frame 수, pack 길이로 batch를 묶는 sampler에서 사용 함.
+        self.pack_lengths = np.add.reduceat(self.feat_length_values, self.offsets[:-1]) if len(self) else np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        start_idx, end_idx = self.offsets[idx], self.offsets[idx + 1]
+        rows = self.dataset[self.packing_values[start_idx:end_idx].tolist()]
+
+        split_idx = torch.as_tensor(rows[self.length_column_name])
+        pack = {
+            "input_values": rows["input_values"],
+            "split_idx": split_idx,
+            self.length_column_name: split_idx.sum(),
+            "feat_split_idx": torch.tensor(self.feat_length_values[start_idx:end_idx]),
+        }
+        # NOTE: int16/float16로 저장된 dataset이면 collator에서 normalize 할 수 있도록 mean/std도 같이 넘김.
+        if "input_values_std" in rows:
+            pack["input_values_mean"] = rows["input_values_mean"]
+            pack["input_values_std"] = rows["input_values_std"]
+        return pack
@@ -1 +1 @@
-from .modeling_packed_wav2vec2 import PackedWav2Vec2ForPreTraining
+from .modeling_packed_wav2vec2 import PackedWav2Vec2ForPreTraining, get_block_diagonal_attention_mask
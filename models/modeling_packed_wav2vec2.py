@@ -1,8 +1,11 @@
 import warnings
+from functools import partial
 from typing import List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.checkpoint import checkpoint
 
 from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled
 from transformers.integrations.fsdp import is_fsdp_managed_module
@@ -13,6 +16,7 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
     _EXPECTED_OUTPUT_SHAPE,
     WAV_2_VEC_2_INPUTS_DOCSTRING,
     Wav2Vec2Adapter,
+    Wav2Vec2Attention,
     Wav2Vec2BaseModelOutput,
     Wav2Vec2Config,
     Wav2Vec2EncoderLayer,
@@ -20,6 +24,7 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
     Wav2Vec2FeatureEncoder,
     Wav2Vec2FeatureProjection,
     Wav2Vec2ForPreTrainingOutput,
+    Wav2Vec2GroupNormConvLayer,
     Wav2Vec2GumbelVectorQuantizer,
     Wav2Vec2PositionalConvEmbedding,
     Wav2Vec2PreTrainedModel,
@@ -28,25 +33,507 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
 from transformers.utils import (
     add_code_sample_docstrings,
     add_start_docstrings_to_model_forward,
+    is_flash_attn_2_available,
     replace_return_docstrings,
 )
 
 
+if is_flash_attn_2_available():
+    from flash_attn import flash_attn_varlen_func
+
+
+def get_block_diagonal_attention_mask(segment_ids: torch.LongTensor) -> torch.BoolTensor:
+    """
+    collator가 넘겨준 `segment_ids` `(batch_size, sequence_length)`로 `(batch_size, 1, sequence_length, sequence_length)`
+    boolean block-diagonal mask를 만듦. 같은 segment에 속한 frame끼리만 True.
+    padding(-1)은 padding끼리 하나의 block이 되기 때문에 실제 frame과 섞이지 않고, 전부 mask된 row도 생기지 않음.
+    """
+    return segment_ids[:, None, :, None] == segment_ids[:, None, None, :]
+
+
+def _group_norm_conv_with_lengths(
+    conv_layer: Wav2Vec2GroupNormConvLayer,
+    hidden_states: torch.FloatTensor,
+    output_lengths: torch.LongTensor,
+) -> torch.FloatTensor:
+    """
+    padding된 batch에서도 segment 하나씩 넣은 것과 같은 결과가 나오도록, GroupNorm 통계를 각 row의 유효한 frame으로만 구함.
+    `Wav2Vec2GroupNormConvLayer`는 channel 마다 시간 축 전체로 정규화하기 때문에 그냥 padding하면 값이 달라짐.
+    """
+    hidden_states = conv_layer.conv(hidden_states)
+
+    layer_norm = conv_layer.layer_norm
+    valid_mask = torch.arange(hidden_states.shape[-1], device=hidden_states.device) < output_lengths[:, None]
+    valid_mask = valid_mask[:, None, :].to(hidden_states.dtype)
+    frame_num = output_lengths[:, None, None].to(hidden_states.dtype)
+
+    mean = (hidden_states * valid_mask).sum(-1, keepdim=True) / frame_num
+    variance = (((hidden_states - mean) * valid_mask) ** 2).sum(-1, keepdim=True) / frame_num
+    hidden_states = (hidden_states - mean) * torch.rsqrt(variance + layer_norm.eps)
+    hidden_states = hidden_states * layer_norm.weight[None, :, None] + layer_norm.bias[None, :, None]
+
+    hidden_states = conv_layer.activation(hidden_states)
+    return hidden_states
+
+
+class PackedWav2Vec2FeatureEncoder(Wav2Vec2FeatureEncoder):
+    """
+    길이가 다른 segment 들을 padding해서 한 번에 넣을 수 있는 feature encoder. parameter 구조는 `Wav2Vec2FeatureEncoder`와 동일 함.
+    conv에 padding이 없어서 유효한 frame은 padding을 보지 않으므로, `input_lengths`가 주어지면 GroupNorm만 길이를 고려해서 계산 함.
+    """
+
+    def forward(self, input_values, input_lengths: Optional[torch.LongTensor] = None):
+        hidden_states = input_values[:, None]
+
+        # make sure hidden_states require grad for gradient_checkpointing
+        if self._requires_grad and self.training:
+            hidden_states.requires_grad = True
+
+        for conv_layer in self.conv_layers:
+            layer_function = conv_layer.__call__
+            if input_lengths is not None:
+                input_lengths = (input_lengths - conv_layer.conv.kernel_size[0]) // conv_layer.conv.stride[0] + 1
+                if isinstance(conv_layer, Wav2Vec2GroupNormConvLayer):
+                    layer_function = partial(_group_norm_conv_with_lengths, conv_layer, output_lengths=input_lengths)
+
+            if self._requires_grad and self.gradient_checkpointing and self.training:
+                hidden_states = self._gradient_checkpointing_func(
+                    layer_function,
+                    hidden_states,
+                )
+            else:
+                hidden_states = layer_function(hidden_states)
+
+        return hidden_states
+
+
+class PackedWav2Vec2GumbelVectorQuantizer(Wav2Vec2GumbelVectorQuantizer):
+    """
+    packing된 `(batch_size, sequence_length, conv_dim[-1])` tensor 전체를 한 번에 quantize 하면서, perplexity는 원래처럼 segment
+    (발화) 마다 따로 구해서 더한 값을 반환 함. `segment_ids`가 없으면 `Wav2Vec2GumbelVectorQuantizer`와 동일하게 동작 함.
+    """
+
+    @staticmethod
+    def _compute_segment_perplexity(probs, segment_ids, mask=None):
+        # NOTE: row 마다 segment 번호가 0부터 다시 시작하므로 앞 row 들의 segment 수를 더해서 batch 전체에서 겹치지 않게 만듦.
+        segment_num_per_row = segment_ids.max(dim=-1).values + 1
+        segment_offsets = torch.cumsum(segment_num_per_row, 0) - segment_num_per_row
+        segment_idx = (segment_ids + segment_offsets[:, None]).flatten()
+
+        frame_mask = segment_ids.flatten() >= 0
+        if mask is not None:
+            frame_mask = frame_mask & mask.flatten()
+
+        segment_idx, probs = segment_idx[frame_mask], probs[frame_mask]
+        segment_num = int(segment_num_per_row.sum())
+        frame_num = torch.bincount(segment_idx, minlength=segment_num)
+        marginal_probs = probs.new_zeros((segment_num,) + probs.shape[1:]).index_add_(0, segment_idx, probs)
+        marginal_probs = marginal_probs / frame_num.clamp(min=1)[:, None, None]
+
+        perplexity = torch.exp(-torch.sum(marginal_probs * torch.log(marginal_probs + 1e-7), dim=-1)).sum(dim=-1)
+        # mask된 frame이 하나도 없는 segment는 marginal을 정의할 수 없어서 0/0(nan)이 됐음. 더하지 않음.
+        perplexity = torch.where(frame_num > 0, perplexity, torch.zeros_like(perplexity))
+        return perplexity.sum()
+
+    def forward(self, hidden_states, mask_time_indices=None, segment_ids=None, output_codevector_idx=False):
+        if segment_ids is None:
+            codevectors, perplexity = super().forward(hidden_states, mask_time_indices=mask_time_indices)
+            return (codevectors, perplexity, None) if output_codevector_idx else (codevectors, perplexity)
+
+        batch_size, sequence_length, hidden_size = hidden_states.shape
+
+        # project to codevector dim
+        hidden_states = self.weight_proj(hidden_states)
+        hidden_states = hidden_states.view(batch_size * sequence_length * self.num_groups, -1)
+
+        if self.training:
+            # sample code vector probs via gumbel in differentiateable way
+            codevector_probs = nn.functional.gumbel_softmax(
+                hidden_states.float(), tau=self.temperature, hard=True
+            ).type_as(hidden_states)
+
+            # compute perplexity
+            codevector_soft_dist = torch.softmax(
+                hidden_states.view(batch_size * sequence_length, self.num_groups, -1).float(), dim=-1
+            )
+            perplexity = self._compute_segment_perplexity(codevector_soft_dist, segment_ids, mask_time_indices)
+        else:
+            # take argmax in non-differentiable way
+            # comptute hard codevector distribution (one hot)
+            codevector_idx = hidden_states.argmax(dim=-1)
+            codevector_probs = hidden_states.new_zeros(hidden_states.shape).scatter_(
+                -1, codevector_idx.view(-1, 1), 1.0
+            )
+            codevector_probs = codevector_probs.view(batch_size * sequence_length, self.num_groups, -1)
+
+            perplexity = self._compute_segment_perplexity(codevector_probs, segment_ids, mask_time_indices)
+
+        codevector_probs = codevector_probs.view(batch_size * sequence_length, -1)
+        # padding frame은 segment 별로 quantize 하던 때처럼 0으로 둠.
+        codevector_probs = codevector_probs * (segment_ids.flatten() >= 0)[:, None].to(codevector_probs.dtype)
+        # use probs to retrieve codevectors
+        codevectors_per_group = codevector_probs.unsqueeze(-1) * self.codevectors
+        codevectors = codevectors_per_group.view(batch_size * sequence_length, self.num_groups, self.num_vars, -1)
+        codevectors = codevectors.sum(-2).view(batch_size, sequence_length, -1)
+
+        if output_codevector_idx:
+            # hard one-hot이므로 group 별 codevector 번호가 모두 같으면 quantize된 vector도 같음.
+            codevector_idx = codevector_probs.view(batch_size, sequence_length, self.num_groups, -1).argmax(dim=-1)
+            return codevectors, perplexity, codevector_idx
+        return codevectors, perplexity
+
+
+class PackedWav2Vec2PositionalConvEmbedding(Wav2Vec2PositionalConvEmbedding):
+    """
+    packing된 `(batch_size, sequence_length, hidden_size)` 전체에 positional conv를 한 번만 적용하면서, conv window가 다른 segment에
+    걸치지 않도록 만든 것. parameter 구조는 `Wav2Vec2PositionalConvEmbedding`와 동일 함.
+    segment 사이에 conv padding(`num_conv_pos_embeddings // 2`) 만큼 0을 끼워 넣은 뒤 conv를 돌리고 원래 위치에서 다시 꺼내기 때문에,
+    segment 마다 따로 적용한 것과 같은 값이 나옴. padding frame의 position embedding은 0.
+    """
+
+    def forward(self, hidden_states, segment_ids: Optional[torch.LongTensor] = None):
+        if segment_ids is None:
+            return super().forward(hidden_states)
+
+        batch_size, sequence_length, hidden_size = hidden_states.shape
+        segment_gap = self.conv.padding[0]
+
+        valid_mask = segment_ids >= 0
+        batch_idx = torch.arange(batch_size, device=hidden_states.device)[:, None].expand_as(segment_ids)[valid_mask]
+        frame_idx = torch.arange(sequence_length, device=hidden_states.device)[None] + segment_ids * segment_gap
+        frame_idx = frame_idx[valid_mask]
+
+        spread_length = sequence_length + (int(segment_ids.max()) + 1) * segment_gap
+        spread_hidden_states = hidden_states.new_zeros((batch_size, spread_length, hidden_size))
+        spread_hidden_states = spread_hidden_states.index_put((batch_idx, frame_idx), hidden_states[valid_mask])
+
+        spread_position_embeddings = super().forward(spread_hidden_states)
+
+        position_embeddings = torch.zeros_like(hidden_states)
+        position_embeddings = position_embeddings.index_put(
+            (valid_mask,), spread_position_embeddings[batch_idx, frame_idx]
+        )
+        return position_embeddings
+
+
+def _segment_batched_attention(
+    query_states: torch.Tensor,
+    key_states: torch.Tensor,
+    value_states: torch.Tensor,
+    segment_ids: torch.LongTensor,
+    cu_seqlens: torch.IntTensor,
+    dropout: float = 0.0,
+) -> torch.Tensor:
+    """
+    pack 안의 segment 들을 `(num_segments, max_segment_length)` batch로 다시 펼쳐서 SDPA를 돌림. `(S, S)` mask가 필요 없음.
+    입출력은 `(batch_size, num_heads, sequence_length, head_dim)`, padding frame의 출력은 0.
+    """
+    batch_size, num_heads, sequence_length, head_dim = query_states.shape
+    valid_mask = segment_ids >= 0
+
+    segment_lengths = (cu_seqlens[1:] - cu_seqlens[:-1]).long()
+    segment_num, max_segment_length = len(segment_lengths), int(segment_lengths.max())
+    frame_segment = torch.repeat_interleave(torch.arange(segment_num, device=segment_lengths.device), segment_lengths)
+    frame_rank = torch.arange(len(frame_segment), device=frame_segment.device) - cu_seqlens[:-1].long()[frame_segment]
+
+    def to_segment_batch(states):
+        segment_states = states.new_zeros((segment_num, max_segment_length, num_heads, head_dim))
+        segment_states[frame_segment, frame_rank] = states.transpose(1, 2)[valid_mask]
+        return segment_states.transpose(1, 2)
+
+    key_padding_mask = torch.arange(max_segment_length, device=segment_lengths.device) < segment_lengths[:, None]
+    attn_output = nn.functional.scaled_dot_product_attention(
+        to_segment_batch(query_states),
+        to_segment_batch(key_states),
+        to_segment_batch(value_states),
+        attn_mask=key_padding_mask[:, None, None, :],
+        dropout_p=dropout,
+    )
+
+    output = query_states.new_zeros((batch_size, sequence_length, num_heads, head_dim))
+    output[valid_mask] = attn_output.transpose(1, 2)[frame_segment, frame_rank]
+    return output.transpose(1, 2)
+
+
+def _flash_varlen_attention(
+    query_states: torch.Tensor,
+    key_states: torch.Tensor,
+    value_states: torch.Tensor,
+    segment_ids: torch.LongTensor,
+    cu_seqlens: torch.IntTensor,
+    dropout: float = 0.0,
+) -> torch.Tensor:
+    """
+    padding을 뺀 frame만 이어 붙여서 `flash_attn_varlen_func`에 넘김. segment 경계는 collator가 만든 `cu_seqlens`로 전달 함.
+    입출력은 `(batch_size, num_heads, sequence_length, head_dim)`, padding frame의 출력은 0.
+    """
+    batch_size, num_heads, sequence_length, head_dim = query_states.shape
+    valid_mask = segment_ids >= 0
+
+    # NOTE: max_seqlen은 kernel grid 크기에만 쓰이는 상한이라 host sync 없이 pack 길이를 그대로 넘김.
+    attn_output = flash_attn_varlen_func(
+        query_states.transpose(1, 2)[valid_mask],
+        key_states.transpose(1, 2)[valid_mask],
+        value_states.transpose(1, 2)[valid_mask],
+        cu_seqlens_q=cu_seqlens.to(torch.int32),
+        cu_seqlens_k=cu_seqlens.to(torch.int32),
+        max_seqlen_q=sequence_length,
+        max_seqlen_k=sequence_length,
+        dropout_p=dropout,
+        causal=False,
+    )
+
+    output = query_states.new_zeros((batch_size, sequence_length, num_heads, head_dim))
+    output[valid_mask] = attn_output
+    return output.transpose(1, 2)
+
+
+class PackedWav2Vec2Attention(Wav2Vec2Attention):
+    """
+    packing된 sequence 용 self-attention. parameter 구조는 `Wav2Vec2Attention`와 동일하고, `config._attn_implementation`에 따라
+    다음 backend로 보냄.
+
+    - `eager`: 원래 `Wav2Vec2Attention`. bool mask는 additive mask로 바꿔서 넘김. `output_attentions`일 때도 사용.
+    - `sdpa`: block-diagonal bool mask를 그대로 `scaled_dot_product_attention`에 넘김.
+    - `flash_attention_2`: `cu_seqlens`로 `flash_attn_varlen_func`를 부름. flash-attn이 없거나 CPU, fp32 tensor면 segment 별로
+      batch를 다시 만든 SDPA로 대신 함.
+    """
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+        segment_ids: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        attn_implementation = self.config._attn_implementation if self.config is not None else "eager"
+        if attention_mask is not None and attention_mask.dim() == 2:
+            # flash_attention_2일 때 encoder가 넘겨주는 2d padding mask
+            attention_mask = attention_mask.bool()[:, None, None, :].expand(-1, 1, hidden_states.shape[1], -1)
+        if attention_mask is not None and attention_mask.dtype == torch.bool:
+            if attn_implementation == "eager" or output_attentions:
+                attention_mask = torch.zeros(
+                    attention_mask.shape, dtype=hidden_states.dtype, device=hidden_states.device
+                ).masked_fill(~attention_mask, torch.finfo(hidden_states.dtype).min)
+
+        if attn_implementation == "eager" or output_attentions:
+            return super().forward(hidden_states, attention_mask=attention_mask, output_attentions=output_attentions)
+
+        bsz, tgt_len, _ = hidden_states.size()
+        query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+        key_states = self._shape(self.k_proj(hidden_states), tgt_len, bsz)
+        value_states = self._shape(self.v_proj(hidden_states), tgt_len, bsz)
+        dropout = self.dropout if self.training else 0.0
+
+        if attn_implementation == "flash_attention_2" and cu_seqlens is not None and segment_ids is not None:
+            if (
+                is_flash_attn_2_available()
+                and query_states.is_cuda
+                and query_states.dtype in (torch.float16, torch.bfloat16)
+            ):
+                attention_function = _flash_varlen_attention
+            else:
+                attention_function = _segment_batched_attention
+            attn_output = attention_function(
+                query_states, key_states, value_states, segment_ids, cu_seqlens, dropout=dropout
+            )
+        else:
+            attn_output = nn.functional.scaled_dot_product_attention(
+                query_states,
+                key_states,
+                value_states,
+                attn_mask=attention_mask,
+                dropout_p=dropout,
+            )
+
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, None, None
+
+
+class PackedWav2Vec2EncoderLayer(Wav2Vec2EncoderLayer):
+    def __init__(self, config):
+        super().__init__(config)
+        self.attention = PackedWav2Vec2Attention(
+            embed_dim=config.hidden_size,
+            num_heads=config.num_attention_heads,
+            dropout=config.attention_dropout,
+            is_decoder=False,
+            config=config,
+        )
+
+    def forward(self, hidden_states, attention_mask=None, output_attentions=False, segment_ids=None, cu_seqlens=None):
+        attn_residual = hidden_states
+        hidden_states, attn_weights, _ = self.attention(
+            hidden_states,
+            attention_mask=attention_mask,
+            output_attentions=output_attentions,
+            segment_ids=segment_ids,
+            cu_seqlens=cu_seqlens,
+        )
+        hidden_states = self.dropout(hidden_states)
+        hidden_states = attn_residual + hidden_states
+
+        hidden_states = self.layer_norm(hidden_states)
+        hidden_states = hidden_states + self.feed_forward(hidden_states)
+        hidden_states = self.final_layer_norm(hidden_states)
+
+        outputs = (hidden_states,)
+
+        if output_attentions:
+            outputs += (attn_weights,)
+
+        return outputs
+
+
+class PackedWav2Vec2EncoderLayerStableLayerNorm(Wav2Vec2EncoderLayerStableLayerNorm):
+    def __init__(self, config):
+        super().__init__(config)
+        self.attention = PackedWav2Vec2Attention(
+            embed_dim=config.hidden_size,
+            num_heads=config.num_attention_heads,
+            dropout=config.attention_dropout,
+            is_decoder=False,
+            config=config,
+        )
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+        segment_ids: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
+    ):
+        attn_residual = hidden_states
+        hidden_states = self.layer_norm(hidden_states)
+        hidden_states, attn_weights, _ = self.attention(
+            hidden_states,
+            attention_mask=attention_mask,
+            output_attentions=output_attentions,
+            segment_ids=segment_ids,
+            cu_seqlens=cu_seqlens,
+        )
+        hidden_states = self.dropout(hidden_states)
+        hidden_states = attn_residual + hidden_states
+        hidden_states = hidden_states + self.feed_forward(self.final_layer_norm(hidden_states))
+
+        if self.adapter_layer is not None:
+            hidden_states = hidden_states + self.adapter_layer(hidden_states)
+
+        outputs = (hidden_states,)
+
+        if output_attentions:
+            outputs += (attn_weights,)
+
+        return outputs
+
+
+def _contrastive_loss_chunk(
+    transformer_features: torch.FloatTensor,
+    quantized_features: torch.FloatTensor,
+    positive_idx: torch.LongTensor,
+    negative_idx: torch.LongTensor,
+    codevector_idx: Optional[torch.LongTensor],
+    temperature: float,
+) -> torch.FloatTensor:
+    """
+    `(batch_size * sequence_length, hidden_size)`로 편 feature에서 mask된 frame `positive_idx` `(chunk_size,)`와 그 negative
+    `negative_idx` `(chunk_size, num_negatives)`만 골라서 contrastive loss의 합을 구함.
+    negative가 positive와 같은지는 feature 대신 quantizer가 고른 codevector 번호 `codevector_idx`로 비교 함.
+    """
+    positive_features = quantized_features[positive_idx]
+    target_features = torch.cat([positive_features[:, None], quantized_features[negative_idx]], dim=1)
+
+    # 4. compute logits, corresponding to `logs = sim(c_t, [q_t, \sim{q}_t]) / \kappa`
+    # of equation (3) in https://arxiv.org/pdf/2006.11477.pdf
+    logits = torch.cosine_similarity(
+        transformer_features[positive_idx][:, None].float(), target_features.float(), dim=-1
+    ).type_as(target_features)
+    logits = logits / temperature
+
+    # 5. if a negative vector is identical to the positive (i.e. when codebook utilization is low),
+    # its cosine similarity will be masked
+    if codevector_idx is not None:
+        neg_is_pos = (codevector_idx[negative_idx] == codevector_idx[positive_idx][:, None]).all(-1)
+    else:
+        neg_is_pos = (target_features[:, 1:] == positive_features[:, None]).all(-1)
+    logits = torch.cat([logits[:, :1], logits[:, 1:].masked_fill(neg_is_pos, float("-inf"))], dim=1)
+
+    # 6. compute contrastive loss \mathbf{L}_m = cross_entropy(logs) =
+    # -log(exp(sim(c_t, q_t)/\kappa) / \sum_{\sim{q}} exp(sim(c_t, \sim{q})/\kappa))
+    target = torch.zeros(len(positive_idx), dtype=torch.long, device=logits.device)
+    return nn.functional.cross_entropy(logits.float(), target, reduction="sum")
+
+
+def compute_packed_contrastive_loss(
+    transformer_features: torch.FloatTensor,
+    quantized_features: torch.FloatTensor,
+    mask_time_indices: torch.BoolTensor,
+    sampled_negative_indices: torch.LongTensor,
+    temperature: float,
+    codevector_idx: Optional[torch.LongTensor] = None,
+    chunk_size: Optional[int] = None,
+    use_checkpoint: bool = False,
+) -> torch.FloatTensor:
+    """
+    mask된 frame에 대해서만 contrastive loss의 합을 구함. `(num_negatives + 1, batch_size, sequence_length)` logits와
+    `(num_negatives, batch_size, sequence_length, hidden_size)` negative tensor를 만들지 않음.
+    `chunk_size`가 주어지면 mask된 frame을 시간 순으로 그 크기만큼 나눠서 계산하고, `use_checkpoint`면 chunk 마다 checkpoint를 걸어서
+    backward에서도 한 chunk 분량의 negative만 memory에 올라가게 함.
+    """
+    hidden_size = quantized_features.shape[-1]
+    transformer_features = transformer_features.reshape(-1, hidden_size)
+    quantized_features = quantized_features.reshape(-1, hidden_size)
+    if codevector_idx is not None:
+        codevector_idx = codevector_idx.reshape(quantized_features.shape[0], -1)
+
+    # sample negative quantized vectors BTC => (BxT)C
+    positive_idx = mask_time_indices.flatten().nonzero().squeeze(-1)
+    negative_idx = sampled_negative_indices.reshape(quantized_features.shape[0], -1)[positive_idx].long()
+
+    chunk_size = max(chunk_size or len(positive_idx), 1)
+    use_checkpoint = use_checkpoint and torch.is_grad_enabled() and chunk_size < len(positive_idx)
+
+    contrastive_loss = torch.zeros((), dtype=torch.float32, device=quantized_features.device)
+    for positive_chunk, negative_chunk in zip(positive_idx.split(chunk_size), negative_idx.split(chunk_size)):
+        chunk_args = (
+            transformer_features,
+            quantized_features,
+            positive_chunk,
+            negative_chunk,
+            codevector_idx,
+            temperature,
+        )
+        if use_checkpoint:
+            contrastive_loss = contrastive_loss + checkpoint(_contrastive_loss_chunk, *chunk_args, use_reentrant=False)
+        else:
+            contrastive_loss = contrastive_loss + _contrastive_loss_chunk(*chunk_args)
+
+    return contrastive_loss
+
+
 class PackedWav2Vec2Encoder(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.config = config
-        self.pos_conv_embed = Wav2Vec2PositionalConvEmbedding(config)
+        self.pos_conv_embed = PackedWav2Vec2PositionalConvEmbedding(config)
         self.layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout)
-        self.layers = nn.ModuleList([Wav2Vec2EncoderLayer(config) for _ in range(config.num_hidden_layers)])
+        self.layers = nn.ModuleList([PackedWav2Vec2EncoderLayer(config) for _ in range(config.num_hidden_layers)])
         self.gradient_checkpointing = False
         self._use_flash_attention_2 = config._attn_implementation == "flash_attention_2"
 
     def forward(
         self,
         hidden_states: torch.Tensor,
+        feat_split_idx=None,
         attention_mask: Optional[torch.Tensor] = None,
+        feat_attention_mask: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
@@ -68,24 +555,13 @@ class PackedWav2Vec2Encoder(nn.Module):
                 attention_mask = attention_mask.expand(
                     attention_mask.shape[0], 1, attention_mask.shape[-1], attention_mask.shape[-1]
                 )
-        elif attention_mask is not None and len(attention_mask.shape) == 4:
-            # make sure padded tokens output 0
-            # attention_mask는 bool tensor로 되어 있도록 하자, 1 True, 0 False로
-            expand_attention_mask = attention_mask[:, 0, 0].unsqueeze(-1).repeat(1, 1, hidden_states.shape[2])
-            hidden_states[~expand_attention_mask] = 0
-            if self._use_flash_attention_2:
-                # 2d mask is passed through the layers
-                attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
-            else:
-                raise ValueError(
-                    "야 여기 값 확인 안되었으니깐, attention_mask가 원본 wav2vec2하고 동일한지 확인하고 학습해라."
-                )
-                # extend attention_mask
-                attention_mask = 1.0 - attention_mask
-                attention_mask = attention_mask * torch.finfo(hidden_states.dtype).min
+        elif feat_attention_mask is not None and len(feat_attention_mask.shape) == 4:
+            # NOTE: block-diagonal bool mask를 그대로 넘기고, backend에 맞는 변환은 PackedWav2Vec2Attention에서 함.
+            #       padding frame은 feature 단계에서 이미 0.
+            attention_mask = feat_attention_mask
 
-        raise ValueError("여기 positional encoding 있음. 이거 수정하고 학습 하셈!")
-        position_embeddings = self.pos_conv_embed(hidden_states)
+        # NOTE: segment_ids가 있으면 pos conv가 발화 경계를 넘지 않음.
+        position_embeddings = self.pos_conv_embed(hidden_states, segment_ids=segment_ids)
         hidden_states = hidden_states + position_embeddings
         hidden_states = self.layer_norm(hidden_states)
         hidden_states = self.dropout(hidden_states)
@@ -108,10 +584,16 @@ class PackedWav2Vec2Encoder(nn.Module):
                         hidden_states,
                         attention_mask,
                         output_attentions,
+                        segment_ids,
+                        cu_seqlens,
                     )
                 else:
                     layer_outputs = layer(
-                        hidden_states, attention_mask=attention_mask, output_attentions=output_attentions
+                        hidden_states,
+                        attention_mask=attention_mask,
+                        output_attentions=output_attentions,
+                        segment_ids=segment_ids,
+                        cu_seqlens=cu_seqlens,
                     )
                 hidden_states = layer_outputs[0]
 
@@ -137,11 +619,11 @@ class PackedWav2Vec2EncoderStableLayerNorm(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.config = config
-        self.pos_conv_embed = Wav2Vec2PositionalConvEmbedding(config)
+        self.pos_conv_embed = PackedWav2Vec2PositionalConvEmbedding(config)
         self.layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.hidden_dropout)
         self.layers = nn.ModuleList(
-            [Wav2Vec2EncoderLayerStableLayerNorm(config) for _ in range(config.num_hidden_layers)]
+            [PackedWav2Vec2EncoderLayerStableLayerNorm(config) for _ in range(config.num_hidden_layers)]
         )
         self.gradient_checkpointing = False
         self._use_flash_attention_2 = config._attn_implementation == "flash_attention_2"
@@ -152,6 +634,8 @@ class PackedWav2Vec2EncoderStableLayerNorm(nn.Module):
         feat_split_idx=None,
         attention_mask=None,
         feat_attention_mask=None,
+        segment_ids=None,
+        cu_seqlens=None,
         output_attentions=False,
         output_hidden_states=False,
         return_dict=True,
@@ -174,42 +658,14 @@ class PackedWav2Vec2EncoderStableLayerNorm(nn.Module):
                     attention_mask.shape[0], 1, attention_mask.shape[-1], attention_mask.shape[-1]
                 )
         elif feat_attention_mask is not None and len(feat_attention_mask.shape) == 4:
-            # make sure padded tokens output 0
-            # attention_mask는 bool tensor로 되어 있도록 하자, 1 True, 0 False로
-            # expand_attention_mask = (
-            #     torch.diagonal(attention_mask, dim1=2, dim2=3).transpose(2, 1).repeat(1, 1, hidden_states.shape[2])
-            # )
-            # hidden_states = hidden_states * expand_attention_mask.to(dtype=hidden_states.dtype)
-            if self._use_flash_attention_2:
-                # 2d mask is passed through the layers
-                attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
-            else:
-                # extend attention_mask
-                feat_attention_mask = 1.0 - feat_attention_mask
-                feat_attention_mask = feat_attention_mask * torch.finfo(hidden_states.dtype).min
-
+            # NOTE: block-diagonal bool mask를 그대로 넘기고, backend에 맞는 변환은 PackedWav2Vec2Attention에서 함.
+            #       padding frame은 feature 단계에서 이미 0.
             attention_mask = feat_attention_mask
 
-        # if feat_split_idx:
-        #     positional_hidden_states = torch.zeros(
-        #         hidden_states.shape,
-        #         device=hidden_states.device,
-        #         dtype=hidden_states.dtype,
-        #     )
-        #     for idx, (feat_split, hidden_state) in enumerate(zip(feat_split_idx, hidden_states)):
-        #         start_idx = 0
-        #         for split_idx in feat_split.tolist():
-        #             end_idx = start_idx + split_idx
-        #             sample = hidden_state[start_idx:end_idx][None]
-        #             sample = self.dropout(sample + self.pos_conv_embed(sample))
-
-        #             positional_hidden_states[idx, start_idx:end_idx, :] = sample[0]
-        #             start_idx += split_idx
-        #     hidden_state = positional_hidden_states
-        # else:
-        #     position_embeddings = self.pos_conv_embed(hidden_states)
-        #     hidden_states = hidden_states + position_embeddings
-        #     hidden_states = self.dropout(hidden_states)
+        # NOTE: segment_ids가 있으면 pos conv가 발화 경계를 넘지 않음.
+        position_embeddings = self.pos_conv_embed(hidden_states, segment_ids=segment_ids)
+        hidden_states = hidden_states + position_embeddings
+        hidden_states = self.dropout(hidden_states)
 
         synced_gpus = is_deepspeed_zero3_enabled() or is_fsdp_managed_module(self)
 
@@ -230,10 +686,16 @@ class PackedWav2Vec2EncoderStableLayerNorm(nn.Module):
                         hidden_states,
                         attention_mask,
                         output_attentions,
+                        segment_ids,
+                        cu_seqlens,
                     )
                 else:
                     layer_outputs = layer(
-                        hidden_states, attention_mask=attention_mask, output_attentions=output_attentions
+                        hidden_states,
+                        attention_mask=attention_mask,
+                        output_attentions=output_attentions,
+                        segment_ids=segment_ids,
+                        cu_seqlens=cu_seqlens,
                     )
                 hidden_states = layer_outputs[0]
 
@@ -261,7 +723,7 @@ class PackedWav2Vec2Model(Wav2Vec2PreTrainedModel):
     def __init__(self, config: Wav2Vec2Config):
         super().__init__(config)
         self.config = config
-        self.feature_extractor = Wav2Vec2FeatureEncoder(config)
+        self.feature_extractor = PackedWav2Vec2FeatureEncoder(config)
         self.feature_projection = Wav2Vec2FeatureProjection(config)
 
         # model only needs masking vector if mask prob is > 0.0
@@ -343,6 +805,81 @@ class PackedWav2Vec2Model(Wav2Vec2PreTrainedModel):
 
         return hidden_states
 
+    def _get_packed_feature_vectors(
+        self,
+        input_values: List[List[torch.Tensor]],
+        mask_time_indices: Optional[torch.BoolTensor],
+        sequence_length: int,
+        num_buckets: int = 4,
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        pack 안의 음성들을 CNN feature encoder, feature projection, SpecAugment에 통과시켜서
+        `(batch_size, sequence_length, hidden_size)` hidden_states와 `(batch_size, sequence_length, conv_dim[-1])` extract_features를
+        pack layout으로 만듦. padding frame은 0.
+
+        segment를 하나씩 넣지 않고 micro-batch 안의 모든 segment를 길이 순으로 정렬해서 `num_buckets`개의 padding된 batch로 돌리고,
+        결과는 마지막에 index 연산 한 번으로 pack layout에 흩뿌림. segment를 하나씩 넣은 것과 값이 같도록 GroupNorm은 유효한 frame으로만
+        통계를 냄. positional conv는 encoder에서 pack 전체에 한 번에 적용 함.
+        """
+        batch_size = len(input_values)
+        segment_ls = [input_value.reshape(-1) for pack in input_values for input_value in pack]
+        pack_idx = torch.tensor([batch_idx for batch_idx, pack in enumerate(input_values) for _ in pack])
+
+        raw_lengths = torch.tensor([len(segment) for segment in segment_ls])
+        feat_lengths = self._get_feat_extract_output_lengths(raw_lengths, add_adapter=False)
+
+        # 각 segment가 (batch_size * sequence_length)로 편 pack에서 시작하는 위치
+        feat_offsets = torch.cumsum(feat_lengths, 0) - feat_lengths
+        segment_num_per_pack = torch.bincount(pack_idx, minlength=batch_size)
+        first_segment_idx = torch.cumsum(segment_num_per_pack, 0) - segment_num_per_pack
+        frame_start = pack_idx * sequence_length + feat_offsets - feat_offsets[first_segment_idx[pack_idx]]
+        frame_start, feat_lengths = frame_start.to(self.device), feat_lengths.to(self.device)
+
+        flat_mask_time_indices = mask_time_indices.reshape(-1) if mask_time_indices is not None else None
+        hidden_states_ls, extract_features_ls, frame_position_ls = list(), list(), list()
+        for bucket_idx in torch.tensor_split(torch.argsort(raw_lengths), min(num_buckets, len(segment_ls))):
+            bucket_values = pad_sequence([segment_ls[idx] for idx in bucket_idx.tolist()], batch_first=True)
+            bucket_values = bucket_values.to(device=self.device, dtype=self.dtype)
+            bucket_raw_lengths = raw_lengths[bucket_idx].to(self.device)
+            bucket_idx = bucket_idx.to(self.device)
+
+            extract_features = self.feature_extractor(bucket_values, input_lengths=bucket_raw_lengths)
+            extract_features = extract_features.transpose(1, 2)
+
+            frame_idx = torch.arange(extract_features.shape[1], device=self.device)
+            valid_mask = frame_idx[None] < feat_lengths[bucket_idx, None]
+            frame_position = frame_start[bucket_idx, None] + frame_idx[None]
+
+            bucket_mask_time_indices = None
+            if flat_mask_time_indices is not None:
+                bucket_mask_time_indices = torch.zeros_like(valid_mask)
+                bucket_mask_time_indices[valid_mask] = flat_mask_time_indices[frame_position[valid_mask]]
+
+            hidden_states, extract_features = self.feature_projection(extract_features)
+            hidden_states = self._mask_hidden_states(
+                hidden_states,
+                mask_time_indices=bucket_mask_time_indices,
+                attention_mask=valid_mask.long(),
+            )
+
+            hidden_states_ls.append(hidden_states[valid_mask])
+            extract_features_ls.append(extract_features[valid_mask])
+            frame_position_ls.append(frame_position[valid_mask])
+
+        frame_position = torch.cat(frame_position_ls)
+        hidden_states = torch.cat(hidden_states_ls)
+        extract_features = torch.cat(extract_features_ls)
+
+        pack_hidden_states = hidden_states.new_zeros((batch_size * sequence_length, hidden_states.shape[-1]))
+        pack_hidden_states = pack_hidden_states.index_copy(0, frame_position, hidden_states)
+        pack_extract_features = extract_features.new_zeros((batch_size * sequence_length, extract_features.shape[-1]))
+        pack_extract_features = pack_extract_features.index_copy(0, frame_position, extract_features)
+
+        return (
+            pack_hidden_states.view(batch_size, sequence_length, -1),
+            pack_extract_features.view(batch_size, sequence_length, -1),
+        )
+
     @add_start_docstrings_to_model_forward(WAV_2_VEC_2_INPUTS_DOCSTRING)
     @add_code_sample_docstrings(
         checkpoint=_CHECKPOINT_FOR_DOC,
@@ -360,6 +897,8 @@ class PackedWav2Vec2Model(Wav2Vec2PreTrainedModel):
         attention_mask: Optional[torch.Tensor] = None,
         feat_split_idx: Optional[torch.Tensor] = None,
         feat_attention_mask: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
         mask_time_indices: Optional[torch.FloatTensor] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
@@ -399,6 +938,8 @@ class PackedWav2Vec2Model(Wav2Vec2PreTrainedModel):
             feat_attention_mask=feat_attention_mask,
             feat_split_idx=feat_split_idx,
             attention_mask=attention_mask,
+            segment_ids=segment_ids,
+            cu_seqlens=cu_seqlens,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
@@ -426,7 +967,7 @@ class PackedWav2Vec2ForPreTraining(Wav2Vec2PreTrainedModel):
         self.wav2vec2 = PackedWav2Vec2Model(config)
         self.dropout_features = nn.Dropout(config.feat_quantizer_dropout)
 
-        self.quantizer = Wav2Vec2GumbelVectorQuantizer(config)
+        self.quantizer = PackedWav2Vec2GumbelVectorQuantizer(config)
 
         self.project_hid = nn.Linear(config.hidden_size, config.proj_codevector_dim)
         self.project_q = nn.Linear(config.codevector_dim, config.proj_codevector_dim)
@@ -487,6 +1028,8 @@ class PackedWav2Vec2ForPreTraining(Wav2Vec2PreTrainedModel):
         input_values: Union[Optional[torch.Tensor], List[torch.Tensor]],
         attention_mask: Optional[torch.Tensor] = None,
         feat_attention_mask: Optional[torch.Tensor] = None,
+        segment_ids: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.IntTensor] = None,
         split_idx: Optional[torch.Tensor] = None,
         feat_split_idx: Optional[torch.Tensor] = None,
         mask_time_indices: Optional[torch.BoolTensor] = None,
@@ -496,6 +1039,12 @@ class PackedWav2Vec2ForPreTraining(Wav2Vec2PreTrainedModel):
         return_dict: Optional[bool] = None,
     ) -> Union[Tuple, Wav2Vec2ForPreTrainingOutput]:
         r"""
+        segment_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Index of the packed utterance each feature frame belongs to, `-1` for padding. Used to build the
+            block-diagonal attention mask on device when `feat_attention_mask` is not given. With `flash_attention_2`
+            and `cu_seqlens` the mask is not built.
+        cu_seqlens (`torch.IntTensor` of shape `(num_segments + 1,)`, *optional*):
+            Cumulative segment lengths over the unpadded frames of the batch, as expected by varlen attention kernels.
         mask_time_indices (`torch.BoolTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Indices to mask extracted features for contrastive loss. When in training mode, model learns to predict
             masked extracted features in *config.proj_codevector_dim* space.
@@ -557,46 +1106,40 @@ class PackedWav2Vec2ForPreTraining(Wav2Vec2PreTrainedModel):
         if mask_time_indices is not None:
             mask_time_indices = mask_time_indices.to(torch.bool)
 
-        max_seq_len = 512
-
-        pack_extract_features = None
-        if isinstance(input_values, list):
-            extract_features_ls = list()
-            hidden_states_ls = list()
-            for batch_idx, batch in enumerate(input_values):
-                start_idx = 0
-                extract_features = torch.zeros(
-                    (1, max_seq_len, self.config.conv_dim[-1]), device=self.device, dtype=self.dtype
-                )
-                hidden_states = torch.zeros(
-                    (1, max_seq_len, self.config.hidden_size), device=self.device, dtype=self.dtype
+        # NOTE: pack buffer 크기는 collator가 batch에 맞춰 padding한 길이를 그대로 따름.
+        if segment_ids is not None:
+            max_seq_len = segment_ids.shape[1]
+        elif mask_time_indices is not None:
+            max_seq_len = mask_time_indices.shape[1]
+        else:
+            max_seq_len = max(int(sum(feat_idx_ls)) for feat_idx_ls in feat_split_idx)
+
+        if segment_ids is None and feat_split_idx is not None:
+            segment_ids = torch.full((len(feat_split_idx), max_seq_len), -1, dtype=torch.long, device=self.device)
+            for batch_idx, feat_idx_ls in enumerate(feat_split_idx):
+                feat_idx_ls = torch.as_tensor(feat_idx_ls, device=self.device)
+                segment_ids[batch_idx, : feat_idx_ls.sum()] = torch.repeat_interleave(
+                    torch.arange(len(feat_idx_ls), device=self.device), feat_idx_ls
                 )
-                for input_value in batch:
-                    input_value = input_value if len(input_value.shape) == 2 else input_value[None]
-                    input_value = input_value.to(self.dtype).to(self.device)
-                    extract_feature = self.wav2vec2.feature_extractor(input_value)
-                    extract_feature = extract_feature.transpose(1, 2)
-                    feat_len = extract_feature.shape[1]
-
-                    hidden_state, extract_feature = self.wav2vec2.feature_projection(extract_feature)
-                    hidden_state = self.wav2vec2._mask_hidden_states(
-                        hidden_state,
-                        mask_time_indices=mask_time_indices[batch_idx, start_idx : start_idx + feat_len][None],
-                        attention_mask=torch.ones((1, feat_len), device=hidden_state.device, dtype=hidden_state.dtype),
-                    )
 
-                    position_embeddings = self.wav2vec2.encoder.pos_conv_embed(hidden_state)
-                    hidden_state = hidden_state + position_embeddings
-                    hidden_state = self.wav2vec2.encoder.dropout(hidden_state)
-
-                    hidden_states[0, start_idx : start_idx + feat_len, :] = hidden_state
-                    extract_features[0, start_idx : start_idx + feat_len, :] = extract_feature
-                    start_idx += feat_len
+        # NOTE: flash_attention_2는 cu_seqlens, segment_ids로 segment 경계를 넘기 때문에 block-diagonal mask를 쓰지 않음.
+        #       output_attentions면 eager로 돌아가서 mask가 필요 함.
+        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
+        use_varlen_attention = (
+            self.config._attn_implementation == "flash_attention_2"
+            and cu_seqlens is not None
+            and not output_attentions
+        )
+        if feat_attention_mask is None and segment_ids is not None and not use_varlen_attention:
+            feat_attention_mask = get_block_diagonal_attention_mask(segment_ids)
 
-                extract_features_ls.append(extract_features)
-                hidden_states_ls.append(hidden_states)
-            pack_extract_features = torch.concat(extract_features_ls)
-            pack_hidden_states = torch.concat(hidden_states_ls)
+        pack_hidden_states = pack_extract_features = None
+        if isinstance(input_values, list):
+            pack_hidden_states, pack_extract_features = self.wav2vec2._get_packed_feature_vectors(
+                input_values,
+                mask_time_indices=mask_time_indices,
+                sequence_length=max_seq_len,
+            )
 
         outputs = self.wav2vec2(
             input_values,
@@ -606,6 +1149,8 @@ class PackedWav2Vec2ForPreTraining(Wav2Vec2PreTrainedModel):
             pack_extract_features=pack_extract_features,
             feat_split_idx=feat_split_idx,
             feat_attention_mask=feat_attention_mask,
+            segment_ids=segment_ids,
+            cu_seqlens=cu_seqlens,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             mask_time_indices=mask_time_indices,
@@ -623,76 +1168,32 @@ class PackedWav2Vec2ForPreTraining(Wav2Vec2PreTrainedModel):
             attention_mask = self._get_feature_vector_attention_mask(
                 extract_features.shape[1], attention_mask, add_adapter=False
             )
-        quantized_features = torch.zeros(
-            (extract_features.shape[0], max_seq_len, self.config.codevector_dim),
-            device=self.device,
-            dtype=self.dtype,
+        # NOTE: segment 마다 quantizer를 부르지 않고 pack 전체를 한 번에 quantize 함. perplexity는 segment 별로 구해서 더한 값.
+        quantized_features, codevector_perplexity, codevector_idx = self.quantizer(
+            extract_features,
+            mask_time_indices=mask_time_indices,
+            segment_ids=segment_ids,
+            output_codevector_idx=True,
         )
-        codevector_perplexity = torch.tensor(0, device=self.device, dtype=self.dtype)
-        for batch_idx, feat_idx_ls in enumerate(feat_split_idx):
-            start_idx = 0
-
-            for feat_idx in feat_idx_ls:
-                feat_idx = int(feat_idx)
-                end_idx = start_idx + feat_idx
-
-                quantized_features[batch_idx, start_idx:end_idx], perplexity = self.quantizer(
-                    extract_features[batch_idx, start_idx:end_idx][None],
-                    mask_time_indices=mask_time_indices[batch_idx, start_idx:end_idx][None],
-                )
-                codevector_perplexity += perplexity
-                start_idx += feat_idx
-
         codevector_perplexity = codevector_perplexity / extract_features.shape[0]
 
-        ########################################################################################
-        ########################################################################################
-        ########################################################################################
-
-        # quantized_features, codevector_perplexity = self.quantizer(
-        #     extract_features, mask_time_indices=mask_time_indices
-        # )
-
         quantized_features = quantized_features.to(self.project_q.weight.dtype)
         quantized_features = self.project_q(quantized_features)
 
         loss = contrastive_loss = diversity_loss = None
         if sampled_negative_indices is not None:
-            batch_size, sequence_length, hidden_size = quantized_features.shape
-
-            # for training, we sample negatives
             # 3. sample K negatives (distractors) quantized states for contrastive loss
-            # if attention_mask is passed, make sure that padded feature vectors cannot be sampled
-            # sample negative quantized vectors BTC => (BxT)C
-            negative_quantized_features = quantized_features.view(-1, hidden_size)[
-                sampled_negative_indices.long().view(-1)
-            ]
-            negative_quantized_features = negative_quantized_features.view(
-                batch_size, sequence_length, -1, hidden_size
-            ).permute(2, 0, 1, 3)
-
-            # 4. compute logits, corresponding to `logs = sim(c_t, [q_t, \sim{q}_t]) / \kappa`
-            # of equation (3) in https://arxiv.org/pdf/2006.11477.pdf
-            logits = self.compute_contrastive_logits(
-                quantized_features[None, :],
-                negative_quantized_features,
+            chunk_size = getattr(self.config, "contrastive_loss_chunk_size", None)
+            contrastive_loss = compute_packed_contrastive_loss(
                 transformer_features,
-                self.config.contrastive_logits_temperature,
+                quantized_features,
+                mask_time_indices,
+                sampled_negative_indices,
+                temperature=self.config.contrastive_logits_temperature,
+                codevector_idx=codevector_idx,
+                chunk_size=chunk_size,
+                use_checkpoint=self.training,
             )
-
-            # 5. if a negative vector is identical to the positive (i.e. when codebook utilization is low),
-            # its cosine similarity will be masked
-            neg_is_pos = (quantized_features == negative_quantized_features).all(-1)
-
-            if neg_is_pos.any():
-                logits[1:][neg_is_pos] = float("-inf")
-
-            # 6. compute contrastive loss \mathbf{L}_m = cross_entropy(logs) =
-            # -log(exp(sim(c_t, q_t)/\kappa) / \sum_{\sim{q}} exp(sim(c_t, \sim{q})/\kappa))
-            logits = logits.transpose(0, 2).reshape(-1, logits.size(0))
-            target = ((1 - mask_time_indices.long()) * -100).transpose(0, 1).flatten()
-
-            contrastive_loss = nn.functional.cross_entropy(logits.float(), target, reduction="sum")
             # 7. compute diversity loss: \mathbf{L}_d
             num_codevectors = self.config.num_codevectors_per_group * self.config.num_codevector_groups
             diversity_loss = ((num_codevectors - codevector_perplexity) / num_codevectors) * mask_time_indices.sum()
@@ -1,12 +1,30 @@
 from transformers.utils import SAFE_WEIGHTS_NAME
 
+from .audio_metadata import get_audio_length, get_audio_num_frames, read_wav_header, scan_audio_length
 from .finetuning_args import Wav2Vec2FinetuningArguments
+from .masking import compute_mask_indices_on_device, sample_negative_indices_on_device
 from .optimization import get_tri_stage_schedule_with_warmup_lr_lambda, set_scheduler
-from .packing import get_packing_dataset_idx, get_packing_strategies
+from .packing import (
+    TYPE_TO_PACKING_STRATEGY_FUNCTION,
+    PackingStrategyType,
+    get_best_fit_decreasing_strategies,
+    get_first_fit_decreasing_strategies,
+    get_packing_dataset_idx,
+    get_packing_fingerprint,
+    get_packing_strategies,
+    get_packing_strategy_function,
+    load_packing_idx_cache,
+    online_packing,
+)
+from .preprocess_cache import PreprocessCacheManager, get_preprocess_fingerprint, get_processor_config
 from .preprocessor import (
+    INT16_AUDIO_SCALE,
+    batched_silence_filter,
     centi_meter_regex,
+    compress_input_values,
     double_space_regex,
     get_feat_extract_output_lengths,
+    get_non_silent_intervals,
     kilo_meter_regex,
     librosa_silence_filter,
     meter_regex,
@@ -15,6 +33,7 @@ from .preprocessor import (
     normal_dual_bracket_regex,
     normal_dual_transcript_extractor,
     percentage_regex,
+    restore_input_values,
     sentence_normalizer,
     space_norm,
     special_char_norm,
@@ -24,3 +43,4 @@ from .preprocessor import (
     unnormal_dual_transcript_extractor,
 )
 from .pretraining_args import Wav2Vec2PretrainingArguments
+from .profiling import PretrainingProfilerCallback
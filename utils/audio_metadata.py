@@ -0,0 +1,134 @@
+import io
+import math
+import struct
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+import soundfile as sf
+from datasets import Audio, Dataset, IterableDataset, Value, concatenate_datasets
+
+
+def read_wav_header(file: BinaryIO) -> Optional[Tuple[int, int]]:
+    """
+    RIFF/RF64 WAV header의 chunk만 따라가서 `(num_frames, sampling_rate)`를 반환 함. sample은 읽지 않음.
+    WAV가 아니거나 header가 깨져 있으면 None을 반환 함.
+    """
+    riff = file.read(12)
+    if len(riff) < 12 or riff[:4] not in (b"RIFF", b"RF64") or riff[8:12] != b"WAVE":
+        return None
+
+    sampling_rate, block_align, rf64_data_size = None, None, None
+    while True:
+        chunk_header = file.read(8)
+        if len(chunk_header) < 8:
+            return None
+
+        chunk_id, chunk_size = chunk_header[:4], struct.unpack("<I", chunk_header[4:])[0]
+        if chunk_id == b"fmt ":
+            fmt = file.read(chunk_size)
+            if len(fmt) < 16:
+                return None
+            _, _, sampling_rate, _, block_align = struct.unpack("<HHIIH", fmt[:14])
+            file.seek(chunk_size % 2, io.SEEK_CUR)
+        elif chunk_id == b"ds64":
+            ds64 = file.read(chunk_size)
+            rf64_data_size = struct.unpack("<Q", ds64[8:16])[0]
+            file.seek(chunk_size % 2, io.SEEK_CUR)
+        elif chunk_id == b"data":
+            if not block_align:
+                return None
+            if chunk_size == 0xFFFFFFFF and rf64_data_size is not None:
+                chunk_size = rf64_data_size
+
+            # NOTE: 녹음이 중간에 끊긴 파일은 header의 크기가 실제보다 클 수 있음. libsndfile과 같이 남은 byte로 자름.
+            data_start = file.tell()
+            chunk_size = min(chunk_size, file.seek(0, io.SEEK_END) - data_start)
+            return chunk_size // block_align, sampling_rate
+        else:
+            file.seek(chunk_size + chunk_size % 2, io.SEEK_CUR)
+
+
+def get_audio_num_frames(audio: Dict[str, Optional[object]]) -> Tuple[int, int]:
+    """
+    `Audio(decode=False)` column의 `{"bytes", "path"}`에서 `(num_frames, sampling_rate)`를 구함.
+    WAV는 header만 읽고, 그 외 format은 soundfile의 header 정보(sf.info)를 씀.
+    """
+    audio_bytes = audio.get("bytes")
+    with io.BytesIO(audio_bytes) if audio_bytes else open(audio["path"], "rb") as file:
+        header = read_wav_header(file)
+        if header is not None:
+            return header
+
+        file.seek(0)
+        info = sf.info(file)
+    return info.frames, info.samplerate
+
+
+def get_audio_length(audio: Dict[str, Optional[object]], sampling_rate: int) -> int:
+    """
+    decode 했을 때 `input_values`의 길이. `Audio(sampling_rate)`는 decode 할 때 librosa.resample을 쓰기 때문에 같은 식으로 올림 함.
+    """
+    num_frames, audio_sampling_rate = get_audio_num_frames(audio)
+    if audio_sampling_rate == sampling_rate:
+        return num_frames
+    return math.ceil(num_frames * sampling_rate / audio_sampling_rate)
+
+
+def scan_audio_length(
+    dataset: Union[Dataset, IterableDataset],
+    audio_column_name: str = "audio",
+    length_column_name: str = "length",
+    sampling_rate: int = 16000,
+    min_length: Optional[int] = None,
+    batch_size: int = 1000,
+    num_proc: Optional[int] = None,
+) -> Union[Dataset, IterableDataset]:
+    """
+    audio를 decode 하지 않고 header에서 읽은 길이로 `length_column_name` column을 만들고 `min_length`보다 짧은 건 버림.
+    silence filter는 길이를 줄이기만 하기 때문에 여기서 짧아서 버린 건 preprocess 후에도 버려짐. 긴 쪽은 preprocess 후에 거름.
+    반환하는 dataset의 audio column은 `Audio(sampling_rate)`로 다시 decode 되도록 cast 됨.
+    """
+
+    def length_scanner(audio_ls):
+        return {length_column_name: [get_audio_length(audio, sampling_rate) for audio in audio_ls]}
+
+    def min_length_filter(length_ls):
+        return [min_length is None or min_length <= length for length in length_ls]
+
+    def streaming_length_scanner(example):
+        length_ls = length_scanner(example[audio_column_name])[length_column_name]
+        is_keep_ls = min_length_filter(length_ls)
+        example[length_column_name] = length_ls
+        return {key: [x for x, is_keep in zip(value, is_keep_ls) if is_keep] for key, value in example.items()}
+
+    dataset = dataset.cast_column(audio_column_name, Audio(decode=False))
+    if isinstance(dataset, IterableDataset):
+        # NOTE: IterableDataset은 filter 뒤에 cast_column을 해도 decode가 되지 않아서 map 안에서 같이 거름.
+        #       features를 넘기지 않으면 map이 features를 잃어버려서 마지막 cast_column이 안 됨.
+        features = dataset.features.copy()
+        features[length_column_name] = Value("int64")
+        dataset = dataset.map(streaming_length_scanner, batched=True, batch_size=batch_size, features=features)
+        return dataset.cast_column(audio_column_name, Audio(sampling_rate=sampling_rate))
+
+    # NOTE: map으로 column을 추가하면 audio bytes까지 전부 다시 씀. length만 있는 dataset을 만들어 옆에 붙임.
+    length_dataset = dataset.map(
+        length_scanner,
+        input_columns=[audio_column_name],
+        batched=True,
+        batch_size=batch_size,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        desc="scan-audio-length",
+    )
+    dataset = concatenate_datasets([dataset, length_dataset], axis=1)
+
+    if min_length is not None:
+        dataset = dataset.filter(
+            min_length_filter,
+            input_columns=[length_column_name],
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            desc="min-length-filtering",
+        )
+
+    return dataset.cast_column(audio_column_name, Audio(sampling_rate=sampling_rate))
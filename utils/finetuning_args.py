@@ -1,5 +1,6 @@
 import json
 from dataclasses import dataclass, field
+from pathlib import Path
 from typing import List, Optional, Union
 
 from transformers import TrainingArguments
@@ -57,6 +58,25 @@ class Wav2Vec2FinetuningArguments(TrainingArguments):
         metadata={"help": "Filter out audio files that are shorter than `max_duration_in_seconds` seconds"},
     )
 
+    scan_audio_length: bool = field(
+        default=False,
+        metadata={
+            "help": "Read sample counts from the WAV headers before preprocessing and drop utterances shorter than `min_duration_in_seconds` without decoding them."
+        },
+    )
+    input_values_storage_dtype: str = field(
+        default="float32",
+        metadata={
+            "help": "Dtype of `input_values` stored in the preprocessing cache: float32, int16 or float16. With int16/float16 the un-normalized audio is stored with per-utterance mean/std and normalized in the collator. int16 is lossless only for PCM_16 audio decoded at its native sampling rate; resampled audio is rounded to 16 bits."
+        },
+    )
+    preprocess_mode: str = field(
+        default="cached",
+        metadata={
+            "help": "cached: run the preprocessor with datasets.map and keep the Arrow caches. lazy: only build a length index from the WAV headers and run silence trimming and normalization with set_transform in the DataLoader workers. For quick experiments."
+        },
+    )
+
     train_dataset_prefix: List[str] = field(
         default="train",
         metadata={"help": "A prefix required to distinguish splits in the data loaded by load_dataset."},
@@ -87,6 +107,12 @@ class Wav2Vec2FinetuningArguments(TrainingArguments):
         default=None,
         metadata={"help": "Where do you want to store the pretrained models downloaded from huggingface.co"},
     )
+    preprocess_cache_max_size_gb: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Disk budget (GB) for the preprocessing map/filter caches in cache_dir. When exceeded, caches not used by the current run are deleted in least-recently-used order. None keeps every cache."
+        },
+    )
 
     # model
     model_name_or_path: str = field(
@@ -119,3 +145,22 @@ class Wav2Vec2FinetuningArguments(TrainingArguments):
         self.train_dataset_prefix = self.train_dataset_prefix if self.train_dataset_prefix else []
         self.valid_dataset_prefix = self.valid_dataset_prefix if self.valid_dataset_prefix else []
         self.test_dataset_prefix = self.test_dataset_prefix if self.test_dataset_prefix else []
+
+        self.cache_dir = Path(self.cache_dir) if self.cache_dir else None
+
+        if self.input_values_storage_dtype not in ("float32", "int16", "float16"):
+            raise ValueError(
+                f"input_values_storage_dtype은 float32, int16, float16 중 하나여야 함. 입력: {self.input_values_storage_dtype}"
+            )
+
+        if self.input_values_storage_dtype != "float32":
+            # NOTE: input_values_mean/std는 model 인자가 아니라서 HF Trainer가 지우면 collator에서 normalize를 못 함.
+            self.remove_unused_columns = False
+
+        if self.preprocess_mode not in ("cached", "lazy"):
+            raise ValueError(f"preprocess_mode은 cached, lazy 중 하나여야 함. 입력: {self.preprocess_mode}")
+
+        if self.preprocess_mode == "lazy":
+            # NOTE: lazy면 dataset에 audio 같은 원본 column만 있고 input_values는 transform에서 만들어짐.
+            #       HF Trainer가 model 인자에 없는 column을 지우면 transform이 audio를 받을 수 없음.
+            self.remove_unused_columns = False
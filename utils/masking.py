@@ -0,0 +1,102 @@
+from typing import Optional, Tuple
+
+import torch
+
+
+def compute_mask_indices_on_device(
+    shape: Tuple[int, int],
+    mask_prob: float,
+    mask_length: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    min_masks: int = 0,
+    device: Optional[torch.device] = None,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    transformers의 `_compute_mask_indices`를 torch로 옮긴 것. batch 전체를 loop 없이 한 번에 계산하고 model device에서 돌아감.
+    span 개수 규칙(batch 당 epsilon 하나로 probabilistic rounding, `min_masks`, 길이 제한)과 span 시작점을 sequence 안에서 중복 없이
+    균등하게 뽑는 것은 원본과 같음. 반환 값은 `(batch_size, sequence_length)` bool tensor.
+    """
+    batch_size, sequence_length = shape
+
+    if mask_length < 1:
+        raise ValueError("`mask_length` has to be bigger than 0.")
+
+    if mask_length > sequence_length:
+        raise ValueError(
+            f"`mask_length` has to be smaller than `sequence_length`, but got `mask_length`: {mask_length}"
+            f" and `sequence_length`: {sequence_length}`"
+        )
+
+    if attention_mask is not None:
+        device = attention_mask.device
+        input_lengths = attention_mask.sum(-1).long()
+    else:
+        input_lengths = torch.full((batch_size,), sequence_length, dtype=torch.long, device=device)
+
+    # NOTE: 원본과 같이 batch 전체가 epsilon 하나를 공유 함.
+    epsilon = torch.rand((), device=device, generator=generator)
+
+    def compute_num_masked_span(input_length: torch.Tensor) -> torch.Tensor:
+        num_masked_span = (mask_prob * input_length / mask_length + epsilon).long()
+        num_masked_span = num_masked_span.clamp(min=min_masks)
+        # make sure num masked span <= sequence_length
+        num_masked_span = torch.where(
+            num_masked_span * mask_length > sequence_length, sequence_length // mask_length, num_masked_span
+        )
+        # make sure num_masked span is also <= input_length - (mask_length - 1)
+        return torch.minimum(num_masked_span, (input_length - (mask_length - 1)).clamp(min=0))
+
+    num_masked_span = compute_num_masked_span(input_lengths)
+    max_num_masked_span = int(compute_num_masked_span(torch.tensor(sequence_length, device=device)))
+    if max_num_masked_span == 0:
+        return torch.zeros(shape, dtype=torch.bool, device=device)
+
+    # NOTE: 시작 가능한 위치에 random key를 주고 작은 순서로 `num_masked_span`개를 고르면 중복 없는 균등 추출이 됨.
+    #       시작할 수 없는 위치는 key를 2로 둬서 뒤로 밀어냄.
+    start_range = torch.arange(sequence_length, device=device)
+    random_key = torch.rand((batch_size, sequence_length), device=device, generator=generator)
+    random_key = random_key.masked_fill(start_range >= (input_lengths - (mask_length - 1))[:, None], 2.0)
+    span_starts = random_key.topk(max_num_masked_span, dim=-1, largest=False).indices
+
+    # NOTE: 고르지 않은 span은 마지막 dummy column으로 보낸 뒤 잘라냄.
+    is_used_span = torch.arange(max_num_masked_span, device=device) < num_masked_span[:, None]
+    span_starts = span_starts.masked_fill(~is_used_span, sequence_length)
+    mask_idxs = (span_starts[:, :, None] + torch.arange(mask_length, device=device)).flatten(1)
+    mask_idxs = mask_idxs.clamp(max=sequence_length)
+
+    spec_aug_mask = torch.zeros((batch_size, sequence_length + 1), dtype=torch.bool, device=device)
+    spec_aug_mask.scatter_(1, mask_idxs, True)
+    return spec_aug_mask[:, :sequence_length]
+
+
+def sample_negative_indices_on_device(
+    mask_time_indices: torch.Tensor,
+    num_negatives: int,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    transformers의 `_sample_negative_indices`를 torch로 옮긴 것. 각 masked frame 마다 같은 sequence의 다른 masked frame을
+    `num_negatives`개 뽑고, 원본과 같이 batch를 펼친 `batch_idx * sequence_length + frame_idx` index를 반환 함.
+    masked가 아닌 frame은 자기 batch의 offset 값을 가짐.
+    """
+    mask_time_indices = mask_time_indices.bool()
+    batch_size, sequence_length = mask_time_indices.shape
+    device = mask_time_indices.device
+
+    num_masked = mask_time_indices.sum(-1, keepdim=True)
+    # NOTE: masked frame의 sequence 안 순서. 자기 자신을 negative로 뽑지 않도록 [0, num_masked - 1)에서 뽑고 순서 이상이면 1을 더함.
+    masked_rank = mask_time_indices.long().cumsum(-1) - 1
+
+    high = (num_masked - 1).clamp(min=0)[:, :, None]
+    sampled_rank = torch.rand((batch_size, sequence_length, num_negatives), device=device, generator=generator)
+    sampled_rank = sampled_rank.mul_(high).long()
+    sampled_rank += sampled_rank >= masked_rank[:, :, None]
+    sampled_rank = torch.minimum(sampled_rank, high, out=sampled_rank)
+
+    # NOTE: stable sort로 masked frame 위치가 앞에 순서대로 오게 해서, 순서 -> frame 위치로 바꿈.
+    masked_positions = torch.sort((~mask_time_indices).long(), dim=-1, stable=True).indices
+    sampled_negative_indices = masked_positions.gather(1, sampled_rank.flatten(1)).view(sampled_rank.shape)
+
+    batch_offset = torch.arange(batch_size, device=device)[:, None, None] * sequence_length
+    return torch.where(mask_time_indices[:, :, None], sampled_negative_indices + batch_offset, batch_offset)
@@ -1,9 +1,20 @@
-from collections import defaultdict
-from typing import List
+import os
+import shutil
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
 import numpy as np
-from datasets import Dataset
-from tqdm import tqdm
+import pyarrow as pa
+from datasets import Dataset, load_from_disk
+from datasets.fingerprint import Hasher
+from filelock import FileLock
+
+from transformers import PretrainedConfig
+from transformers.utils import ExplicitEnum
+
+from .preprocessor import get_feat_extract_output_lengths
 
 
 def get_packing_strategies(length_ls: List[int], max_seq_len: int, max_seq_per_pack: int) -> defaultdict:
@@ -70,50 +81,280 @@ def get_packing_strategies(length_ls: List[int], max_seq_len: int, max_seq_per_p
     return strategies_per_length
 
 
+def _packs_to_strategies(packs: List[List[int]], max_seq_len: int) -> defaultdict:
+    # NOTE: 같은 구성의 pack을 묶어서 get_packing_strategies와 같은 (count, pack) 형식으로 바꿈.
+    strategies_per_length = defaultdict(list)
+    for pack, count in Counter(tuple(pack) for pack in packs).items():
+        strategies_per_length[max_seq_len - sum(pack)].append((count, list(pack)))
+    return strategies_per_length
+
+
+def get_first_fit_decreasing_strategies(length_ls: List[int], max_seq_len: int, max_seq_per_pack: int) -> defaultdict:
+    """
+    길이가 긴 순서대로, 들어갈 수 있는 가장 앞쪽 pack에 넣는 first-fit-decreasing.
+    pack의 남은 공간을 max segment tree로 관리해서 가장 앞쪽 pack을 O(log n)으로 찾음.
+    아직 만들어지지 않은 pack은 남은 공간이 max_seq_len인 leaf로 취급 함.
+    """
+    seq_lens, counts = np.unique(length_ls, return_counts=True)
+
+    leaf_num = 1
+    while leaf_num < max(int(counts.sum()), 1):
+        leaf_num *= 2
+    tree = [max_seq_len] * (2 * leaf_num)
+
+    packs = list()
+    for length, n_sequences in zip(seq_lens[::-1].tolist(), counts[::-1].tolist()):
+        while n_sequences > 0:
+            node = 1
+            while node < leaf_num:
+                node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+            pack_idx = node - leaf_num
+            if pack_idx == len(packs):
+                packs.append(list())
+
+            # 같은 길이는 이 pack이 계속 가장 앞쪽 pack이므로 들어갈 만큼 한 번에 넣음.
+            pack = packs[pack_idx]
+            count = min(n_sequences, tree[node] // length, max_seq_per_pack - len(pack))
+            pack.extend([length] * count)
+            n_sequences -= count
+
+            tree[node] = 0 if len(pack) == max_seq_per_pack else tree[node] - count * length
+            node //= 2
+            while node:
+                tree[node] = max(tree[2 * node], tree[2 * node + 1])
+                node //= 2
+
+    return _packs_to_strategies(packs, max_seq_len)
+
+
+def get_best_fit_decreasing_strategies(length_ls: List[int], max_seq_len: int, max_seq_per_pack: int) -> defaultdict:
+    """
+    길이가 긴 순서대로, 들어갈 수 있는 pack 중 남은 공간이 가장 적은 pack에 넣는 best-fit-decreasing.
+    열린 pack은 남은 공간을 key로 정렬된 index에 (count, pack) 묶음으로 관리 함.
+    같은 길이를 넣을 때 고른 pack이 계속 best-fit이라 묶음 단위로 처리해도 발화 단위로 넣은 결과와 같음.
+    """
+    seq_lens, counts = np.unique(length_ls, return_counts=True)
+
+    free_space_to_packs = defaultdict(list)
+    free_space_ls = list()  # NOTE: 항상 정렬된 상태를 유지 함.
+    strategies_per_length = defaultdict(list)
+
+    def push_packs(free_space: int, count: int, pack: List[int]) -> None:
+        if free_space == 0 or len(pack) == max_seq_per_pack:
+            strategies_per_length[free_space].append((count, pack))
+            return
+        if free_space not in free_space_to_packs:
+            insort(free_space_ls, free_space)
+        free_space_to_packs[free_space].append((count, pack))
+
+    for length, n_sequences in zip(seq_lens[::-1].tolist(), counts[::-1].tolist()):
+        while n_sequences > 0:
+            position = bisect_left(free_space_ls, length)
+            if position < len(free_space_ls):
+                free_space = free_space_ls[position]
+                n_packs, pack = free_space_to_packs[free_space].pop()
+                if not free_space_to_packs[free_space]:
+                    free_space_to_packs.pop(free_space)
+                    free_space_ls.pop(position)
+            else:
+                # 들어갈 곳이 없으니 새 pack을 만듦.
+                free_space, n_packs, pack = max_seq_len, n_sequences, list()
+
+            fill_num = min(free_space // length, max_seq_per_pack - len(pack))
+            full_pack_num = min(n_packs, n_sequences // fill_num)
+            if full_pack_num:
+                push_packs(free_space - fill_num * length, full_pack_num, pack + [length] * fill_num)
+                n_sequences -= full_pack_num * fill_num
+                n_packs -= full_pack_num
+
+            if n_packs and n_sequences:
+                push_packs(free_space - n_sequences * length, 1, pack + [length] * n_sequences)
+                n_sequences = 0
+                n_packs -= 1
+
+            if n_packs and pack:
+                push_packs(free_space, n_packs, pack)
+
+    for free_space in free_space_ls:
+        strategies_per_length[free_space].extend(free_space_to_packs[free_space])
+
+    return strategies_per_length
+
+
+class PackingStrategyType(ExplicitEnum):
+    HISTOGRAM = "histogram"
+    FIRST_FIT_DECREASING = "first_fit_decreasing"
+    BEST_FIT_DECREASING = "best_fit_decreasing"
+
+
+TYPE_TO_PACKING_STRATEGY_FUNCTION = {
+    PackingStrategyType.HISTOGRAM: get_packing_strategies,
+    PackingStrategyType.FIRST_FIT_DECREASING: get_first_fit_decreasing_strategies,
+    PackingStrategyType.BEST_FIT_DECREASING: get_best_fit_decreasing_strategies,
+}
+
+
+def get_packing_strategy_function(name: Union[str, PackingStrategyType]) -> Callable[..., defaultdict]:
+    return TYPE_TO_PACKING_STRATEGY_FUNCTION[PackingStrategyType(name)]
+
+
 def get_packing_dataset_idx(length_ls: List[int], strategies_per_length: defaultdict) -> Dataset:
-    length_to_indices = {}
-    length_array = np.array(length_ls)
-    unique_lengths = np.unique(length_array)
+    length_array = np.asarray(length_ls, dtype=np.int64)
+
+    # NOTE: strategies_per_length를 (pack_id, length)의 flat한 배열로 풀어냄. 순서는 기존 loop와 동일하게 pack 순, pack 내부 순서를 유지 함.
+    slot_length_ls, pack_size_ls = list(), list()
+    for pad_num, strategies_ls in strategies_per_length.items():
+        for repeat_count, strategies in strategies_ls:
+            if not repeat_count:
+                continue
+            slot_length_ls.append(np.tile(np.asarray(strategies, dtype=np.int64), repeat_count))
+            pack_size_ls.append(np.full(repeat_count, len(strategies), dtype=np.int64))
+
+    if not slot_length_ls:
+        return Dataset.from_dict({"packing_ls": [], "feat_length_ls": []})
+
+    slot_length = np.concatenate(slot_length_ls)
+    pack_size = np.concatenate(pack_size_ls)
+    slot_pack_id = np.repeat(np.arange(len(pack_size)), pack_size)
+
+    # 같은 length를 요구하는 slot 중에서 몇 번째인지(rank)를 stable argsort + cumsum으로 구함.
+    slot_order = np.argsort(slot_length, kind="stable")
+    sorted_slot_length = slot_length[slot_order]
+    is_group_start = np.ones(len(sorted_slot_length), dtype=bool)
+    is_group_start[1:] = sorted_slot_length[1:] != sorted_slot_length[:-1]
+    group_start = np.maximum.accumulate(np.where(is_group_start, np.arange(len(sorted_slot_length)), 0))
+    slot_rank = np.empty_like(slot_order)
+    slot_rank[slot_order] = np.arange(len(slot_order)) - group_start
 
-    for length in unique_lengths:
-        length_to_indices[length] = np.where(length_array == length)[0]
+    # length 별 dataset index를 오름차순으로 정렬해 두고, rank 번째 index를 할당 함.
+    data_order = np.argsort(length_array, kind="stable")
+    sorted_data_length = length_array[data_order]
+    bucket_start = np.searchsorted(sorted_data_length, slot_length, side="left")
+    bucket_end = np.searchsorted(sorted_data_length, slot_length, side="right")
 
-    current_positions = {length: 0 for length in unique_lengths}
+    # NOTE: 기존 loop와 동일하게 해당 length의 데이터가 모자라면 그 slot은 pack에서 빠짐.
+    position = bucket_start + slot_rank
+    is_valid = position < bucket_end
 
-    compressed_num = sum(
-        strategies_num
-        for pad_num, strategies_ls in strategies_per_length.items()
-        for strategies_num, seq_ls in strategies_ls
+    data_idx = data_order[position[is_valid]]
+    feat_length = slot_length[is_valid]
+    member_num = np.bincount(slot_pack_id[is_valid], minlength=len(pack_size))
+
+    offsets = pa.array(np.concatenate([[0], np.cumsum(member_num)]), type=pa.int32())
+    packing_table = pa.Table.from_arrays(
+        [
+            pa.ListArray.from_arrays(offsets, pa.array(data_idx, type=pa.int64())),
+            pa.ListArray.from_arrays(offsets, pa.array(feat_length, type=pa.int64())),
+        ],
+        names=["packing_ls", "feat_length_ls"],
     )
 
-    packing_dataset_ls = []
-    with tqdm(total=compressed_num, desc="find_packing_idx") as pbar:
-        for pad_num, strategies_ls in strategies_per_length.items():
-            for repeat_count, strategies in strategies_ls:
-                for _ in range(repeat_count):
-                    data_idx_ls = []
-                    for length in strategies:
-                        indices = length_to_indices[length]
-                        current_pos = current_positions[length]
-
-                        while current_pos < len(indices):
-                            idx = indices[current_pos]
-                            if length_array[idx] != -1:
-                                break
-                            current_pos += 1
-
-                        if current_pos < len(indices):
-                            data_idx = indices[current_pos]
-                            length_array[data_idx] = -1
-                            data_idx_ls.append(data_idx)
-                            current_positions[length] = current_pos + 1
-
-                    packing_dataset_ls.append(
-                        {
-                            "packing_ls": data_idx_ls,
-                            "feat_length_ls": strategies,
-                        },
-                    )
-                    pbar.update(1)
-
-    return Dataset.from_list(packing_dataset_ls)
+    return Dataset(packing_table)
+
+
+def online_packing(
+    dataset: Iterable[Dict[str, Any]],
+    config: PretrainedConfig,
+    max_seq_len: int,
+    max_seq_per_pack: int,
+    buffer_size: int = 1000,
+    length_column_name: str = "length",
+) -> Iterator[Dict[str, Any]]:
+    """
+    streaming dataset에서 발화를 하나씩 받아 best-fit으로 열린 pack에 채워 넣고, pack이 가득 차면 바로 내보냄.
+    열린 pack은 남은 공간(feature length)을 key로 관리하며, buffer에 쌓인 발화 수가 buffer_size를 넘으면
+    가장 많이 채워진 pack부터 내보냄. 출력 형식은 packing_datasets에서 만드는 pack과 동일 함.
+    """
+
+    def make_pack(pack: List[Tuple[Dict[str, Any], int]]) -> Dict[str, Any]:
+        packed_example = {
+            "input_values": [example["input_values"] for example, _ in pack],
+            "split_idx": [example[length_column_name] for example, _ in pack],
+            length_column_name: sum(example[length_column_name] for example, _ in pack),
+            "feat_split_idx": [feat_len for _, feat_len in pack],
+        }
+        # NOTE: int16/float16로 저장된 발화는 collator에서 normalize 할 mean/std를 같이 넘김.
+        for column_name in ("input_values_mean", "input_values_std"):
+            if column_name in pack[0][0]:
+                packed_example[column_name] = [example[column_name] for example, _ in pack]
+        return packed_example
+
+    free_space_to_packs = defaultdict(list)
+    free_space_ls = list()  # NOTE: 항상 정렬된 상태를 유지 함.
+    buffered_num = 0
+
+    def pop_pack(free_space: int) -> List[Tuple[Dict[str, Any], int]]:
+        packs = free_space_to_packs[free_space]
+        pack = packs.pop()
+        if not packs:
+            free_space_to_packs.pop(free_space)
+            free_space_ls.pop(bisect_left(free_space_ls, free_space))
+        return pack
+
+    def push_pack(free_space: int, pack: List[Tuple[Dict[str, Any], int]]) -> None:
+        if free_space not in free_space_to_packs:
+            insort(free_space_ls, free_space)
+        free_space_to_packs[free_space].append(pack)
+
+    for example in dataset:
+        feat_len = get_feat_extract_output_lengths(example[length_column_name], config)
+        if feat_len > max_seq_len:
+            # NOTE: length_filter에서 걸러졌어야 하는 값, pack에 들어갈 수 없으니 버림.
+            continue
+
+        # feat_len이 들어갈 수 있는 pack 중 남은 공간이 가장 적은 pack을 고름.
+        position = bisect_left(free_space_ls, feat_len)
+        if position < len(free_space_ls):
+            free_space = free_space_ls[position]
+            pack = pop_pack(free_space)
+        else:
+            free_space, pack = max_seq_len, list()
+
+        pack.append((example, feat_len))
+        free_space -= feat_len
+        buffered_num += 1
+
+        if free_space == 0 or len(pack) == max_seq_per_pack:
+            buffered_num -= len(pack)
+            yield make_pack(pack)
+        else:
+            push_pack(free_space, pack)
+
+        while buffered_num > buffer_size:
+            pack = pop_pack(free_space_ls[0])
+            buffered_num -= len(pack)
+            yield make_pack(pack)
+
+    while free_space_ls:
+        yield make_pack(pop_pack(free_space_ls[0]))
+
+
+def get_packing_fingerprint(dataset: Dataset, packing_kwargs: Dict[str, Any]) -> str:
+    """
+    입력 dataset의 fingerprint와 packing에 영향을 주는 모든 인자를 묶어서 packing index cache의 key를 만듦.
+    split, max_seq_len, duration filter 등이 바뀌면 key가 달라져서 예전 index를 재사용하지 않음.
+    """
+    return Hasher.hash({"dataset_fingerprint": dataset._fingerprint, **packing_kwargs})
+
+
+def load_packing_idx_cache(cache_path: Path, build_fn: Callable[[], Dataset]) -> Dataset:
+    """
+    cache_path에 packing index가 있으면 불러오고, 없으면 build_fn으로 만들어서 저장 함.
+    여러 node가 같은 cache_dir를 공유할 수 있어서 main_process_first와 별개로 file lock을 잡고,
+    임시 경로에 저장한 뒤 rename해서 덜 쓰인 cache를 다른 rank가 읽지 않도록 함.
+    """
+    lock_path = cache_path.with_name(f"{cache_path.name}.lock")
+    with FileLock(lock_path.as_posix()):
+        if cache_path.exists():
+            return load_from_disk(cache_path.as_posix())
+
+        packing_idx_dataset = build_fn()
+
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        if tmp_path.exists():
+            # NOTE: 이전 실행이 저장 중에 죽어서 남은 찌꺼기
+            shutil.rmtree(tmp_path)
+        packing_idx_dataset.save_to_disk(tmp_path.as_posix())
+        os.replace(tmp_path, cache_path)
+
+    return packing_idx_dataset
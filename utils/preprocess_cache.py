@@ -0,0 +1,235 @@
+import inspect
+import json
+import os
+import re
+import time
+from pathlib import Path
+from types import CodeType
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from datasets import Dataset
+from datasets.fingerprint import Hasher
+from filelock import FileLock
+
+from transformers import ProcessorMixin
+from transformers.utils import logging
+
+from . import preprocessor as preprocessor_module
+
+
+logger = logging.get_logger(__name__)
+
+PREPROCESS_CACHE_INDEX_NAME = "preprocess_cache_index.json"
+
+
+def _get_source(obj: Any) -> str:
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        # NOTE: source를 못 읽는 환경(zip import 등)이면 bytecode로 대신 함.
+        return obj.__code__.co_code.hex()
+
+
+def _get_global_names(code: CodeType) -> Set[str]:
+    # NOTE: list comprehension이나 내부 함수는 별도 code object라서 co_consts까지 따라감.
+    name_set = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            name_set |= _get_global_names(const)
+    return name_set
+
+
+def get_preprocessor_sources(preprocess_fn: Callable) -> Dict[str, str]:
+    """
+    `preprocess_fn`이 부르는 utils/preprocessor.py의 함수를 따라가면서, 그 함수들과 함수가 쓰는 module 상수(regex 등)만 모음.
+    preprocess에서 쓰지 않는 함수를 고쳐도 cache key가 바뀌지 않음.
+    """
+    source_map = dict()
+    function_ls = [preprocess_fn]
+    while function_ls:
+        function = function_ls.pop()
+        is_preprocessor_function = function.__globals__ is vars(preprocessor_module)
+        for name in sorted(_get_global_names(function.__code__)):
+            obj = function.__globals__.get(name)
+            if name in source_map or obj is None or inspect.ismodule(obj) or inspect.isclass(obj):
+                continue
+
+            if inspect.isfunction(obj):
+                if obj.__module__ == preprocessor_module.__name__:
+                    source_map[name] = _get_source(obj)
+                    function_ls.append(obj)
+            elif is_preprocessor_function:
+                if isinstance(obj, re.Pattern):
+                    source_map[name] = f"{obj.pattern}/{obj.flags}"
+                elif isinstance(obj, (str, int, float, bool)):
+                    source_map[name] = repr(obj)
+                else:
+                    # NOTE: Kss 같은 객체는 repr에 주소가 들어가서 type 이름만 씀.
+                    source_map[name] = type(obj).__qualname__
+    return dict(sorted(source_map.items()))
+
+
+def get_processor_config(processor: ProcessorMixin) -> Dict[str, Any]:
+    """
+    preprocess 결과에 영향을 주는 processor 설정만 모음. checkpoint 경로가 바뀌어도 같은 설정이면 같은 값이 나오도록
+    `name_or_path`, `*_file` 같은 경로는 뺌.
+    """
+    processor_config = {"feature_extractor": processor.feature_extractor.to_dict()}
+
+    tokenizer = getattr(processor, "tokenizer", None)
+    if tokenizer is not None:
+        processor_config["tokenizer"] = {
+            "vocab": tokenizer.get_vocab(),
+            "init_kwargs": {
+                key: value
+                for key, value in tokenizer.init_kwargs.items()
+                if key != "name_or_path" and not key.endswith("_file")
+            },
+        }
+    return processor_config
+
+
+def get_preprocess_fingerprint(
+    dataset: Dataset,
+    preprocess_fn: Callable,
+    processor: ProcessorMixin,
+    preprocess_kwargs: Dict[str, Any],
+) -> str:
+    """
+    입력 dataset의 fingerprint, preprocess 함수와 그 함수가 부르는 utils/preprocessor.py 함수의 source, processor 설정,
+    preprocess에 영향을 주는 인자를 묶어서 map cache의 key를 만듦.
+    silence filter의 top_db나 sentence_normalizer를 고치면 key가 달라지고, 쓰지 않는 함수를 고치면 그대로임.
+    """
+    return Hasher.hash(
+        {
+            "dataset_fingerprint": dataset._fingerprint,
+            "preprocess_fn": _get_source(preprocess_fn),
+            "preprocessor_sources": get_preprocessor_sources(preprocess_fn),
+            "processor_config": get_processor_config(processor),
+            **preprocess_kwargs,
+        }
+    )
+
+
+class PreprocessCacheManager:
+    """
+    `cache_dir`에 쌓이는 map/filter arrow cache의 이름을 정하고, fingerprint 별로 파일 크기와 마지막 사용 시각을
+    `preprocess_cache_index.json`에 기록 함. `max_size_gb`를 넘으면 이번 실행에서 쓰지 않은 cache부터 오래된 순(LRU)으로 지움.
+    index는 여러 rank/node가 같이 쓸 수 있어서 file lock을 잡고 임시 파일에 쓴 뒤 rename 함.
+
+    Args:
+        cache_dir (`Path`):
+            map/filter cache와 index를 저장할 경로.
+        cache_file_name (`str`):
+            cache 이름 뒤에 붙는 사용자 지정 이름.
+        max_size_gb (`float`, *optional*):
+            preprocess cache 전체가 쓸 수 있는 disk 크기(GB). None이면 지우지 않고 index만 기록 함.
+    """
+
+    def __init__(self, cache_dir: Path, cache_file_name: str, max_size_gb: Optional[float] = None) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_file_name = cache_file_name
+        self.max_size = int(max_size_gb * 1024**3) if max_size_gb is not None else None
+
+        self.index_path = self.cache_dir.joinpath(PREPROCESS_CACHE_INDEX_NAME)
+        self.lock_path = self.cache_dir.joinpath(f"{PREPROCESS_CACHE_INDEX_NAME}.lock")
+        # 이번 실행에서 register한 fingerprint, evict 대상에서 빠짐.
+        self.used_fingerprint_set = set()
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_cache_file_names(
+        self,
+        repo_name: str,
+        split: str,
+        fingerprint: str,
+        min_length: int,
+        max_length: int,
+    ) -> Tuple[str, str]:
+        """
+        pretrain, finetune에서 같이 쓰는 `(map cache, filter cache)` 경로. fingerprint는 항상 확장자 바로 앞에 붙음.
+        num_proc를 쓰면 datasets가 확장자 앞에 rank suffix를 넣기 때문에 확장자가 꼭 있어야 함.
+        """
+        cache_file_name = Path(self.cache_file_name).stem
+        name = f"{repo_name.split('/')[-1]}-{split}_{cache_file_name}-{fingerprint}.arrow"
+        map_cache_path = self.cache_dir.joinpath(f"map_{name}")
+        filter_cache_path = self.cache_dir.joinpath(f"filter_{min_length}-{max_length}_{name}")
+        return map_cache_path.as_posix(), filter_cache_path.as_posix()
+
+    def _get_cache_files(self, fingerprint: str) -> List[Path]:
+        # NOTE: num_proc를 쓰면 datasets가 fingerprint 뒤에 `_00000_of_00004`를 붙여서 glob으로 찾음.
+        return [path for path in self.cache_dir.glob(f"*-{fingerprint}*") if path.is_file() and path.suffix != ".lock"]
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        if not self.index_path.exists():
+            return dict()
+        try:
+            return json.loads(self.index_path.read_text())
+        except json.JSONDecodeError:
+            logger.warning(f"{self.index_path}가 깨져 있어서 새로 만듦.")
+            return dict()
+
+    def _save_index(self, index: Dict[str, Dict[str, Any]]) -> None:
+        tmp_path = self.index_path.with_name(f"{self.index_path.name}.tmp")
+        tmp_path.write_text(json.dumps(index, indent=2, ensure_ascii=False))
+        os.replace(tmp_path, self.index_path)
+
+    def register(self, fingerprint: str, repo_name: str, split: str) -> None:
+        """map/filter가 끝난 뒤에 불러서 해당 fingerprint의 파일 크기와 마지막 사용 시각을 갱신 함."""
+        self.used_fingerprint_set.add(fingerprint)
+
+        with FileLock(self.lock_path.as_posix()):
+            index = self._load_index()
+            file_ls = self._get_cache_files(fingerprint)
+            index[fingerprint] = {
+                "repo_name": repo_name,
+                "split": split,
+                "files": sorted(path.name for path in file_ls),
+                "size": sum(path.stat().st_size for path in file_ls),
+                "last_access": time.time(),
+            }
+            self._save_index(index)
+
+    def evict(self) -> List[str]:
+        """
+        `max_size`를 넘는 만큼 이번 실행에서 쓰지 않은 cache를 LRU 순으로 지우고, 지운 fingerprint를 반환 함.
+        index에는 있지만 파일이 이미 없어진 항목도 같이 정리 함.
+        """
+        evicted_ls = list()
+        with FileLock(self.lock_path.as_posix()):
+            index = self._load_index()
+            index = {
+                fingerprint: entry
+                for fingerprint, entry in index.items()
+                if any(self.cache_dir.joinpath(file_name).exists() for file_name in entry["files"])
+            }
+
+            total_size = sum(entry["size"] for entry in index.values())
+            if self.max_size is not None and total_size > self.max_size:
+                candidate_ls = sorted(
+                    (x for x in index.items() if x[0] not in self.used_fingerprint_set),
+                    key=lambda x: x[1]["last_access"],
+                )
+                for fingerprint, entry in candidate_ls:
+                    if total_size <= self.max_size:
+                        break
+
+                    for path in self._get_cache_files(fingerprint):
+                        path.unlink(missing_ok=True)
+                    total_size -= entry["size"]
+                    evicted_ls.append(fingerprint)
+                    del index[fingerprint]
+
+                    logger.info(
+                        f"preprocess cache 삭제: {entry['repo_name']}-{entry['split']} ({entry['size'] / 1024**3:.2f}GB)"
+                    )
+
+                if total_size > self.max_size:
+                    logger.warning(
+                        f"이번 실행에서 쓰는 preprocess cache만 {total_size / 1024**3:.2f}GB라서 "
+                        f"max_size({self.max_size / 1024**3:.2f}GB)를 넘음."
+                    )
+
+            self._save_index(index)
+
+        return evicted_ls
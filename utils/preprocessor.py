@@ -1,10 +1,11 @@
 import math
 import re
-from typing import Callable, Literal, Optional
+from typing import Callable, List, Literal, Optional, Tuple, Union
 from unicodedata import normalize
 
 import librosa
 import numpy as np
+import torch
 from kss import Kss
 
 from transformers import PretrainedConfig
@@ -286,6 +287,135 @@ def librosa_silence_filter(audio: np.ndarray, filter_decibel: int = 30) -> np.nd
     return filtered_audio
 
 
+def get_non_silent_intervals(
+    audio_ls: List[np.ndarray],
+    top_db: int = 30,
+    frame_length: int = 2048,
+    hop_length: int = 512,
+) -> List[np.ndarray]:
+    """
+    `librosa.effects.split`(ref=np.max)을 여러 waveform에 한 번에 돌리는 numpy 구현. STFT 없이 framed RMS를 바로 계산 함.
+    waveform 마다 `frame_length // 2` 만큼 zero padding한 segment를 hop_length 단위로 이어 붙인 buffer 하나를 만들고,
+    `gcd(frame_length, hop_length)` 크기 block의 제곱합에 strided view를 씌워 모든 frame의 power를 한 번에 구함.
+    반환 값은 waveform 마다 librosa와 같은 `(num_intervals, 2)` sample 단위 `(start, end)` 배열.
+    """
+    pad_length = frame_length // 2
+    block_length = math.gcd(frame_length, hop_length)
+
+    length_ls = np.array([audio.shape[-1] for audio in audio_ls], dtype=np.int64)
+    frame_num_ls = np.maximum(1 + (length_ls + 2 * pad_length - frame_length) // hop_length, 0)
+    segment_length_ls = -(-(length_ls + 2 * pad_length) // hop_length) * hop_length
+    segment_offset_ls = np.concatenate([[0], np.cumsum(segment_length_ls)])
+
+    dtype = np.result_type(np.float32, *[audio.dtype for audio in audio_ls]) if audio_ls else np.float32
+    buffer = np.zeros(segment_offset_ls[-1] + frame_length, dtype=dtype)
+    for audio, offset in zip(audio_ls, segment_offset_ls):
+        np.square(audio, out=buffer[offset + pad_length : offset + pad_length + audio.shape[-1]])
+
+    # NOTE: frame 하나는 block (frame_length // block_length)개, frame 간격은 block (hop_length // block_length)개.
+    block_power = buffer[: len(buffer) // block_length * block_length].reshape(-1, block_length).sum(-1)
+    frame_view = np.lib.stride_tricks.sliding_window_view(block_power, frame_length // block_length)
+    frame_power = frame_view[:: hop_length // block_length].sum(-1) / frame_length
+
+    # NOTE: segment가 hop_length 단위로 정렬되어 있어서 waveform의 k번째 frame은 (offset // hop_length + k)번째 frame.
+    frame_start_ls = np.cumsum(frame_num_ls) - frame_num_ls
+    frame_idx = np.arange(frame_num_ls.sum()) - np.repeat(
+        frame_start_ls - segment_offset_ls[:-1] // hop_length, frame_num_ls
+    )
+    frame_power = frame_power[frame_idx]
+
+    # NOTE: librosa.amplitude_to_db와 같이 amin(1e-5)의 제곱으로 clip 하고 waveform 별 최댓값을 ref로 씀.
+    frame_db = 10.0 * np.log10(np.maximum(frame_power, 1e-10))
+    ref_db = np.maximum.reduceat(frame_db, frame_start_ls[frame_num_ls > 0]) if len(frame_db) else frame_db
+    non_silent = frame_db > np.repeat(ref_db, frame_num_ls[frame_num_ls > 0]) - top_db
+
+    interval_ls = list()
+    for length, frame_start, frame_num in zip(length_ls, frame_start_ls, frame_num_ls):
+        edges = np.flatnonzero(np.diff(non_silent[frame_start : frame_start + frame_num], prepend=False, append=False))
+        edges = np.minimum(edges * hop_length, length)
+        interval_ls.append(edges.reshape(-1, 2))
+
+    return interval_ls
+
+
+def batched_silence_filter(
+    audio_ls: List[np.ndarray],
+    filter_decibel: int = 30,
+    return_intervals: bool = False,
+) -> List[np.ndarray]:
+    """
+    `librosa_silence_filter`의 batch 버전. `return_intervals`면 waveform은 건드리지 않고 `get_non_silent_intervals`의 결과만 반환 함.
+    구간이 하나면 slice view를 반환하기 때문에 waveform이 복사되지 않음.
+    """
+    interval_ls = get_non_silent_intervals(audio_ls, top_db=filter_decibel)
+    if return_intervals:
+        return interval_ls
+
+    filtered_audio_ls = list()
+    for audio, intervals in zip(audio_ls, interval_ls):
+        if len(intervals) == 1:
+            start, end = intervals[0]
+            filtered_audio_ls.append(audio[start:end])
+        else:
+            filtered_audio_ls.append(np.concatenate([audio[start:end] for start, end in intervals] or [audio[:0]]))
+
+    return filtered_audio_ls
+
+
+# NOTE: soundfile이 PCM_16을 k / 32768로 decode 하기 때문에 같은 scale을 쓰면 int16으로 그대로 돌아감.
+INT16_AUDIO_SCALE = 32768
+
+
+def compress_input_values(
+    audio: np.ndarray,
+    storage_dtype: Literal["int16", "float16"] = "int16",
+    do_normalize: bool = True,
+) -> Tuple[np.ndarray, float, float]:
+    """
+    normalize 하지 않은 audio를 `storage_dtype`으로 줄여서 저장하기 위한 값 `(input_values, mean, std)`를 반환 함.
+    mean/std는 Wav2Vec2FeatureExtractor.zero_mean_unit_var_norm과 같은 float32 값이라서 `restore_input_values`의 결과는
+    processor의 `input_values`와 같음. int16은 PCM_16 파일을 원래 sampling rate 그대로 decode 한 audio일 때만 bit 단위로 같음.
+    resample 됐거나 원본이 24bit/float면 int16으로 반올림 하면서 1/65536 이내의 오차가 생기고, float16은 항상 손실이 있음.
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    if do_normalize:
+        mean, std = audio.mean(), np.sqrt(audio.var() + 1e-7)
+    else:
+        mean, std = 0.0, 1.0
+
+    if storage_dtype == "int16":
+        input_values = np.clip(np.round(audio * INT16_AUDIO_SCALE), -32768, 32767).astype(np.int16)
+    elif storage_dtype == "float16":
+        input_values = audio.astype(np.float16)
+    else:
+        raise ValueError(f"storage_dtype은 int16, float16 중 하나여야 함. 입력: {storage_dtype}")
+
+    return input_values, float(np.float32(mean)), float(np.float32(std))
+
+
+def restore_input_values(
+    input_values: Union[np.ndarray, torch.Tensor],
+    mean: Union[float, torch.Tensor],
+    std: Union[float, torch.Tensor],
+) -> Union[np.ndarray, torch.Tensor]:
+    """
+    `compress_input_values`로 저장한 값을 collator에서 float32로 되돌리고 zero-mean/unit-variance normalize 함.
+    """
+    # NOTE: datasets의 pt/np format은 int16 column도 int64로 꺼내기 때문에 정수형이면 int16으로 저장된 것으로 봄.
+    mean, std = float(mean), float(std)
+    if isinstance(input_values, torch.Tensor):
+        audio = input_values.to(torch.float32)
+        is_int16 = not input_values.is_floating_point()
+    else:
+        input_values = np.asarray(input_values)
+        audio = input_values.astype(np.float32)
+        is_int16 = np.issubdtype(input_values.dtype, np.integer)
+
+    if is_int16:
+        audio = audio / INT16_AUDIO_SCALE
+    return (audio - mean) / std
+
+
 def sentence_normalizer(sentence: str) -> str:
     # KsponSpeech 기준
     # 자/ 몸짱 열풍 다이어트에 성공하겠다.\xa0(5)/(오) 위 였구요.
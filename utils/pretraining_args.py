@@ -5,6 +5,8 @@ from typing import List, Optional, Union
 
 from transformers import TrainingArguments
 
+from .packing import PackingStrategyType
+
 
 @dataclass
 class Wav2Vec2PretrainingArguments(TrainingArguments):
@@ -64,6 +66,12 @@ class Wav2Vec2PretrainingArguments(TrainingArguments):
         default=None,
         metadata={"help": "Where do you want to store the pretrained models downloaded from huggingface.co"},
     )
+    preprocess_cache_max_size_gb: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Disk budget (GB) for the preprocessing map/filter caches in cache_dir. When exceeded, caches not used by the current run are deleted in least-recently-used order. None keeps every cache."
+        },
+    )
 
     # model
     model_name_or_path: str = field(
@@ -112,6 +120,24 @@ class Wav2Vec2PretrainingArguments(TrainingArguments):
         default=16000,
         metadata={"help": ""},
     )
+    scan_audio_length: bool = field(
+        default=False,
+        metadata={
+            "help": "Read sample counts from the WAV headers before preprocessing and drop utterances shorter than `min_duration_in_seconds` without decoding them."
+        },
+    )
+    input_values_storage_dtype: str = field(
+        default="float32",
+        metadata={
+            "help": "Dtype of `input_values` stored in the preprocessing cache: float32, int16 or float16. With int16/float16 the un-normalized audio is stored with per-utterance mean/std and normalized in the collator. int16 is lossless only for PCM_16 audio decoded at its native sampling rate; resampled audio is rounded to 16 bits."
+        },
+    )
+    preprocess_mode: str = field(
+        default="cached",
+        metadata={
+            "help": "cached: run the preprocessor with datasets.map and keep the Arrow caches. lazy: only build a length index from the WAV headers and run silence trimming and normalization with set_transform in the DataLoader workers. For quick experiments."
+        },
+    )
     packing_max_seq_len: int = field(
         default=512,
         metadata={"help": ""},
@@ -120,10 +146,60 @@ class Wav2Vec2PretrainingArguments(TrainingArguments):
         default=10,
         metadata={"help": ""},
     )
+    packing_pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "With `do_packing`, pad each batch of packs to a multiple of this many feature frames (capped at `packing_max_seq_len`). Unlike `pad_to_multiple_of`, which counts raw audio samples, this counts frames after the CNN feature encoder."
+        },
+    )
     do_packing: bool = field(
         default=False,
         metadata={"help": ""},
     )
+    packing_strategy: Union[PackingStrategyType, str] = field(
+        default="histogram",
+        metadata={"help": "The packing algorithm to use: histogram, first_fit_decreasing or best_fit_decreasing."},
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": "Load datasets as streaming IterableDataset. With `do_packing`, packs are built online and `max_steps` must be set."
+        },
+    )
+    packing_buffer_size: int = field(
+        default=1000,
+        metadata={"help": "Maximum number of utterances waiting in open packs for online packing."},
+    )
+    contrastive_loss_chunk_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Number of masked frames per chunk in the packed contrastive loss. Bounds peak memory of the negatives, computed in one chunk if omitted."
+        },
+    )
+    sample_mask_on_device: bool = field(
+        default=False,
+        metadata={
+            "help": "Sample span masks and negatives with torch on the model device in the trainer instead of with NumPy in the collator. Only used without `do_packing`."
+        },
+    )
+    profile_step_timing: bool = field(
+        default=False,
+        metadata={
+            "help": "Record data wait, forward, grad rescale, backward and optimizer time of every step with throughput and pack fill ratio. Written to `step_timing.jsonl` in output_dir and averaged into the training logs."
+        },
+    )
+    torch_profiler_start_step: Optional[int] = field(
+        default=None,
+        metadata={"help": "Global step from which a torch.profiler trace is recorded. No trace if omitted."},
+    )
+    torch_profiler_num_steps: int = field(
+        default=3,
+        metadata={"help": "Number of steps recorded in the torch.profiler trace."},
+    )
+    torch_profiler_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Where to write the torch.profiler trace. Defaults to `output_dir/torch_profiler`."},
+    )
 
     def __post_init__(self):
         super().__post_init__()
@@ -135,3 +211,25 @@ class Wav2Vec2PretrainingArguments(TrainingArguments):
         self.test_dataset_prefix = self.test_dataset_prefix if self.test_dataset_prefix else []
 
         self.cache_dir = Path(self.cache_dir) if self.cache_dir else None
+        self.packing_strategy = PackingStrategyType(self.packing_strategy)
+
+        if self.input_values_storage_dtype not in ("float32", "int16", "float16"):
+            raise ValueError(
+                f"input_values_storage_dtype은 float32, int16, float16 중 하나여야 함. 입력: {self.input_values_storage_dtype}"
+            )
+
+        if self.input_values_storage_dtype != "float32":
+            # NOTE: input_values_mean/std는 model 인자가 아니라서 HF Trainer가 지우면 collator에서 normalize를 못 함.
+            self.remove_unused_columns = False
+
+        if self.preprocess_mode not in ("cached", "lazy"):
+            raise ValueError(f"preprocess_mode은 cached, lazy 중 하나여야 함. 입력: {self.preprocess_mode}")
+
+        if self.preprocess_mode == "lazy" and (self.do_packing or self.streaming):
+            # NOTE: packing은 trim 된 길이로 pack을 만들어야 하고, streaming은 이미 on-the-fly로 preprocess 함.
+            raise ValueError("lazy preprocess_mode는 do_packing, streaming과 같이 쓸 수 없음.")
+
+        if self.preprocess_mode == "lazy":
+            # NOTE: lazy면 dataset에 audio 같은 원본 column만 있고 input_values는 transform에서 만들어짐.
+            #       HF Trainer가 model 인자에 없는 column을 지우면 transform이 audio를 받을 수 없음.
+            self.remove_unused_columns = False
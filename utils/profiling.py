@@ -0,0 +1,149 @@
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+import torch
+
+from transformers import TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+from transformers.utils import logging
+
+
+logger = logging.get_logger(__name__)
+
+PROFILE_PHASES = ("log_save_evaluate", "data_wait", "forward", "grad_rescale", "backward", "optimizer")
+
+
+class PretrainingProfilerCallback(TrainerCallback):
+    """
+    Wav2Vec2Pretrainer의 step을 구간 별로 나눠서 시간을 재는 callback.
+    trainer가 구간이 끝날 때마다 `mark(phase)`를 부르면 직전 mark 부터의 시간이 그 구간에 더해짐.
+    on_step_end에서 optimizer 구간을 닫고 step 하나의 기록을 `step_timing.jsonl`에 남김.
+    logging 할 때는 trainer가 `pop_interval_logs()`로 구간 평균 시간(ms)과 처리량을 받아서 log에 같이 남김.
+
+    `torch_profiler_start_step`이 있으면 그 step 부터 `torch_profiler_num_steps` step 동안 torch.profiler trace를 남김.
+    """
+
+    def __init__(
+        self,
+        sampling_rate: int = 16000,
+        torch_profiler_start_step: Optional[int] = None,
+        torch_profiler_num_steps: int = 3,
+        torch_profiler_dir: Optional[str] = None,
+    ) -> None:
+        self.sampling_rate = sampling_rate
+        self.torch_profiler_start_step = torch_profiler_start_step
+        self.torch_profiler_num_steps = torch_profiler_num_steps
+        self.torch_profiler_dir = torch_profiler_dir
+
+        self.synchronize_cuda = False
+        self.step_timing_path = None
+        self.torch_profiler = None
+
+        self.last_mark_time = None
+        self.step_times = defaultdict(float)
+        self.step_counts = defaultdict(int)
+        self.interval_times = defaultdict(float)
+        self.interval_counts = defaultdict(int)
+        self.interval_steps = 0
+
+    def mark(self, phase: str) -> None:
+        # NOTE: CUDA는 kernel이 비동기로 돌기 때문에 sync를 하지 않으면 실제 GPU 시간이 다음 구간으로 넘어감.
+        if self.synchronize_cuda:
+            torch.cuda.synchronize()
+
+        now = time.perf_counter()
+        if self.last_mark_time is not None:
+            self.step_times[phase] += now - self.last_mark_time
+        self.last_mark_time = now
+
+    def add_batch(self, audio_samples: int, feature_frames: int, frame_capacity: int) -> None:
+        self.step_counts["audio_samples"] += audio_samples
+        self.step_counts["feature_frames"] += feature_frames
+        self.step_counts["frame_capacity"] += frame_capacity
+
+    def pop_interval_logs(self) -> Dict[str, float]:
+        if not self.interval_steps:
+            return {}
+
+        interval_time = sum(self.interval_times.values())
+        logs = {
+            f"{phase}_ms": round(self.interval_times[phase] / self.interval_steps * 1000, 2)
+            for phase in PROFILE_PHASES
+        }
+        logs["step_ms"] = round(interval_time / self.interval_steps * 1000, 2)
+        if interval_time > 0:
+            logs["audio_sec_per_sec"] = round(
+                self.interval_counts["audio_samples"] / self.sampling_rate / interval_time, 2
+            )
+            logs["frames_per_sec"] = round(self.interval_counts["feature_frames"] / interval_time, 2)
+        if self.interval_counts["frame_capacity"]:
+            logs["pack_fill_ratio"] = round(
+                self.interval_counts["feature_frames"] / self.interval_counts["frame_capacity"], 4
+            )
+
+        self.interval_times.clear()
+        self.interval_counts.clear()
+        self.interval_steps = 0
+        return logs
+
+    def on_train_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        self.synchronize_cuda = args.device.type == "cuda"
+        if state.is_world_process_zero:
+            os.makedirs(args.output_dir, exist_ok=True)
+            self.step_timing_path = os.path.join(args.output_dir, "step_timing.jsonl")
+
+        if self.torch_profiler_start_step is not None and self.torch_profiler_start_step >= state.global_step:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+            torch_profiler_dir = self.torch_profiler_dir or os.path.join(args.output_dir, "torch_profiler")
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    # NOTE: schedule은 on_step_end 마다 한 칸씩 가고, 바로 앞 step 하나를 warmup으로 씀.
+                    wait=max(self.torch_profiler_start_step - state.global_step - 2, 0),
+                    warmup=1,
+                    active=self.torch_profiler_num_steps,
+                    repeat=1,
+                ),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    torch_profiler_dir, worker_name=f"rank{args.process_index}"
+                ),
+                record_shapes=True,
+                with_stack=False,
+            )
+            self.torch_profiler.start()
+            logger.info(f"torch.profiler trace가 {torch_profiler_dir}에 저장 됨.")
+
+        self.last_mark_time = None
+        self.mark("data_wait")
+
+    def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        self.mark("optimizer")
+
+        step_time = sum(self.step_times.values())
+        record = {"step": state.global_step, "step_ms": round(step_time * 1000, 3)}
+        record.update({f"{phase}_ms": round(self.step_times[phase] * 1000, 3) for phase in PROFILE_PHASES})
+        record.update(self.step_counts)
+        if self.step_timing_path is not None:
+            with open(self.step_timing_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        for phase, phase_time in self.step_times.items():
+            self.interval_times[phase] += phase_time
+        for name, count in self.step_counts.items():
+            self.interval_counts[name] += count
+        self.interval_steps += 1
+        self.step_times.clear()
+        self.step_counts.clear()
+
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def on_train_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
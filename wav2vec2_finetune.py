@@ -10,9 +10,13 @@ from datasets import Dataset, concatenate_datasets, load_dataset
 from evaluate import load
 from setproctitle import setproctitle
 from utils import (
+    PreprocessCacheManager,
     Wav2Vec2FinetuningArguments,
+    batched_silence_filter,
+    compress_input_values,
     get_feat_extract_output_lengths,
-    librosa_silence_filter,
+    get_preprocess_fingerprint,
+    scan_audio_length,
     sentence_normalizer,
     set_scheduler,
 )
@@ -40,26 +44,34 @@ def main(train_args: Wav2Vec2FinetuningArguments) -> None:
     def preprocessor(example):
         sentence_ls = example[train_args.sentence_column_name]
         audio_ls = example[train_args.audio_column_name]
+        audio_ls = batched_silence_filter([audio["array"] for audio in audio_ls])
 
         finish_label_ls, finish_audio_ls, finish_length_ls = list(), list(), list()
+        finish_mean_ls, finish_std_ls = list(), list()
         for sentence, audio in zip(sentence_ls, audio_ls):
-            audio, sentence = librosa_silence_filter(audio["array"]), sentence_normalizer(sentence)
+            sentence = sentence_normalizer(sentence)
 
             if not audio.any() or not sentence:
                 continue
 
-            outputs = processor(
-                text=sentence,
-                audio=audio,
-                sampling_rate=train_args.sampling_rate,
-                return_tensors="np",
-            )
-
-            labels, input_values, length = (
-                outputs["input_ids"][0],
-                outputs["input_values"][0],
-                outputs["input_values"][0].shape[0],
-            )
+            if train_args.input_values_storage_dtype == "float32":
+                outputs = processor(
+                    text=sentence,
+                    audio=audio,
+                    sampling_rate=train_args.sampling_rate,
+                    return_tensors="np",
+                )
+                input_values = outputs["input_values"][0]
+            else:
+                # NOTE: normalize는 collator에서 함. 여기선 int16/float16 audio와 mean/std만 저장 함.
+                outputs = processor(text=sentence, return_tensors="np")
+                input_values, mean, std = compress_input_values(
+                    audio,
+                    train_args.input_values_storage_dtype,
+                    do_normalize=processor.feature_extractor.do_normalize,
+                )
+
+            labels, length = outputs["input_ids"][0], input_values.shape[0]
 
             # NOTE: for CTC loss
             if len(sentence) > get_feat_extract_output_lengths(length, config):
@@ -68,12 +80,65 @@ def main(train_args: Wav2Vec2FinetuningArguments) -> None:
             finish_label_ls.append(labels)
             finish_audio_ls.append(input_values)
             finish_length_ls.append(length)
+            if train_args.input_values_storage_dtype != "float32":
+                finish_mean_ls.append(mean)
+                finish_std_ls.append(std)
 
-        return {
+        outputs = {
             "input_values": finish_audio_ls,
             "labels": finish_label_ls,
             train_args.length_column_name: finish_length_ls,
         }
+        if train_args.input_values_storage_dtype != "float32":
+            outputs["input_values_mean"] = finish_mean_ls
+            outputs["input_values_std"] = finish_std_ls
+        return outputs
+
+    def lazy_preprocessor(example):
+        # NOTE: dataset["length"]처럼 column만 꺼낼 때도 transform이 불리기 때문에 audio가 없으면 그대로 반환 함.
+        if train_args.audio_column_name not in example:
+            return example
+
+        sentence_ls = example[train_args.sentence_column_name]
+        raw_audio_ls = [audio["array"] for audio in example[train_args.audio_column_name]]
+        audio_ls = batched_silence_filter(raw_audio_ls)
+
+        finish_label_ls, finish_audio_ls = list(), list()
+        for sentence, raw_audio, audio in zip(sentence_ls, raw_audio_ls, audio_ls):
+            sentence = sentence_normalizer(sentence)
+
+            # NOTE: lazy_index_filter는 trim 전 길이로 CTC 길이를 검사 함. trim 후에 CTC가 안 될 만큼 짧아지면
+            #       row를 버릴 수 없으니 검사를 통과한 trim 전 audio를 그대로 씀.
+            if not audio.any() or len(sentence) > get_feat_extract_output_lengths(audio.shape[0], config):
+                audio = raw_audio
+
+            outputs = processor(
+                text=sentence,
+                audio=audio,
+                sampling_rate=train_args.sampling_rate,
+                return_tensors="np",
+            )
+            finish_label_ls.append(outputs["input_ids"][0])
+            finish_audio_ls.append(outputs["input_values"][0])
+
+        return {
+            "input_values": finish_audio_ls,
+            "labels": finish_label_ls,
+            train_args.length_column_name: [audio.shape[0] for audio in finish_audio_ls],
+        }
+
+    def lazy_index_filter(sentence_ls, length_ls):
+        # NOTE: lazy에선 row를 버릴 수 없어서 문장 normalize와 CTC 길이 검사는 index를 만들 때 미리 함.
+        #       length는 silence trim 전 header 길이라서, trim 후 CTC 길이는 lazy_preprocessor에서 다시 확인 함.
+        is_keep_ls = list()
+        for sentence, length in zip(sentence_ls, length_ls):
+            sentence = sentence_normalizer(sentence)
+            is_keep_ls.append(
+                bool(sentence)
+                and train_args.min_duration_in_seconds <= length <= train_args.max_duration_in_seconds
+                and len(sentence) <= get_feat_extract_output_lengths(length, config)
+            )
+        return is_keep_ls
 
     def length_filter(length_ls):
         return [
@@ -82,6 +147,28 @@ def main(train_args: Wav2Vec2FinetuningArguments) -> None:
 
     def prepare_datasets() -> Tuple[Optional[Dataset], Optional[Dataset], Optional[Dataset]]:
         train_dataset_ls, valid_dataset_ls, test_dataset_ls = list(), list(), list()
+
+        cache_manager = None
+        if train_args.cache_file_name:
+            cache_manager = PreprocessCacheManager(
+                train_args.cache_dir,
+                train_args.cache_file_name,
+                max_size_gb=train_args.preprocess_cache_max_size_gb,
+            )
+        preprocess_kwargs = {
+            "audio_column_name": train_args.audio_column_name,
+            "sentence_column_name": train_args.sentence_column_name,
+            "length_column_name": train_args.length_column_name,
+            "sampling_rate": train_args.sampling_rate,
+            "input_values_storage_dtype": train_args.input_values_storage_dtype,
+            # NOTE: CTC 길이로 거르는 데 쓰임.
+            "conv_kernel": config.conv_kernel,
+            "conv_stride": config.conv_stride,
+            "add_adapter": config.add_adapter,
+            "num_adapter_layers": config.num_adapter_layers,
+            "adapter_stride": config.adapter_stride,
+        }
+
         for repo_name in train_args.dataset_repo_ls:
             start_time = time.time()
 
@@ -93,42 +180,76 @@ def main(train_args: Wav2Vec2FinetuningArguments) -> None:
 
             datasets = load_dataset(repo_name, data_name)
 
-            map_cache_file_name = None
-            filter_cache_file_name = None
-            if train_args.cache_file_name:
-                name = repo_name.split("/")[-1]
-                map_cache_file_name = {
-                    x: train_args.cache_dir.joinpath(f"map_{name}-{x}_{train_args.cache_file_name}").as_posix()
-                    for x in datasets
-                }
-                filter_cache_file_name = {
-                    x: train_args.cache_dir.joinpath(
-                        f"filter_{train_args.min_duration_in_seconds}-{train_args.max_duration_in_seconds}_{name}-{x}_{train_args.cache_file_name}"
-                    ).as_posix()
-                    for x in datasets
-                }
-
-            # DatasetsDict이라서 이런식으로 해줘야 함.
-            datasets = datasets.map(
-                preprocessor,
-                num_proc=train_args.preprocessing_num_workers,
-                load_from_cache_file=True,
-                batched=train_args.preprocessing_batched,
-                cache_file_names=map_cache_file_name,
-                batch_size=train_args.preprocessing_batch_size,
-                remove_columns=set(sum(datasets.column_names.values(), [])),
-                desc=f"preprocess-{repo_name}",
-            )
+            if train_args.scan_audio_length or train_args.preprocess_mode == "lazy":
+                # NOTE: decode 하기 전에 header 길이로 짧은 건 미리 버림. lazy면 이게 length index가 됨.
+                for split in datasets:
+                    datasets[split] = scan_audio_length(
+                        datasets[split],
+                        audio_column_name=train_args.audio_column_name,
+                        length_column_name=train_args.length_column_name,
+                        sampling_rate=train_args.sampling_rate,
+                        min_length=train_args.min_duration_in_seconds,
+                        batch_size=train_args.preprocessing_batch_size,
+                        num_proc=train_args.preprocessing_num_workers,
+                    )
 
-            datasets = datasets.filter(
-                length_filter,
-                num_proc=train_args.preprocessing_num_workers,
-                input_columns=[train_args.length_column_name],
-                cache_file_names=filter_cache_file_name,
-                batched=train_args.preprocessing_batched,
-                batch_size=train_args.preprocessing_batch_size,
-                desc=f"length-filtering-{repo_name}",
-            )
+            if train_args.preprocess_mode == "lazy":
+                # NOTE: map cache를 만들지 않고 header 길이와 문장으로만 거름.
+                #       repo 마다 column이 달라서 concatenate 할 수 있도록 transform에 필요한 column만 남김.
+                datasets = datasets.select_columns(
+                    [train_args.audio_column_name, train_args.sentence_column_name, train_args.length_column_name]
+                )
+                datasets = datasets.filter(
+                    lazy_index_filter,
+                    input_columns=[train_args.sentence_column_name, train_args.length_column_name],
+                    batched=True,
+                    batch_size=train_args.preprocessing_batch_size,
+                    num_proc=train_args.preprocessing_num_workers,
+                    desc=f"length-filtering-{repo_name}",
+                )
+            else:
+                map_cache_file_name = None
+                filter_cache_file_name = None
+                fingerprint_map = dict()
+                if cache_manager is not None:
+                    # NOTE: 입력 dataset, preprocess 코드, processor 설정, 관련 인자가 하나라도 바뀌면 다른 cache를 사용 함.
+                    map_cache_file_name, filter_cache_file_name = dict(), dict()
+                    for split in datasets:
+                        fingerprint_map[split] = get_preprocess_fingerprint(
+                            datasets[split], preprocessor, processor, preprocess_kwargs
+                        )
+                        map_cache_file_name[split], filter_cache_file_name[split] = cache_manager.get_cache_file_names(
+                            repo_name,
+                            split,
+                            fingerprint_map[split],
+                            train_args.min_duration_in_seconds,
+                            train_args.max_duration_in_seconds,
+                        )
+
+                # DatasetsDict이라서 이런식으로 해줘야 함.
+                datasets = datasets.map(
+                    preprocessor,
+                    num_proc=train_args.preprocessing_num_workers,
+                    load_from_cache_file=True,
+                    batched=train_args.preprocessing_batched,
+                    cache_file_names=map_cache_file_name,
+                    batch_size=train_args.preprocessing_batch_size,
+                    remove_columns=set(sum(datasets.column_names.values(), [])),
+                    desc=f"preprocess-{repo_name}",
+                )
+
+                datasets = datasets.filter(
+                    length_filter,
+                    num_proc=train_args.preprocessing_num_workers,
+                    input_columns=[train_args.length_column_name],
+                    cache_file_names=filter_cache_file_name,
+                    batched=train_args.preprocessing_batched,
+                    batch_size=train_args.preprocessing_batch_size,
+                    desc=f"length-filtering-{repo_name}",
+                )
+
+                for split, fingerprint in fingerprint_map.items():
+                    cache_manager.register(fingerprint, repo_name, split)
 
             for data_type in truncate_map:
                 truncate_size = truncate_map[data_type]
@@ -168,24 +289,36 @@ def main(train_args: Wav2Vec2FinetuningArguments) -> None:
                         f"{dataset_key}_total_hour: {(sum(length_ls) / train_args.sampling_rate) / 60**2:.2f}h"
                     )
 
+        if cache_manager is not None and is_main_process(train_args.local_rank):
+            cache_manager.evict()
+
         train_dataset = None
         if train_dataset_ls:
             train_dataset = concatenate_datasets(train_dataset_ls)
-            train_dataset.set_format("pt")
+            if train_args.preprocess_mode == "lazy":
+                train_dataset.set_transform(lazy_preprocessor)
+            else:
+                train_dataset.set_format("pt")
             if is_main_process(train_args.local_rank):
                 logger.info(f"train_dataset:\n{train_dataset}")
 
         valid_dataset = None
         if valid_dataset_ls:
             valid_dataset = concatenate_datasets(valid_dataset_ls)
-            valid_dataset.set_format("pt")
+            if train_args.preprocess_mode == "lazy":
+                valid_dataset.set_transform(lazy_preprocessor)
+            else:
+                valid_dataset.set_format("pt")
             if is_main_process(train_args.local_rank):
                 logger.info(f"valid_dataset:\n{valid_dataset}")
 
         test_dataset = None
         if test_dataset_ls:
             test_dataset = concatenate_datasets(test_dataset_ls)
-            test_dataset.set_format("pt")
+            if train_args.preprocess_mode == "lazy":
+                test_dataset.set_transform(lazy_preprocessor)
+            else:
+                test_dataset.set_format("pt")
             if is_main_process(train_args.local_rank):
                 logger.info(f"test_dataset:\n{test_dataset}")
 
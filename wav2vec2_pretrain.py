@@ -1,18 +1,26 @@
 import os
 import time
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 
 import torch
-from data import DataCollatorForWav2Vec2Pretraining, PackingCollator
-from datasets import Dataset, concatenate_datasets, load_dataset, load_from_disk
+from data import DataCollatorForWav2Vec2Pretraining, PackedDatasetView, PackingCollator
+from datasets import Dataset, IterableDataset, concatenate_datasets, load_dataset
 from models import PackedWav2Vec2ForPreTraining
 from setproctitle import setproctitle
 from utils import (
+    PreprocessCacheManager,
+    PretrainingProfilerCallback,
     Wav2Vec2PretrainingArguments,
+    batched_silence_filter,
+    compress_input_values,
     get_feat_extract_output_lengths,
     get_packing_dataset_idx,
-    get_packing_strategies,
-    librosa_silence_filter,
+    get_packing_fingerprint,
+    get_packing_strategy_function,
+    get_preprocess_fingerprint,
+    load_packing_idx_cache,
+    online_packing,
+    scan_audio_length,
 )
 from wav2vec2_pretrainer import Wav2Vec2Pretrainer
 
@@ -34,103 +42,149 @@ logger = hf_logging.get_logger("transformers")
 def main(train_args: Wav2Vec2PretrainingArguments) -> None:
     def preprocessor(example):
         audio_ls = example[train_args.audio_column_name]
+        audio_ls = batched_silence_filter([audio["array"] for audio in audio_ls])
 
         finish_length_ls, finish_audio_ls = list(), list()
+        finish_mean_ls, finish_std_ls = list(), list()
         for audio in audio_ls:
-            audio = librosa_silence_filter(audio["array"])
-
             if not audio.any():
                 continue
 
-            outputs = processor(audio=audio, sampling_rate=train_args.sampling_rate, return_tensors="np")
-            audio, length = outputs["input_values"][0], outputs["input_values"][0].shape[0]
+            if train_args.input_values_storage_dtype == "float32":
+                outputs = processor(audio=audio, sampling_rate=train_args.sampling_rate, return_tensors="np")
+                audio = outputs["input_values"][0]
+            else:
+                # NOTE: normalize는 collator에서 함. 여기선 int16/float16 audio와 mean/std만 저장 함.
+                audio, mean, std = compress_input_values(
+                    audio,
+                    train_args.input_values_storage_dtype,
+                    do_normalize=processor.feature_extractor.do_normalize,
+                )
+                finish_mean_ls.append(mean)
+                finish_std_ls.append(std)
 
             finish_audio_ls.append(audio)
-            finish_length_ls.append(length)
+            finish_length_ls.append(audio.shape[0])
 
         outputs = {
             "input_values": finish_audio_ls,
             train_args.length_column_name: finish_length_ls,
         }
+        if train_args.input_values_storage_dtype != "float32":
+            outputs["input_values_mean"] = finish_mean_ls
+            outputs["input_values_std"] = finish_std_ls
         return outputs
 
+    def lazy_preprocessor(example):
+        # NOTE: dataset["length"]처럼 column만 꺼낼 때도 transform이 불리기 때문에 audio가 없으면 그대로 반환 함.
+        if train_args.audio_column_name not in example:
+            return example
+
+        audio_ls = example[train_args.audio_column_name]
+        audio_ls = batched_silence_filter([audio["array"] for audio in audio_ls])
+
+        # NOTE: row를 버릴 수 없어서 cached와 달리 무음(all zero) audio도 그대로 씀.
+        finish_audio_ls = list()
+        for audio in audio_ls:
+            outputs = processor(audio=audio, sampling_rate=train_args.sampling_rate, return_tensors="np")
+            finish_audio_ls.append(outputs["input_values"][0])
+
+        return {
+            "input_values": finish_audio_ls,
+            train_args.length_column_name: [audio.shape[0] for audio in finish_audio_ls],
+        }
+
     def length_filter(length_ls):
         return [
             train_args.min_duration_in_seconds <= length <= train_args.max_duration_in_seconds for length in length_ls
         ]
 
-    def packing_datasets(dataset: Dataset, split: str) -> Dataset:
+    def packing_datasets(
+        dataset: Union[Dataset, IterableDataset], split: str
+    ) -> Union[PackedDatasetView, IterableDataset]:
+        if isinstance(dataset, IterableDataset):
+            # NOTE: streaming일 땐 전체 length를 알 수 없으니 online으로 packing 함.
+            packing_dataset = IterableDataset.from_generator(
+                online_packing,
+                gen_kwargs={
+                    "dataset": dataset,
+                    "config": config,
+                    "max_seq_len": train_args.packing_max_seq_len,
+                    "max_seq_per_pack": train_args.packing_max_elem,
+                    "buffer_size": train_args.packing_buffer_size,
+                    "length_column_name": train_args.length_column_name,
+                },
+            )
+            return packing_dataset.with_format("pt")
+
         def get_pack_length(length_ls):
             return {"pack_length": [get_feat_extract_output_lengths(length, config) for length in length_ls]}
 
-        def packing_data_sample(packing_ls: List[List[int]], feat_length_ls: List[int], dataset: Dataset):
-            finish_pack_audio_ls, finish_split_idx_ls, finish_length_ls, finish_feat_split_idx_ls = (
-                list(),
-                list(),
-                list(),
-                list(),
+        def build_packing_idx() -> Dataset:
+            pack_length_dataset = dataset.map(
+                get_pack_length,
+                num_proc=train_args.preprocessing_num_workers,
+                batch_size=train_args.preprocessing_batch_size,
+                keep_in_memory=True,
+                batched=True,
+                remove_columns="length",
+                input_columns="length",
             )
-            for pack, feat in zip(packing_ls, feat_length_ls):
-                sampled_pack = dataset.select(pack)
-                pack_audio = sampled_pack["input_values"]
-                pack_length = sampled_pack["length"]
-
-                finish_pack_audio_ls.append(pack_audio)
-                finish_split_idx_ls.append(pack_length)
-                finish_feat_split_idx_ls.append(feat)
-                finish_length_ls.append(sum(pack_length))
-
-            return {
-                "input_values": finish_pack_audio_ls,
-                "split_idx": finish_split_idx_ls,
-                "length": finish_length_ls,
-                "feat_split_idx": finish_feat_split_idx_ls,
-            }
 
+            length_ls = pack_length_dataset["pack_length"]
+            strategies_per_length = get_packing_strategy_function(train_args.packing_strategy)(
+                length_ls,
+                train_args.packing_max_seq_len,
+                train_args.packing_max_elem,
+            )
+            return get_packing_dataset_idx(length_ls, strategies_per_length)
+
+        # NOTE: 입력 dataset과 packing에 영향을 주는 인자가 하나라도 바뀌면 다른 cache를 사용 함.
+        packing_fingerprint = get_packing_fingerprint(
+            dataset,
+            {
+                "split": split,
+                "packing_strategy": train_args.packing_strategy.value,
+                "packing_max_seq_len": train_args.packing_max_seq_len,
+                "packing_max_elem": train_args.packing_max_elem,
+                "min_duration_in_seconds": train_args.min_duration_in_seconds,
+                "max_duration_in_seconds": train_args.max_duration_in_seconds,
+                "data_truncate_map": train_args.data_truncate_map,
+                "conv_kernel": config.conv_kernel,
+                "conv_stride": config.conv_stride,
+                "add_adapter": config.add_adapter,
+            },
+        )
         cache_name = "_".join(sorted(x.split("/")[1] for x in train_args.dataset_repo_ls))
-        cache_path = train_args.cache_dir.joinpath(f"{cache_name}-packing_idx_cache")
-
-        cache_file_path = train_args.cache_dir.joinpath(f"packing_{cache_name}-{split}_{train_args.cache_file_name}")
+        cache_path = train_args.cache_dir.joinpath(f"{cache_name}-{split}-packing_idx_cache-{packing_fingerprint}")
 
         with train_args.main_process_first("packing"):
-            if not cache_path.exists():
-                pack_length_dataset = dataset.map(
-                    get_pack_length,
-                    num_proc=train_args.preprocessing_num_workers,
-                    batch_size=train_args.preprocessing_batch_size,
-                    keep_in_memory=True,
-                    batched=True,
-                    remove_columns="length",
-                    input_columns="length",
-                )
+            packing_idx_dataset = load_packing_idx_cache(cache_path, build_packing_idx)
 
-                length_ls = pack_length_dataset["pack_length"]
-                strategies_per_length = get_packing_strategies(
-                    length_ls,
-                    train_args.packing_max_seq_len,
-                    train_args.packing_max_elem,
-                )
-                packing_idx_dataset = get_packing_dataset_idx(length_ls, strategies_per_length)
-                packing_idx_dataset.save_to_disk(cache_path.as_posix())
-            else:
-                packing_idx_dataset = load_from_disk(cache_path.as_posix())
-
-        packing_dataset = packing_idx_dataset.map(
-            packing_data_sample,
-            num_proc=train_args.preprocessing_num_workers,
-            batch_size=train_args.preprocessing_batch_size,
-            load_from_cache_file=True,
-            batched=True,
-            cache_file_name=cache_file_path.as_posix(),
-            remove_columns=["packing_ls", "feat_length_ls"],
-            input_columns=["packing_ls", "feat_length_ls"],
-            fn_kwargs={"dataset": dataset},
+        # NOTE: packing된 음성을 다시 쓰지 않고, index만 들고 원본 arrow에서 lazy하게 가져옴.
+        return PackedDatasetView(
+            dataset.with_format("pt"),
+            packing_idx_dataset,
+            length_column_name=train_args.length_column_name,
         )
 
-        return packing_dataset
-
     def prepare_datasets() -> Tuple[Optional[Dataset], Optional[Dataset], Optional[Dataset]]:
         train_dataset_ls, valid_dataset_ls, test_dataset_ls = list(), list(), list()
+
+        cache_manager = None
+        if train_args.cache_file_name and not train_args.streaming:
+            cache_manager = PreprocessCacheManager(
+                train_args.cache_dir,
+                train_args.cache_file_name,
+                max_size_gb=train_args.preprocess_cache_max_size_gb,
+            )
+        preprocess_kwargs = {
+            "audio_column_name": train_args.audio_column_name,
+            "length_column_name": train_args.length_column_name,
+            "sampling_rate": train_args.sampling_rate,
+            "input_values_storage_dtype": train_args.input_values_storage_dtype,
+        }
+
         for repo_name in train_args.dataset_repo_ls:
             start_time = time.time()
 
@@ -140,47 +194,100 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
             data_name = train_args.data_name_map.get(repo_name, None)
             truncate_map = train_args.data_truncate_map.get(repo_name, {})
 
-            datasets = load_dataset(repo_name, data_name)
-
-            map_cache_file_name = None
-            filter_cache_file_name = None
-            if train_args.cache_file_name:
-                name = repo_name.split("/")[-1]
-                map_cache_file_name = {
-                    x: train_args.cache_dir.joinpath(f"map_{name}-{x}_{train_args.cache_file_name}").as_posix()
-                    for x in datasets
-                }
-                filter_cache_file_name = {
-                    x: train_args.cache_dir.joinpath(
-                        f"filter_{train_args.min_duration_in_seconds}-{train_args.max_duration_in_seconds}_{name}-{x}_{train_args.cache_file_name}"
-                    ).as_posix()
-                    for x in datasets
-                }
-
-            # DatasetsDict이라서 이런식으로 해줘야 함.
-            datasets = datasets.map(
-                preprocessor,
-                num_proc=train_args.preprocessing_num_workers,
-                load_from_cache_file=True,
-                batched=True,
-                cache_file_names=map_cache_file_name,
-                batch_size=train_args.preprocessing_batch_size,
-                remove_columns=set(sum(datasets.column_names.values(), [])),
-                desc=f"preprocess-{repo_name}",
-            )
+            datasets = load_dataset(repo_name, data_name, streaming=train_args.streaming)
+
+            if train_args.scan_audio_length or train_args.preprocess_mode == "lazy":
+                # NOTE: decode 하기 전에 header 길이로 짧은 건 미리 버림. lazy면 이게 length index가 됨.
+                for split in datasets:
+                    datasets[split] = scan_audio_length(
+                        datasets[split],
+                        audio_column_name=train_args.audio_column_name,
+                        length_column_name=train_args.length_column_name,
+                        sampling_rate=train_args.sampling_rate,
+                        min_length=train_args.min_duration_in_seconds,
+                        batch_size=train_args.preprocessing_batch_size,
+                        num_proc=None if train_args.streaming else train_args.preprocessing_num_workers,
+                    )
 
-            datasets = datasets.filter(
-                length_filter,
-                num_proc=train_args.preprocessing_num_workers,
-                input_columns=[train_args.length_column_name],
-                cache_file_names=filter_cache_file_name,
-                batched=True,
-                batch_size=train_args.preprocessing_batch_size,
-                desc=f"length-filtering-{repo_name}",
-            )
+            if train_args.preprocess_mode == "lazy":
+                # NOTE: map cache를 만들지 않고 header 길이로만 거름. silence trim 전 길이라서 max 쪽은 cached와 조금 다름.
+                #       repo 마다 column이 달라서 concatenate 할 수 있도록 transform에 필요한 column만 남김.
+                datasets = datasets.select_columns([train_args.audio_column_name, train_args.length_column_name])
+                datasets = datasets.filter(
+                    length_filter,
+                    input_columns=[train_args.length_column_name],
+                    batched=True,
+                    batch_size=train_args.preprocessing_batch_size,
+                    num_proc=train_args.preprocessing_num_workers,
+                    desc=f"length-filtering-{repo_name}",
+                )
+            else:
+                map_cache_file_name = None
+                filter_cache_file_name = None
+                fingerprint_map = dict()
+                if cache_manager is not None:
+                    # NOTE: 입력 dataset, preprocess 코드, processor 설정, 관련 인자가 하나라도 바뀌면 다른 cache를 사용 함.
+                    map_cache_file_name, filter_cache_file_name = dict(), dict()
+                    for split in datasets:
+                        fingerprint_map[split] = get_preprocess_fingerprint(
+                            datasets[split], preprocessor, processor, preprocess_kwargs
+                        )
+                        map_cache_file_name[split], filter_cache_file_name[split] = cache_manager.get_cache_file_names(
+                            repo_name,
+                            split,
+                            fingerprint_map[split],
+                            train_args.min_duration_in_seconds,
+                            train_args.max_duration_in_seconds,
+                        )
+
+                # NOTE: IterableDatasetDict는 cache, num_proc 관련 인자를 받지 않음.
+                map_kwargs, filter_kwargs = dict(), dict()
+                if not train_args.streaming:
+                    map_kwargs = {
+                        "num_proc": train_args.preprocessing_num_workers,
+                        "load_from_cache_file": True,
+                        "cache_file_names": map_cache_file_name,
+                        "desc": f"preprocess-{repo_name}",
+                    }
+                    filter_kwargs = {
+                        "num_proc": train_args.preprocessing_num_workers,
+                        "cache_file_names": filter_cache_file_name,
+                        "desc": f"length-filtering-{repo_name}",
+                    }
+
+                if train_args.streaming:
+                    # NOTE: IterableDatasetDict엔 column_names가 없고, features를 모르는 IterableDataset은
+                    #       column_names가 None이라서 첫 example의 key로 대신 함.
+                    column_names_ls = [x.column_names or list(next(iter(x)).keys()) for x in datasets.values()]
+                else:
+                    column_names_ls = list(datasets.column_names.values())
+
+                # DatasetsDict이라서 이런식으로 해줘야 함.
+                datasets = datasets.map(
+                    preprocessor,
+                    batched=True,
+                    batch_size=train_args.preprocessing_batch_size,
+                    remove_columns=set(sum(column_names_ls, [])),
+                    **map_kwargs,
+                )
+
+                datasets = datasets.filter(
+                    length_filter,
+                    input_columns=[train_args.length_column_name],
+                    batched=True,
+                    batch_size=train_args.preprocessing_batch_size,
+                    **filter_kwargs,
+                )
+
+                for split, fingerprint in fingerprint_map.items():
+                    cache_manager.register(fingerprint, repo_name, split)
 
             for data_type in truncate_map:
                 truncate_size = truncate_map[data_type]
+                if train_args.streaming:
+                    datasets[data_type] = datasets[data_type].take(truncate_size)
+                    continue
+
                 data = datasets[data_type].shuffle()
                 if len(data) <= truncate_size:
                     if is_main_process(train_args.local_rank):
@@ -210,19 +317,28 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
                     dataset = datasets[dataset_key]
                     test_dataset_ls.append(dataset)
 
-                if dataset and is_main_process(train_args.local_rank):
+                if dataset and not train_args.streaming and is_main_process(train_args.local_rank):
                     length_ls = sorted(dataset[train_args.length_column_name], reverse=True)
                     logger.info(f"{repo_name}/{dataset_key}-length: {length_ls[:100]}")
                     logger.info(
                         f"{dataset_key}_total_hour: {(sum(length_ls) / train_args.sampling_rate) / 60**2:.2f}h"
                     )
 
+        if cache_manager is not None and is_main_process(train_args.local_rank):
+            cache_manager.evict()
+
         train_dataset = None
         if train_dataset_ls:
             train_dataset = concatenate_datasets(train_dataset_ls)
             if train_args.do_packing:
                 train_dataset = packing_datasets(train_dataset, "train")
-            train_dataset.set_format("pt")
+            elif train_args.preprocess_mode == "lazy":
+                train_dataset.set_transform(lazy_preprocessor)
+            elif isinstance(train_dataset, IterableDataset):
+                # NOTE: IterableDataset엔 set_format이 없어서 새 dataset을 받음.
+                train_dataset = train_dataset.with_format("pt")
+            else:
+                train_dataset.set_format("pt")
             if is_main_process(train_args.local_rank):
                 logger.info(f"train_dataset:\n{train_dataset}")
 
@@ -231,7 +347,13 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
             valid_dataset = concatenate_datasets(valid_dataset_ls)
             if train_args.do_packing:
                 valid_dataset = packing_datasets(valid_dataset, "valid")
-            valid_dataset.set_format("pt")
+            elif train_args.preprocess_mode == "lazy":
+                valid_dataset.set_transform(lazy_preprocessor)
+            elif isinstance(valid_dataset, IterableDataset):
+                # NOTE: IterableDataset엔 set_format이 없어서 새 dataset을 받음.
+                valid_dataset = valid_dataset.with_format("pt")
+            else:
+                valid_dataset.set_format("pt")
             if is_main_process(train_args.local_rank):
                 logger.info(f"valid_dataset:\n{valid_dataset}")
 
@@ -240,7 +362,13 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
             test_dataset = concatenate_datasets(test_dataset_ls)
             if train_args.do_packing:
                 test_dataset = packing_datasets(test_dataset, "test")
-            test_dataset.set_format("pt")
+            elif train_args.preprocess_mode == "lazy":
+                test_dataset.set_transform(lazy_preprocessor)
+            elif isinstance(test_dataset, IterableDataset):
+                # NOTE: IterableDataset엔 set_format이 없어서 새 dataset을 받음.
+                test_dataset = test_dataset.with_format("pt")
+            else:
+                test_dataset.set_format("pt")
             if is_main_process(train_args.local_rank):
                 logger.info(f"test_dataset:\n{test_dataset}")
         return (train_dataset, valid_dataset, test_dataset)
@@ -249,6 +377,7 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
     config = Wav2Vec2Config.from_pretrained(
         model_name_or_path,
         attn_implementation=train_args.attn_implementation,
+        contrastive_loss_chunk_size=train_args.contrastive_loss_chunk_size,
     )
 
     if train_args.do_packing:
@@ -257,9 +386,6 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
         model = Wav2Vec2ForPreTraining.from_pretrained(model_name_or_path, config=config)
     processor = Wav2Vec2Processor.from_pretrained(model_name_or_path)
 
-    if config._attn_implementation == "flash_attention_2" and train_args.do_packing:
-        raise ValueError("packing 알고리즘은 flash_attention_2가 지원되지 않음. ㅇㅇ")
-
     if train_args.torch_compile:
         model = torch.compile(
             model,
@@ -275,6 +401,7 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
     if train_args.do_packing:
         collator = PackingCollator(
             pack_max_seq=train_args.packing_max_seq_len,
+            pad_to_multiple_of=train_args.packing_pad_to_multiple_of,
             mask_time_prob=config.mask_time_prob,
             mask_time_length=config.mask_time_length,
             mask_time_min_masks=config.mask_time_min_masks,
@@ -289,6 +416,18 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
             mask_time_length=config.mask_time_length,
             mask_time_min_masks=config.mask_time_min_masks,
             num_negatives=config.num_negatives,
+            sample_mask_on_device=train_args.sample_mask_on_device,
+        )
+
+    callbacks = list()
+    if train_args.profile_step_timing or train_args.torch_profiler_start_step is not None:
+        callbacks.append(
+            PretrainingProfilerCallback(
+                sampling_rate=processor.feature_extractor.sampling_rate,
+                torch_profiler_start_step=train_args.torch_profiler_start_step,
+                torch_profiler_num_steps=train_args.torch_profiler_num_steps,
+                torch_profiler_dir=train_args.torch_profiler_dir,
+            )
         )
 
     # set trainer
@@ -299,6 +438,7 @@ def main(train_args: Wav2Vec2PretrainingArguments) -> None:
         eval_dataset=valid_dataset,
         tokenizer=processor,
         args=train_args,
+        callbacks=callbacks,
     )
 
     if train_args.do_train and train_dataset:
@@ -3,23 +3,22 @@ from typing import Any, Dict, List, Optional, Tuple, Union
 import numpy as np
 import torch
 import torch.nn as nn
+from accelerate.utils import DistributedType
 from torch._tensor import Tensor
 from torch.nn.modules import Module
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 
+from data import PackedDatasetView
 from transformers import Trainer
 from transformers.integrations.deepspeed import deepspeed_init
 from transformers.trainer_pt_utils import (
     IterableDatasetShard,
+    LengthGroupedSampler,
     find_batch_size,
-    nested_concat,
     nested_detach,
-    nested_numpify,
 )
 from transformers.trainer_utils import (
     EvalLoopOutput,
-    EvalPrediction,
-    denumpify_detensorize,
     has_length,
 )
 from transformers.training_args import OptimizerNames
@@ -34,6 +33,7 @@ from transformers.utils import (
     is_torch_xpu_available,
     logging,
 )
+from utils import PretrainingProfilerCallback, compute_mask_indices_on_device, sample_negative_indices_on_device
 
 
 if is_apex_available():
@@ -52,31 +52,160 @@ if is_sagemaker_mp_enabled():
 logger = logging.get_logger(__name__)
 
 
-# 이게 acclerate의 기능과 맞물려서 어떤 사이드 이팩트를 만들어 낼지 모르겠다.
-# copied_from: examples/pytorch/speech-pretraining/run_wav2vec2_pretraining_no_trainer.py
-def multiply_grads(params: torch.nn.Parameter, loss: torch.Tensor) -> None:
-    """Multiplies grads by a constant *loss*."""
-    for p in params:
-        if p.grad is not None:
-            if torch.is_tensor(loss):
-                loss = loss.to(p.grad.device)
-            p.grad.data.mul_(loss)
+class Wav2Vec2Pretrainer(Trainer):
+    # NOTE: logging 용 metric은 tensor 하나에
+    #       [contrastive_loss, diversity_loss, loss, codevector_perplexity, percent_masked, num_losses] 순서로 모아서,
+    #       logging 할 때 collective 한 번으로 reduce 함.
+    metrics_buffer: Optional[Tensor] = None
+    pending_logs: Optional[Tuple[Dict[str, float], Tensor, Any, int, Optional[float]]] = None
+    _eval_mask_step = 0
+    profiler_callback: Optional[PretrainingProfilerCallback] = None
+
+    def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
+        # NOTE: PackedDatasetView는 datasets.Dataset이 아니라서 HF가 길이 column을 못 읽음.
+        #       group_by_length면 pack 길이(feature frame 수)가 비슷한 pack끼리 batch를 만들어서 padding을 줄임.
+        if self.args.group_by_length and isinstance(self.train_dataset, PackedDatasetView):
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=self.train_dataset.pack_lengths.tolist(),
+            )
+        return super()._get_train_sampler()
 
+    def _get_eval_sampler(self, eval_dataset: Dataset) -> Optional[torch.utils.data.Sampler]:
+        if (
+            self.args.group_by_length
+            and isinstance(eval_dataset, PackedDatasetView)
+            and not self.args.use_legacy_prediction_loop
+        ):
+            return LengthGroupedSampler(self.args.eval_batch_size, lengths=eval_dataset.pack_lengths.tolist())
+        return super()._get_eval_sampler(eval_dataset)
 
-class Wav2Vec2Pretrainer(Trainer):
-    contrastive_loss = 0.0
-    diversity_loss = 0.0
-    loss = 0.0
-    codevector_perplexity = 0
-    percent_masked = 0
-    num_losses = 0
+    def train(self, *args, **kwargs):
+        # NOTE: mark()가 micro step 마다 여러 번 불려서 callback 목록을 매번 뒤지지 않도록 train 시작 시 한 번만 찾아 둠.
+        self.profiler_callback = next(
+            (x for x in self.callback_handler.callbacks if isinstance(x, PretrainingProfilerCallback)), None
+        )
+        return super().train(*args, **kwargs)
+
+    def _mark_profile_phase(self, phase: str) -> None:
+        if self.profiler_callback is not None:
+            self.profiler_callback.mark(phase)
+
+    def _add_profile_batch(self, inputs: Dict[str, Tensor | Any]) -> None:
+        # NOTE: device로 옮기기 전의 cpu tensor로 세서 sync가 생기지 않게 함.
+        if self.profiler_callback is None:
+            return
+
+        if "segment_ids" in inputs:
+            audio_samples = sum(int(sum(split_idx)) for split_idx in inputs["split_idx"])
+            feature_frames = int((inputs["segment_ids"] >= 0).sum())
+            frame_capacity = inputs["segment_ids"].numel()
+        else:
+            attention_mask = inputs.get("attention_mask")
+            audio_samples = int(attention_mask.sum()) if attention_mask is not None else inputs["input_values"].numel()
+            sub_attention_mask = inputs.get("sub_attention_mask")
+            if sub_attention_mask is not None:
+                feature_frames, frame_capacity = int(sub_attention_mask.sum()), sub_attention_mask.numel()
+            else:
+                feature_frames = frame_capacity = inputs["mask_time_indices"].numel()
+        self.profiler_callback.add_batch(audio_samples, feature_frames, frame_capacity)
+
+    def _get_mask_generator(self, step_key: Tuple[int, ...]) -> torch.Generator:
+        # NOTE: seed를 (seed, process, step_key)로 매 step 새로 정해서, 같은 step이면 resume 후에도 같은 mask가 나옴.
+        seed = np.random.SeedSequence([self.args.seed, self.args.process_index, *step_key]).generate_state(1)[0]
+        return torch.Generator(device=self.args.device).manual_seed(int(seed))
+
+    def _sample_mask_time_indices(self, model: Module, inputs: Dict[str, Tensor | Any], step_key: Tuple[int, ...]):
+        # NOTE: collator가 sample_mask_on_device로 mask를 비워서 보낸 경우에만 여기서 뽑음.
+        #       mask는 shape과 길이만 있으면 돼서 input_values는 옮기지 않고 model device에 mask만 만듦.
+        if "mask_time_indices" in inputs:
+            return inputs
+
+        unwrapped_model = self.accelerator.unwrap_model(model)
+        config = unwrapped_model.config
+        batch_size, sample_size = inputs["input_values"].shape
+        sequence_length = int(unwrapped_model._get_feat_extract_output_lengths(sample_size))
+
+        sub_attention_mask = inputs.get("sub_attention_mask")
+        if sub_attention_mask is None and inputs.get("attention_mask") is not None:
+            sub_attention_mask = unwrapped_model._get_feature_vector_attention_mask(
+                sequence_length, inputs["attention_mask"]
+            )
+
+        mask_time_indices = compute_mask_indices_on_device(
+            (batch_size, sequence_length),
+            mask_prob=config.mask_time_prob,
+            mask_length=config.mask_time_length,
+            attention_mask=sub_attention_mask.to(self.args.device) if sub_attention_mask is not None else None,
+            min_masks=config.mask_time_min_masks,
+            device=self.args.device,
+            generator=self._get_mask_generator((*step_key, 0)),
+        )
+        inputs["mask_time_indices"] = mask_time_indices.long()
+        return inputs
+
+    def _sample_mask_on_device(self, model: Module, inputs: Dict[str, Tensor | Any], step_key: Tuple[int, ...]):
+        # NOTE: negative는 (batch, frame, num_negatives)라서 input_values 만큼 커질 수 있음. micro step 마다 여기서 뽑음.
+        if "sampled_negative_indices" in inputs:
+            return inputs
+
+        inputs = self._sample_mask_time_indices(model, inputs, step_key)
+        inputs["sampled_negative_indices"] = sample_negative_indices_on_device(
+            inputs["mask_time_indices"],
+            num_negatives=self.accelerator.unwrap_model(model).config.num_negatives,
+            generator=self._get_mask_generator((*step_key, 1)),
+        )
+        return inputs
+
+    def get_batch_samples(self, epoch_iterator, num_batches) -> Tuple[List[Dict[str, Tensor | Any]], Optional[Tensor]]:
+        # NOTE: accumulation window의 batch를 한 번에 받아서 window 전체의 masked frame 수를 미리 셈.
+        #       device에서 mask를 뽑는 경우엔 첫 backward 전에 수를 알아야 해서 mask_time_indices만 여기서 뽑음.
+        #       input_values를 device로 옮기는 것과 negative는 training_step에서 micro step 마다 함.
+        #       그래서 window에서 device에 미리 올라가는 건 (batch, frame) mask 뿐이고 process 간 collective는 window 당 한 번.
+        batch_samples = list()
+        for _ in range(num_batches):
+            try:
+                batch_samples.append(next(epoch_iterator))
+            except StopIteration:
+                break
+
+        if not batch_samples:
+            return batch_samples, None
+
+        for micro_step, inputs in enumerate(batch_samples):
+            if "mask_time_indices" not in inputs:
+                step_key = (0, self.state.global_step, micro_step)
+                self._sample_mask_time_indices(self.model, inputs, step_key)
+                inputs["mask_step_key"] = step_key
+
+        num_items_in_batch = sum(inputs["mask_time_indices"].sum().to(self.args.device) for inputs in batch_samples)
+        if self.accelerator.state.num_processes > 1:
+            num_items_in_batch = self.accelerator.gather(num_items_in_batch).sum()
+        return batch_samples, num_items_in_batch
+
+    def _update_gumbel_temperature(self, model: Module) -> None:
+        self.gumbel_temperature = max(
+            self.args.max_gumbel_temperature * self.args.gumbel_temperature_decay**self.state.global_step,
+            self.args.min_gumbel_temperature,
+        )
+        if hasattr(model, "module"):
+            model.module.set_gumbel_temperature(self.gumbel_temperature)
+        else:
+            model.set_gumbel_temperature(self.gumbel_temperature)
 
     def training_step(self, model: Module, inputs: Dict[str, Tensor | Any], num_items_in_batch=None) -> Tensor:
         model.train()
         if hasattr(self.optimizer, "train") and callable(self.optimizer.train):
             self.optimizer.train()
 
+        self._mark_profile_phase("data_wait")
+        # NOTE: 보통은 get_batch_samples에서 mask와 그 step_key가 같이 넘어옴. training_step을 바로 부른 경우엔 여기서 다 뽑음.
+        step_key = inputs.pop("mask_step_key", (0, self.state.global_step))
+        self._add_profile_batch(inputs)
+
         inputs = self._prepare_inputs(inputs)
+        inputs = self._sample_mask_on_device(model, inputs, step_key)
+        self._mark_profile_phase("data_wait")
 
         sub_attention_mask = inputs.pop("sub_attention_mask", None)
         sub_attention_mask = (
@@ -89,10 +218,12 @@ class Wav2Vec2Pretrainer(Trainer):
         if is_sagemaker_mp_enabled():
             # NOTE: sagemaker에선 outputs가 나오질 않음! 참고
             loss_mb = smp_forward_backward(model, inputs, self.args.gradient_accumulation_steps)
+            self._update_gumbel_temperature(model)
             return loss_mb.reduce_mean().detach().to(self.args.device)
 
         with self.compute_loss_context_manager():
             loss, outputs = self.compute_loss(model, inputs, return_outputs=True)
+        self._mark_profile_phase("forward")
 
         del inputs
         if (
@@ -121,86 +252,94 @@ class Wav2Vec2Pretrainer(Trainer):
         if self.args.n_gpu > 1:
             loss = loss.mean()  # mean() to average on multi-gpu parallel training
 
-        if self.use_apex:
-            with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss *= self.args.gradient_accumulation_steps
-            # NOTE: accelerate에서 gradient accumulation을 자동으로 계산 해줌. 어떻게 하는지는 모르지만....
-            self.accelerator.backward(loss)
-
         # NOTE: https://github.com/huggingface/transformers/pull/13877#discussion_r723197919 참고
-        if self.accelerator.state.num_processes > 1:
-            num_losses = self.accelerator.gather_for_metrics(num_losses).sum()
-            gradient_multiplier = self.accelerator.state.num_processes / num_losses
-            multiply_grads(model.module.parameters(), gradient_multiplier)
+        #       backward 후에 parameter 마다 grad를 다시 곱하는 대신, 같은 scale을 backward 전에 loss에 곱함.
+        #       DDP의 grad 평균(1/num_processes)은 gradient_multiplier의 num_processes가 상쇄 함.
+        #       num_items_in_batch는 get_batch_samples가 센 accumulation window 전체(모든 process)의
+        #       masked frame 수라서, micro step 마다 grad를 더하면 window 전체를 batch 하나로 돌린 것과 같은 grad가 됨.
+        #       HF Trainer는 accelerate에 gradient_accumulation_steps를 넘기지 않아서 DDP에선 backward가 나눠주지 않지만,
+        #       DeepSpeed는 DeepSpeedEngine.backward가 loss를 gradient_accumulation_steps로 나눔. 그래서 그만큼 미리 곱해서 상쇄 함.
+        if num_items_in_batch is not None:
+            gradient_multiplier = self.accelerator.state.num_processes / num_items_in_batch
         else:
-            multiply_grads(model.parameters(), 1 / num_losses)
+            # training_step을 바로 부른 경우엔 micro batch 별로 normalize 하고 window 안에서 평균 냄.
+            if self.accelerator.state.num_processes > 1:
+                num_losses = (
+                    self.accelerator.gather_for_metrics(num_losses).sum() / self.accelerator.state.num_processes
+                )
+            gradient_multiplier = 1 / (num_losses * self.args.gradient_accumulation_steps)
+        if self.accelerator.distributed_type == DistributedType.DEEPSPEED:
+            gradient_multiplier = gradient_multiplier * self.args.gradient_accumulation_steps
+        self._mark_profile_phase("grad_rescale")
 
-        self.gumbel_temperature = max(
-            self.args.max_gumbel_temperature * self.args.gumbel_temperature_decay**self.state.global_step,
-            self.args.min_gumbel_temperature,
-        )
-        if hasattr(model, "module"):
-            model.module.set_gumbel_temperature(self.gumbel_temperature)
+        if self.use_apex:
+            with amp.scale_loss(loss * gradient_multiplier, self.optimizer) as scaled_loss:
+                scaled_loss.backward()
         else:
-            model.set_gumbel_temperature(self.gumbel_temperature)
+            self.accelerator.backward(loss * gradient_multiplier)
+        self._mark_profile_phase("backward")
 
-        # TODO: 다른 loss에도 gradient accumulation이 적용이 되었는지는 모르겠음. 이건 확인 필요.
+        self._update_gumbel_temperature(model)
+
+        # NOTE: diversity loss도 model 안에서 masked frame 수를 곱해서 나오므로
+        #       contrastive loss와 같은 scale로 normalize 됨.
 
         # for logging
-        self.contrastive_loss += outputs.contrastive_loss.detach() / self.args.gradient_accumulation_steps
-        self.diversity_loss += outputs.diversity_loss.detach() / self.args.gradient_accumulation_steps
-        self.loss += outputs.loss.detach() / self.args.gradient_accumulation_steps
-        self.codevector_perplexity += outputs.codevector_perplexity.detach() / self.args.gradient_accumulation_steps
-        self.percent_masked += percent_masked.detach() / self.args.gradient_accumulation_steps
-        self.num_losses += num_losses.detach() / self.args.gradient_accumulation_steps
+        step_metrics = torch.stack(
+            [
+                outputs.contrastive_loss.detach().float(),
+                outputs.diversity_loss.detach().float(),
+                outputs.loss.detach().float(),
+                outputs.codevector_perplexity.detach().float(),
+                percent_masked.detach().float(),
+                num_losses.detach().float(),
+            ]
+        )
+        if self.metrics_buffer is None:
+            self.metrics_buffer = torch.zeros_like(step_metrics)
+        self.metrics_buffer += step_metrics / self.args.gradient_accumulation_steps
 
         # 사실상 return하는 loss는 사용하지 않음
         # inner_training_loop는 수정하기에는 리스크가 너무 큼.
         # 최소한의 코드 수정을 요하기 위해 이런 방식을 사용함.
-        return loss.detach() / self.args.gradient_accumulation_steps
+        return loss.detach()
 
     def _maybe_log_save_evaluate(self, tr_loss, grad_norm, model, trial, epoch, ignore_keys_for_eval):
         if self.control.should_log and self.state.global_step > self._globalstep_last_logged:
             if is_torch_xla_available():
                 xm.mark_step()
 
-            logs: Dict[str, float] = {}
-
-            # TODO: ctc reduction이 sum이냐 mean이냐에 따라 연산하는 방식이 달라질거임. 그거에 맞춰서 계산하는 방법을 구해야 할 듯
-            # all_gather + mean() to get average loss over all processes
-            tr_contrastive_loss_scalar = self._nested_gather(self.contrastive_loss / self.num_losses)
-            tr_diversity_loss_scalar = self._nested_gather(self.diversity_loss / self.num_losses)
-            tr_percent_masked = self._nested_gather(self.percent_masked / self.accelerator.num_processes)
-            tr_perplexity = self._nested_gather(self.codevector_perplexity / self.accelerator.num_processes)
-            tr_loss_scalar = self._nested_gather(self.loss / self.num_losses)
-
-            # reset tr_loss to zero
-            self.contrastive_loss -= self.contrastive_loss
-            self.diversity_loss -= self.diversity_loss
-            self.loss -= self.loss
-            self.codevector_perplexity -= self.codevector_perplexity
-            self.percent_masked -= self.percent_masked
-            self.num_losses -= self.num_losses
-
-            logs["loss"] = round(tr_loss_scalar.sum().item(), 4)
-            logs["constrast_loss"] = round(tr_contrastive_loss_scalar.sum().item(), 4)
-            logs["div_loss"] = round(tr_diversity_loss_scalar.sum().item(), 4)
-            logs["%_mask_idx"] = round(tr_percent_masked.sum().item(), 4)
-            logs["ppl"] = round(tr_perplexity.sum().item(), 4)
-            logs["temp"] = round(self.gumbel_temperature, 4)
-
-            if grad_norm is not None:
-                grad_norm = grad_norm if isinstance(grad_norm, float) else grad_norm.detach().item()
-                logs["grad_norm"] = round(grad_norm, 4)
-            logs["learning_rate"] = self._get_learning_rate()
-
-            self._total_loss_scalar += tr_loss_scalar
+            # NOTE: 이전 logging 구간의 metric은 지금쯤 host로 복사가 끝났으므로 기다리지 않고 log 함.
+            self._log_pending_metrics()
+
+            if self.metrics_buffer is None:
+                # NOTE: sagemaker mp에선 training_step이 outputs 없이 바로 return 해서 metric이 모이지 않음.
+                #       HF Trainer처럼 tr_loss로 loss만 바로 남김.
+                tr_loss_scalar = self._nested_gather(tr_loss).mean().item()
+                tr_loss -= tr_loss
+
+                logs: Dict[str, float] = {}
+                logs["loss"] = round(tr_loss_scalar / (self.state.global_step - self._globalstep_last_logged), 4)
+                logs["temp"] = round(self.gumbel_temperature, 4)
+                if grad_norm is not None:
+                    grad_norm = grad_norm if isinstance(grad_norm, float) else grad_norm.detach().item()
+                    logs["grad_norm"] = round(grad_norm, 4)
+                logs["learning_rate"] = self._get_learning_rate()
+                if self.profiler_callback is not None:
+                    logs.update(self.profiler_callback.pop_interval_logs())
+
+                self._total_loss_scalar += tr_loss_scalar
+                self.log(logs)
+            else:
+                self._queue_pending_metrics(grad_norm)
+
             self._globalstep_last_logged = self.state.global_step
-            self.store_flos()
+            # NOTE: store_flos도 process 간 collective라서 여기선 부르지 않음.
+            #       checkpoint 저장과 학습 종료 때 HF가 부름.
 
-            self.log(logs)
+        # 학습이 끝나거나 평가로 어차피 sync가 일어나는 경우엔 남은 log를 바로 남김.
+        if self.control.should_training_stop or self.control.should_evaluate:
+            self._log_pending_metrics()
 
         metrics = None
         if self.control.should_evaluate:
@@ -218,6 +357,77 @@ class Wav2Vec2Pretrainer(Trainer):
             self._save_checkpoint(model, trial, metrics=metrics)
             self.control = self.callback_handler.on_save(self.args, self.state, self.control)
 
+        self._mark_profile_phase("log_save_evaluate")
+
+    def _queue_pending_metrics(self, grad_norm) -> None:
+        # TODO: ctc reduction이 sum이냐 mean이냐에 따라 연산하는 방식이 달라질거임. 그거에 맞춰서 계산하는 방법을 구해야 할 듯
+        # process 별 합을 all_reduce 한 번으로 더함.
+        # num_losses도 process 별 값이라 더하면 전체 masked frame 수가 됨.
+        metrics_buffer = self.accelerator.reduce(self.metrics_buffer.clone(), reduction="sum")
+        self.metrics_buffer.zero_()
+
+        if grad_norm is not None and not isinstance(grad_norm, float):
+            metrics_buffer = torch.cat([metrics_buffer, grad_norm.detach().float().view(1).to(metrics_buffer)])
+            grad_norm = None
+
+        # NOTE: .item()으로 바로 읽으면 host가 GPU queue가 빌 때까지 멈춤.
+        #       pinned memory로 non_blocking 복사만 걸어두고 다음 logging 때 읽음.
+        #       이 구간 log는 step 번호를 기억해 두었다가 그 step으로 남김.
+        if metrics_buffer.is_cuda:
+            host_metrics = torch.empty(metrics_buffer.shape, dtype=metrics_buffer.dtype, pin_memory=True)
+            host_metrics.copy_(metrics_buffer, non_blocking=True)
+            copy_event = torch.cuda.Event()
+            copy_event.record()
+        else:
+            host_metrics, copy_event = metrics_buffer.cpu(), None
+
+        logs: Dict[str, float] = {}
+        logs["temp"] = round(self.gumbel_temperature, 4)
+        if grad_norm is not None:
+            logs["grad_norm"] = round(grad_norm, 4)
+        logs["learning_rate"] = self._get_learning_rate()
+        if self.profiler_callback is not None:
+            logs.update(self.profiler_callback.pop_interval_logs())
+        self.pending_logs = (logs, host_metrics, copy_event, self.state.global_step, self.state.epoch)
+
+    def _log_pending_metrics(self) -> None:
+        if self.pending_logs is None:
+            return
+
+        logs, host_metrics, copy_event, global_step, epoch = self.pending_logs
+        self.pending_logs = None
+        if copy_event is not None:
+            copy_event.synchronize()
+
+        # NOTE: loss들은 모든 process의 합을 전체 masked frame 수로 나눈 값(masked frame 당 평균)임.
+        #       process 별 loss / num_losses를 더하던 예전 값과는 process가 여러 개일 때 다름.
+        #       %_mask_idx, ppl은 예전처럼 process 평균.
+        num_processes = self.accelerator.num_processes
+        contrastive_loss, diversity_loss, loss, perplexity, percent_masked, num_losses = host_metrics[:6].tolist()
+        tr_loss_scalar = loss / num_losses
+
+        metric_logs = {
+            "loss": round(tr_loss_scalar, 4),
+            "constrast_loss": round(contrastive_loss / num_losses, 4),
+            "div_loss": round(diversity_loss / num_losses, 4),
+            "%_mask_idx": round(percent_masked / num_processes, 4),
+            "ppl": round(perplexity / num_processes, 4),
+        }
+        logs = {**metric_logs, **logs}
+        if len(host_metrics) > 6:
+            logs["grad_norm"] = round(host_metrics[6].item(), 4)
+            logs["learning_rate"] = logs.pop("learning_rate")
+
+        self._total_loss_scalar += tr_loss_scalar
+
+        # NOTE: log()는 현재 state의 step, epoch으로 기록하므로 metric을 모은 시점의 값으로 잠깐 바꿔서 log 함.
+        current_step, current_epoch = self.state.global_step, self.state.epoch
+        self.state.global_step, self.state.epoch = global_step, epoch
+        try:
+            self.log(logs)
+        finally:
+            self.state.global_step, self.state.epoch = current_step, current_epoch
+
     def prediction_step(
         self,
         model: nn.Module,
@@ -264,6 +474,8 @@ class Wav2Vec2Pretrainer(Trainer):
             return_loss = self.can_return_loss
 
         inputs = self._prepare_inputs(inputs)
+        inputs = self._sample_mask_on_device(model, inputs, (1, self._eval_mask_step))
+        self._eval_mask_step += 1
         if ignore_keys is None:
             if hasattr(self.model, "config"):
                 ignore_keys = getattr(self.model.config, "keys_to_ignore_at_inference", [])
@@ -355,6 +567,8 @@ class Wav2Vec2Pretrainer(Trainer):
         logger.info(f"  Batch size = {batch_size}")
 
         model.eval()
+        # NOTE: 평가 때마다 같은 mask를 쓰도록 eval mask seed를 처음부터 다시 셈.
+        self._eval_mask_step = 0
 
         self.callback_handler.eval_dataloader = dataloader
         # Do this before wrapping.
@@ -363,23 +577,11 @@ class Wav2Vec2Pretrainer(Trainer):
         if args.past_index >= 0:
             self._past = None
 
-        # Initialize containers
-        # losses/preds/labels on GPU/TPU (accumulated for eval_accumulation_steps)
-        codevector_perplexities_host = None
-        contrastive_losses_host = None
-        diversity_losses_host = None
-        num_losses_host = None
-        losses_host = None
-        inputs_host = None
-
-        # losses/preds/labels on CPU (final containers)
-        all_codevector_perplexities = None
-        all_contrastive_losses = None
-        all_diversity_losses = None
-        all_num_losses = None
-        all_losses = None
-        all_inputs = None
-
+        # NOTE: batch 마다 metric을 gather해서 host에 쌓지 않고,
+        #       device에서 가중합만 유지하다가 마지막에 한 번 reduce 함.
+        #       [loss, codevector_perplexity, contrastive_loss, diversity_loss, num_loss, weight] 순서.
+        #       weight는 batch가 대표하는 sample 수. 평균은 sample 기준으로 냄.
+        metric_sums = torch.zeros(6, dtype=torch.float32, device=args.device)
         all_preds = None
         all_labels = None
         # Will be useful when we have an iterable dataset so don't know its length.
@@ -402,144 +604,39 @@ class Wav2Vec2Pretrainer(Trainer):
                 prediction_loss_only,
                 ignore_keys=ignore_keys,
             )
-            main_input_name = getattr(self.model, "main_input_name", "input_ids")
-            inputs_decode = self._prepare_input(inputs[main_input_name]) if args.include_inputs_for_metrics else None
 
             if is_torch_xla_available():
                 xm.mark_step()
 
-            # Update containers on host
-            if loss is not None:
-                losses = self.gather_function((loss.repeat(batch_size)))
-                losses_host = losses if losses_host is None else nested_concat(losses_host, losses, padding_index=-100)
-            if codevector_perplexity is not None:
-                codevector_perplexities = self.gather_function((codevector_perplexity.repeat(batch_size)))
-                codevector_perplexities_host = (
-                    codevector_perplexities
-                    if codevector_perplexities_host is None
-                    else nested_concat(codevector_perplexities_host, codevector_perplexities, padding_index=-100)
-                )
-            if contrastive_loss is not None:
-                contrastive_losses = self.gather_function((contrastive_loss.repeat(batch_size)))
-                contrastive_losses_host = (
-                    contrastive_losses
-                    if contrastive_losses_host is None
-                    else nested_concat(contrastive_losses_host, contrastive_losses, padding_index=-100)
-                )
-            if diversity_loss is not None:
-                diversity_losses = self.gather_function((diversity_loss.repeat(batch_size)))
-                diversity_losses_host = (
-                    diversity_losses
-                    if diversity_losses_host is None
-                    else nested_concat(diversity_losses_host, diversity_losses, padding_index=-100)
-                )
-            if num_loss is not None:
-                num_losses = self.gather_function((num_loss.repeat(batch_size)))
-                num_losses_host = (
-                    num_losses
-                    if num_losses_host is None
-                    else nested_concat(num_losses_host, num_losses, padding_index=-100)
-                )
-            if inputs_decode is not None:
-                inputs_decode = self.accelerator.pad_across_processes(inputs_decode, dim=1, pad_index=-100)
-                inputs_decode = self.gather_function((inputs_decode))
-                inputs_host = (
-                    inputs_decode
-                    if inputs_host is None
-                    else nested_concat(inputs_host, inputs_decode, padding_index=-100)
+            # 마지막 batch는 gather_for_metrics와 같이 process 순서대로 remainder 개의 sample만 셈.
+            weight = batch_size
+            gradient_state = self.accelerator.gradient_state
+            if gradient_state.end_of_dataloader and gradient_state.remainder > 0:
+                weight = min(
+                    max(gradient_state.remainder - self.accelerator.process_index * batch_size, 0), batch_size
                 )
 
+            batch_metrics = torch.stack(
+                [
+                    loss.float(),
+                    codevector_perplexity.float(),
+                    contrastive_loss.float(),
+                    diversity_loss.float(),
+                    num_loss.float(),
+                    torch.ones((), device=loss.device),
+                ]
+            )
+            metric_sums += batch_metrics.to(metric_sums.device) * weight
+
             self.control = self.callback_handler.on_prediction_step(args, self.state, self.control)
 
-            # Gather all tensors and put them back on the CPU if we have done enough accumulation steps.
-            if args.eval_accumulation_steps is not None and (step + 1) % args.eval_accumulation_steps == 0:
-                if losses_host is not None:
-                    losses = nested_numpify(losses_host)
-                    all_losses = losses if all_losses is None else np.concatenate((all_losses, losses), axis=0)
-                if codevector_perplexities_host is not None:
-                    codevector_perplexities = nested_numpify(codevector_perplexities_host)
-                    all_codevector_perplexities = (
-                        codevector_perplexities
-                        if all_codevector_perplexities is None
-                        else np.concatenate((all_codevector_perplexities, codevector_perplexities), axis=0)
-                    )
-                if contrastive_losses_host is not None:
-                    contrastive_losses = nested_numpify(contrastive_losses_host)
-                    all_contrastive_losses = (
-                        contrastive_losses
-                        if all_contrastive_losses is None
-                        else np.concatenate((all_contrastive_losses, contrastive_losses), axis=0)
-                    )
-                if diversity_losses_host is not None:
-                    diversity_losses = nested_numpify(diversity_losses_host)
-                    all_diversity_losses = (
-                        diversity_losses
-                        if all_diversity_losses is None
-                        else np.concatenate((all_diversity_losses, diversity_losses), axis=0)
-                    )
-                if num_losses_host is not None:
-                    num_losses = nested_numpify(num_losses_host)
-                    all_num_losses = (
-                        num_losses if all_num_losses is None else np.concatenate((all_num_losses, num_losses), axis=0)
-                    )
-                if inputs_host is not None:
-                    inputs_decode = nested_numpify(inputs_host)
-                    all_inputs = (
-                        inputs_decode
-                        if all_inputs is None
-                        else nested_concat(all_inputs, inputs_decode, padding_index=-100)
-                    )
-                # Set back to None to begin a new accumulation
-                (
-                    losses_host,
-                    codevector_perplexities_host,
-                    contrastive_losses_host,
-                    diversity_losses_host,
-                    num_losses_host,
-                    inputs_host,
-                ) = (None, None, None, None, None, None)
-
-        # After all calls to `.gather_function`, reset to `gather_for_metrics`:
-        self.gather_function = self.accelerator.gather_for_metrics
         if args.past_index and hasattr(self, "_past"):
             # Clean the state at the end of the evaluation loop
             delattr(self, "_past")
 
-        # Gather all remaining tensors and put them back on the CPU
-        if losses_host is not None:
-            losses = nested_numpify(losses_host)
-            all_losses = losses if all_losses is None else np.concatenate((all_losses, losses), axis=0)
-        if codevector_perplexities_host is not None:
-            codevector_perplexities = nested_numpify(codevector_perplexities_host)
-            all_codevector_perplexities = (
-                codevector_perplexities
-                if all_codevector_perplexities is None
-                else np.concatenate((all_codevector_perplexities, codevector_perplexities), axis=0)
-            )
-        if contrastive_losses_host is not None:
-            contrastive_losses = nested_numpify(contrastive_losses_host)
-            all_contrastive_losses = (
-                contrastive_losses
-                if all_contrastive_losses is None
-                else np.concatenate((all_contrastive_losses, contrastive_losses), axis=0)
-            )
-        if diversity_losses_host is not None:
-            diversity_losses = nested_numpify(diversity_losses_host)
-            all_diversity_losses = (
-                diversity_losses
-                if all_diversity_losses is None
-                else np.concatenate((all_diversity_losses, diversity_losses), axis=0)
-            )
-        if num_losses_host is not None:
-            num_losses = nested_numpify(num_losses_host)
-            all_num_losses = (
-                num_losses if all_num_losses is None else np.concatenate((all_num_losses, num_losses), axis=0)
-            )
-        if inputs_host is not None:
-            inputs_decode = nested_numpify(inputs_host)
-            all_inputs = (
-                inputs_decode if all_inputs is None else nested_concat(all_inputs, inputs_decode, padding_index=-100)
-            )
+        loss_sum, perplexity_sum, contrastive_loss_sum, diversity_loss_sum, num_loss_sum, weight_sum = (
+            self.accelerator.reduce(metric_sums, reduction="sum").tolist()
+        )
 
         # Number of samples
         if has_length(eval_dataset):
@@ -556,40 +653,13 @@ class Wav2Vec2Pretrainer(Trainer):
         if num_samples == 0 and observed_num_examples > 0:
             num_samples = observed_num_examples
 
-        # Metrics!
-        if self.compute_metrics is not None and all_preds is not None and all_labels is not None:
-            if args.include_inputs_for_metrics:
-                metrics = self.compute_metrics(
-                    EvalPrediction(predictions=all_preds, label_ids=all_labels, inputs=all_inputs)
-                )
-            else:
-                metrics = self.compute_metrics(EvalPrediction(predictions=all_preds, label_ids=all_labels))
-        else:
-            metrics = {}
-
-        # To be JSON-serializable, we need to remove numpy types or zero-d tensors
-        metrics = denumpify_detensorize(metrics)
-
-        if all_losses is not None:
-            all_losses = all_losses.astype(np.float32)
-            metrics[f"{metric_key_prefix}_loss"] = round(all_losses.sum().item() / all_num_losses.sum().item(), 4)
-
-        if all_codevector_perplexities is not None:
-            all_codevector_perplexities = all_codevector_perplexities.astype(np.float32)
-            metrics[f"{metric_key_prefix}_ppl"] = round(all_codevector_perplexities.mean().item(), 4)
-
-        if all_contrastive_losses is not None:
-            all_contrastive_losses = all_contrastive_losses.astype(np.float32)
-            metrics[f"{metric_key_prefix}_contrastive_loss"] = round(
-                all_contrastive_losses.sum().item() / all_num_losses.sum().item(), 4
-            )
-
-        # inf가 발생하는 원인은 overflow 때문임.
-        if all_diversity_losses is not None:
-            all_diversity_losses = all_diversity_losses.astype(np.float32)
-            metrics[f"{metric_key_prefix}_diversity_loss"] = round(
-                all_diversity_losses.sum().item() / all_num_losses.sum().item(), 4
-            )
+        metrics: Dict[str, float] = {}
+        if weight_sum > 0:
+            metrics[f"{metric_key_prefix}_loss"] = round(loss_sum / num_loss_sum, 4)
+            metrics[f"{metric_key_prefix}_ppl"] = round(perplexity_sum / weight_sum, 4)
+            metrics[f"{metric_key_prefix}_contrastive_loss"] = round(contrastive_loss_sum / num_loss_sum, 4)
+            # inf가 발생하는 원인은 overflow 때문임.
+            metrics[f"{metric_key_prefix}_diversity_loss"] = round(diversity_loss_sum / num_loss_sum, 4)
 
         if hasattr(self, "jit_compilation_time"):
             metrics[f"{metric_key_prefix}_jit_compilation_time"] = self.jit_compilation_time